@@ -0,0 +1,408 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic_fasta import format_size, parse_size, write_fasta
+from musicinator import render_request
+from packages.calculate_gc import calculate_gc_per_residue
+from packages.detect_motifs import generate_motif_hits
+from packages.detect_repeats import find_context_repeats, find_tandem_repeats
+from packages.fasta_midi_converter import AAToMidiCSV
+from packages.get_tempo import tempo_inator
+from packages.map_duration import compute_timeline, map_notes_to_durations
+from packages.map_pitch import find_orfs, shift_orf_pitch
+from packages.midi_writer import write_note_table
+from packages.sequence_context import SequenceContext
+from packages.sweep import run_sweep, sweep_grid
+from packages.translate_file import translate_file, translate_frames
+
+'''
+Benchmark suite for the Musicinator.
+For every size a seeded synthetic FASTA file is written (see synthetic_fasta.py), then every package
+function and the end-to-end CLI are timed on it. The report shows the time at every size and the
+scaling exponent (the slope of log time over log size, 1.0 means linear).
+Results can be saved as a baseline and later runs compared against it with a regression threshold,
+a benchmark without a baseline timing is reported so it does not go unchecked.
+The golden check runs the CLI on the example file and compares the CSV/MIDI bytes with golden.json,
+so an optimization that changes the output is caught right away.
+The import check starts the CLI with -X importtime and fails when its imports take longer than a budget
+or load a heavy dependency (pandas, matplotlib, Biopython, ...) that the command does not need.
+
+Run it from the repository root:
+    python -m benchmarks.run_benchmarks --sizes 1k 10k 100k 1M
+    python -m benchmarks.run_benchmarks --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run_benchmarks --golden-only
+    python -m benchmarks.run_benchmarks --imports-only --import-budget 200
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.join(ROOT, "benchmarks")
+CLI = os.path.join(ROOT, "musicinator.py")
+EXAMPLE_FASTA = os.path.join(ROOT, "example_files", "GJB2_hearing_protein.fasta")
+GOLDEN_FILE = os.path.join(HERE, "golden.json")
+BASELINE_FILE = os.path.join(HERE, "baseline.json")
+
+DEFAULT_SIZES = ("1k", "10k", "100k", "1M")
+#Command line the golden outputs were made with, relative to a fresh working directory
+GOLDEN_ARGS = ["--write-standardized", "--no-plots"]
+#Modules the CLI must not load just to start, the stages that need them import them when they run
+HEAVY_MODULES = ("pandas", "matplotlib", "Bio", "mido", "asyncio", "multiprocessing")
+#Budget for the imports of one cold start in ms, the times measured with -X importtime are a bit inflated
+DEFAULT_IMPORT_BUDGET = 300
+#Commands whose imports are checked: the help, and a render of the example that writes neither plots nor CSV
+IMPORT_COMMANDS = {"help": ["-h"], "render_npz": [EXAMPLE_FASTA, "--no-plots", "--format", "npz"]}
+#A benchmark is only a regression when it is this many times slower than the baseline...
+DEFAULT_THRESHOLD = 1.5
+#...and at least this many seconds slower, so timer noise on tiny inputs is ignored
+MIN_REGRESSION_SECONDS = 0.005
+
+
+def time_call(func, repeat=3, budget=3.0):
+    """
+    Returns the fastest of up to repeat runs of func() in seconds.
+    Stops repeating once the runs so far took more than budget seconds, so big inputs run only once.
+    """
+    best = float("inf")
+    spent = 0.0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = min(best, elapsed)
+        spent += elapsed
+        if spent > budget:
+            break
+    return best
+
+
+def run_cli(fasta, workdir, extra_args=()):
+    #Runs musicinator.py in its own process, the way a user would
+    subprocess.run([sys.executable, CLI, fasta, *extra_args], cwd=workdir, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def import_times(cli_args, workdir):
+    """
+    Runs the CLI with -X importtime and returns the cumulative import time in microseconds
+    of every module imported at the top level, and the names of all modules that were loaded.
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", CLI, *cli_args], cwd=workdir, check=True,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    top_level, loaded = {}, set()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        loaded.add(name.strip())
+        #Nested imports are indented below the module that caused them
+        if len(name) - len(name.lstrip()) == 1:
+            top_level[name.strip()] = int(cumulative)
+    return top_level, loaded
+
+
+def import_check(budget=DEFAULT_IMPORT_BUDGET):
+    """
+    Times the imports of every IMPORT_COMMANDS run of the CLI and prints the total and the slowest modules.
+    Returns the commands that took longer than budget ms or loaded one of the HEAVY_MODULES.
+    """
+    failed = []
+    with tempfile.TemporaryDirectory(prefix="musicinator_imports_") as workdir:
+        for name, cli_args in IMPORT_COMMANDS.items():
+            top_level, loaded = import_times(cli_args, workdir)
+            total = sum(top_level.values()) / 1000
+            heavy = sorted({module.split(".")[0] for module in loaded} & set(HEAVY_MODULES))
+            slowest = sorted(top_level.items(), key=lambda item: -item[1])[:3]
+            ok = total <= budget and not heavy
+            print(f"imports {name:<12} {total:8.1f} ms {'ok' if ok else 'FAILED':<7}"
+                  f"slowest: {', '.join(f'{module} {us / 1000:.1f} ms' for module, us in slowest)}")
+            if heavy:
+                print(f"imports {name:<12} loads {', '.join(heavy)}")
+            if not ok:
+                failed.append(name)
+    return failed
+
+
+def package_benchmarks(fasta, workdir):
+    """
+    Prepares the inputs of every package function for one FASTA file (untimed) and
+    returns a list of (name, function) pairs that each run one step.
+    """
+    context = SequenceContext.from_fasta(fasta)
+    aa = translate_file(context)
+    table = AAToMidiCSV(aa).convert_to_note_table()
+    durations = map_notes_to_durations(table["Note"])
+    time_column, start_ticks, duration_ticks = compute_timeline(durations, 120)
+    table["Duration"] = durations
+    table["Time"] = time_column
+    orf_starts, orf_ends = find_orfs(aa)
+    midi_path = os.path.join(workdir, "benchmark.mid")
+    with open(fasta, "rb") as file:
+        fasta_bytes = file.read()
+    #What one request to a warm 'musicinator.py serve' worker costs, compare with cli
+    serve_settings = {"motif_table": None, "stage_cache": None, "stage_cache_size": 0}
+    #12 variants of the sequence, compare with 12 times cli
+    sweep_variants = sweep_grid([6, 12, 24], [1.0, 1.27], [(1.15, 1.05), (1.3, 1.0)], [None])
+
+    return [
+        ("parse", lambda: SequenceContext.from_fasta(fasta)),
+        ("translate_file", lambda: translate_file(context)),
+        ("translate_six_frames", lambda: [translate_frames(record) for record in context.records()]),
+        ("note_table", lambda: AAToMidiCSV(aa).convert_to_note_table()),
+        ("calculate_gc", lambda: calculate_gc_per_residue(context)),
+        ("tempo_inator", lambda: tempo_inator(aa)),
+        ("generate_motif_hits", lambda: generate_motif_hits(context, len(aa))),
+        ("tandem_repeats", lambda: find_tandem_repeats(aa)),
+        ("base_repeats", lambda: find_context_repeats(context)),
+        ("map_duration", lambda: compute_timeline(map_notes_to_durations(table["Note"]), 120)),
+        ("map_pitch", lambda: shift_orf_pitch(table["Note"], *find_orfs(aa))),
+        ("find_orfs", lambda: find_orfs(aa)),
+        ("shift_orf_pitch", lambda: shift_orf_pitch(table["Note"], orf_starts, orf_ends)),
+        ("midi_export", lambda: write_note_table(midi_path, table, 2 * start_ticks, duration_ticks)),
+        ("serve_request", lambda: os.unlink(render_request(serve_settings, fasta_bytes, "").path)),
+        ("sweep_12_variants", lambda: run_sweep(context, sweep_variants, os.path.join(workdir, "sweep"), jobs=1)),
+        ("cli", lambda: run_cli(fasta, workdir, ["--no-plots"])),
+        ("cli_start", lambda: subprocess.run([sys.executable, CLI, "-h"], check=True, stdout=subprocess.DEVNULL)),
+    ]
+
+
+def run_suite(sizes, repeat=3, records=1, gc=0.5, motif_density=2.0, orf_density=0.5, seed=0, only=None):
+    """
+    Times every benchmark at every size and returns the results as a dict:
+    {"sizes": {label: bases}, "results": {benchmark: {label: seconds}}, plus details of the run}.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="musicinator_bench_") as workdir:
+        for length in sizes:
+            label = format_size(length)
+            fasta = write_fasta(os.path.join(workdir, f"synthetic_{label}.fasta"), length, records,
+                                gc, motif_density, orf_density, seed)
+            for name, func in package_benchmarks(fasta, workdir):
+                if only and name not in only:
+                    continue
+                seconds = time_call(func, repeat)
+                results.setdefault(name, {})[label] = seconds
+                print(f"{label:>6} {name:<20} {seconds * 1000:10.2f} ms")
+            os.remove(fasta)
+    return {
+        "sizes": {format_size(length): length for length in sizes},
+        "results": results,
+        "generator": {"records": records, "gc": gc, "motif_density": motif_density,
+                      "orf_density": orf_density, "seed": seed},
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+
+
+def scaling_exponent(sizes, seconds):
+    """Slope of log(seconds) over log(size), about 1.0 for linear and 2.0 for quadratic code."""
+    if len(sizes) < 2:
+        return float("nan")
+    return float(np.polyfit(np.log(sizes), np.log(np.maximum(seconds, 1e-9)), 1)[0])
+
+
+def format_report(report):
+    """Formats the results as a table of milliseconds per size, with the scaling exponent and the throughput at the largest size."""
+    labels = list(report["sizes"])
+    lines = [f"{'benchmark':<20}" + "".join(f"{label + ' ms':>12}" for label in labels) + f"{'scaling':>9}{'Mb/s':>9}"]
+    for name, timings in report["results"].items():
+        present = [label for label in labels if label in timings]
+        seconds = [timings[label] for label in present]
+        slope = scaling_exponent([report["sizes"][label] for label in present], seconds)
+        throughput = report["sizes"][present[-1]] / seconds[-1] / 1e6 if seconds else float("nan")
+        cells = "".join(f"{timings[label] * 1000:12.2f}" if label in timings else f"{'-':>12}" for label in labels)
+        lines.append(f"{name:<20}{cells}{slope:9.2f}{throughput:9.1f}")
+    return "\n".join(lines)
+
+
+def plot_scaling(report, path):
+    """Saves a log-log plot of time over sequence length for every benchmark."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(8, 6))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    for name, timings in report["results"].items():
+        labels = [label for label in report["sizes"] if label in timings]
+        axes.loglog([report["sizes"][label] for label in labels], [timings[label] for label in labels],
+                    marker="o", label=name)
+    axes.set_xlabel("Bases")
+    axes.set_ylabel("Seconds")
+    axes.set_title("Musicinator scaling")
+    axes.legend(fontsize="small")
+    figure.tight_layout()
+    figure.savefig(path)
+
+
+def compare_to_baseline(report, baseline, threshold=DEFAULT_THRESHOLD, min_seconds=MIN_REGRESSION_SECONDS):
+    """
+    Compares the timings with a stored baseline report.
+    Returns a list of (benchmark, size, baseline seconds, seconds) for every timing that is more than
+    threshold times and more than min_seconds slower than the baseline.
+    """
+    regressions = []
+    for name, timings in report["results"].items():
+        for label, seconds in timings.items():
+            before = baseline.get("results", {}).get(name, {}).get(label)
+            if before is None:
+                continue
+            if seconds > before * threshold and seconds - before > min_seconds:
+                regressions.append((name, label, before, seconds))
+    return regressions
+
+
+def missing_from_baseline(report, baseline):
+    """Returns (benchmark, [sizes]) for every benchmark that ran at sizes the baseline has no timing for."""
+    missing = []
+    for name, timings in report["results"].items():
+        stored = baseline.get("results", {}).get(name, {})
+        labels = [label for label in timings if label not in stored]
+        if labels:
+            missing.append((name, labels))
+    return missing
+
+
+def merge_baseline(report, path):
+    """
+    Returns the report to save as the baseline at path: the new timings replace the stored ones,
+    the timings of benchmarks and sizes that did not run this time are kept.
+    """
+    if not os.path.exists(path):
+        return report
+    with open(path) as file:
+        baseline = json.load(file)
+    merged = dict(report, sizes={**baseline.get("sizes", {}), **report["sizes"]},
+                  results={name: dict(timings) for name, timings in baseline.get("results", {}).items()})
+    for name, timings in report["results"].items():
+        merged["results"].setdefault(name, {}).update(timings)
+    return merged
+
+
+def output_hashes(directory, names):
+    #sha256 of every output file, None when it was not written
+    hashes = {}
+    for name in names:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                hashes[name] = hashlib.sha256(file.read()).hexdigest()
+        else:
+            hashes[name] = None
+    return hashes
+
+
+def golden_check(update=False, golden_file=GOLDEN_FILE):
+    """
+    Runs the CLI on the example file and compares the bytes of its outputs with the stored golden hashes.
+    With update the current outputs become the new golden outputs. Returns the names of the files that differ.
+    """
+    with tempfile.TemporaryDirectory(prefix="musicinator_golden_") as workdir:
+        run_cli(EXAMPLE_FASTA, workdir, GOLDEN_ARGS)
+        if update:
+            names = sorted(name for name in os.listdir(workdir) if os.path.isfile(os.path.join(workdir, name)))
+            golden = {"input": os.path.relpath(EXAMPLE_FASTA, ROOT), "args": GOLDEN_ARGS,
+                      "files": output_hashes(workdir, names)}
+            with open(golden_file, "w") as file:
+                json.dump(golden, file, indent=2)
+                file.write("\n")
+            print(f"Updated {golden_file}")
+            return []
+        with open(golden_file) as file:
+            golden = json.load(file)
+        current = output_hashes(workdir, golden["files"])
+    differ = [name for name, digest in golden["files"].items() if current[name] != digest]
+    for name in golden["files"]:
+        print(f"golden {name:<32} {'DIFFERS' if name in differ else 'ok'}")
+    return differ
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Musicinator on synthetic FASTA files")
+    parser.add_argument("--sizes", nargs="+", default=list(DEFAULT_SIZES),
+                        help="Sequence lengths to benchmark, e.g. 1k 10k 1M 100M")
+    parser.add_argument("--only", nargs="+", help="Only run these benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per timing, the fastest is kept")
+    parser.add_argument("--records", type=int, default=1, help="Records per synthetic file")
+    parser.add_argument("--gc", type=float, default=0.5, help="GC fraction of the synthetic files")
+    parser.add_argument("--motif-density", type=float, default=2.0, help="Motifs planted per kb")
+    parser.add_argument("--orf-density", type=float, default=0.5, help="ORFs planted per kb")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic files")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--plot", help="Save a log-log scaling plot (png)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline results to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Slowdown factor over the baseline that counts as a regression")
+    parser.add_argument("--save-baseline", metavar="PATH",
+                        help="Save the results as the new baseline (timings that did not run are kept)")
+    parser.add_argument("--skip-golden", action="store_true", help="Skip the golden output check")
+    parser.add_argument("--golden-only", action="store_true", help="Only run the golden output check")
+    parser.add_argument("--update-golden", action="store_true", help="Store the current example outputs as golden")
+    parser.add_argument("--skip-imports", action="store_true", help="Skip the import time check")
+    parser.add_argument("--imports-only", action="store_true", help="Only run the import time check")
+    parser.add_argument("--import-budget", type=float, default=DEFAULT_IMPORT_BUDGET,
+                        help="Import time budget of one CLI start in ms")
+    args = parser.parse_args(argv)
+
+    if args.imports_only:
+        return 1 if import_check(args.import_budget) else 0
+    failed = False
+    if not args.skip_golden:
+        differ = golden_check(update=args.update_golden)
+        if differ:
+            print(f"Golden check failed: {', '.join(differ)} changed")
+            failed = True
+    if args.golden_only or args.update_golden:
+        return 1 if failed else 0
+    if not args.skip_imports:
+        slow = import_check(args.import_budget)
+        if slow:
+            print(f"Import check failed: {', '.join(slow)}")
+            failed = True
+
+    sizes = [parse_size(size) for size in args.sizes]
+    report = run_suite(sizes, args.repeat, args.records, args.gc, args.motif_density,
+                       args.orf_density, args.seed, args.only)
+    print()
+    print(format_report(report))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Created {args.output}")
+    if args.plot:
+        plot_scaling(report, args.plot)
+        print(f"Created {args.plot}")
+    if args.save_baseline:
+        merged = merge_baseline(report, args.save_baseline)
+        with open(args.save_baseline, "w") as file:
+            json.dump(merged, file, indent=2)
+            file.write("\n")
+        print(f"Saved baseline {args.save_baseline}")
+    elif args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        for name, labels in missing_from_baseline(report, baseline):
+            print(f"NO BASELINE {name} at {', '.join(labels)}, not checked "
+                  f"(add it with --only {name} --save-baseline {os.path.relpath(args.baseline)})")
+        regressions = compare_to_baseline(report, baseline, args.threshold)
+        for name, label, before, seconds in regressions:
+            print(f"REGRESSION {name} at {label}: {before * 1000:.2f} ms -> {seconds * 1000:.2f} ms "
+                  f"({seconds / before:.2f}x)")
+        if regressions:
+            failed = True
+        else:
+            print(f"No regressions against {args.baseline} (threshold {args.threshold}x)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
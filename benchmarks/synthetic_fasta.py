@@ -0,0 +1,123 @@
+import argparse
+import re
+
+import numpy as np
+
+from packages.detect_motifs import motif_to_drum
+
+'''
+Seeded generator of synthetic FASTA files for the benchmarks.
+The same arguments and seed always give the same file, so timings of different commits are comparable.
+You can control:
+- length: total number of bases (1 kb up to 100 Mb and more, written in blocks so memory stays flat)
+- records: number of records the bases are split over
+- gc: fraction of G and C bases
+- motif_density: motifs from detect_motifs planted per kb
+- orf_density: ATG ... stop open reading frames planted per kb, in the reading frame that gets translated
+'''
+
+#Bases generated per block, a multiple of 3 so planted ORFs stay in frame across blocks
+BLOCK_SIZE = 3 << 20
+LINE_WIDTH = 60
+
+_SIZE_SUFFIXES = {"": 1, "k": 10**3, "m": 10**6, "g": 10**9}
+_STOP_CODONS = (b"TAA", b"TAG", b"TGA")
+
+
+def parse_size(text):
+    """Turns a size like 1000, 10k, 2.5M or 1G into a number of bases."""
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([kKmMgG]?)[bB]?\s*", str(text))
+    if not match:
+        raise ValueError(f"Not a size: {text}")
+    return int(float(match.group(1)) * _SIZE_SUFFIXES[match.group(2).lower()])
+
+
+def format_size(length):
+    """Turns a number of bases back into a short label like 10k or 1M."""
+    for suffix, factor in (("G", 10**9), ("M", 10**6), ("k", 10**3)):
+        if length >= factor and length % factor == 0:
+            return f"{length // factor}{suffix}"
+    return str(length)
+
+
+def _plant(block, rng, words, count):
+    #Writes count randomly chosen words at random positions of block, all occurrences of one word at once
+    if count == 0:
+        return
+    choice = rng.integers(0, len(words), size=count)
+    starts = rng.integers(0, len(block), size=count)
+    for index, word in enumerate(words):
+        positions = starts[choice == index]
+        positions = positions[positions + len(word) <= len(block)]
+        codes = np.frombuffer(word, dtype=np.uint8)
+        block[positions[:, None] + np.arange(len(word))] = codes
+
+
+def generate_block(rng, length, gc=0.5, motif_density=0.0, orf_density=0.0):
+    """
+    Returns length random bases as a uint8 array of ASCII codes.
+    Motifs are planted anywhere, ORFs start at a multiple of 3 (the frame translate_file reads)
+    with an ATG followed 30-300 codons later by a stop codon.
+    """
+    probabilities = [(1 - gc) / 2, gc / 2, gc / 2, (1 - gc) / 2]
+    block = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.choice(4, size=length, p=probabilities)]
+
+    motifs = [motif.encode("ascii") for motif in motif_to_drum]
+    _plant(block, rng, motifs, rng.poisson(motif_density * length / 1000))
+
+    orfs = rng.poisson(orf_density * length / 1000)
+    if orfs and length >= 6:
+        starts = rng.integers(0, length // 3 - 1, size=orfs) * 3
+        stops = starts + rng.integers(30, 301, size=orfs) * 3
+        keep = stops + 3 <= length
+        starts, stops = starts[keep], stops[keep]
+        block[starts[:, None] + np.arange(3)] = np.frombuffer(b"ATG", dtype=np.uint8)
+        _plant_stops = rng.integers(0, len(_STOP_CODONS), size=len(stops))
+        for index, codon in enumerate(_STOP_CODONS):
+            positions = stops[_plant_stops == index]
+            block[positions[:, None] + np.arange(3)] = np.frombuffer(codon, dtype=np.uint8)
+    return block
+
+
+def write_fasta(path, length, records=1, gc=0.5, motif_density=0.0, orf_density=0.0, seed=0, line_width=LINE_WIDTH):
+    """
+    Writes a synthetic FASTA file of length bases split over records records and returns its path.
+    Every record is generated in blocks of BLOCK_SIZE bases, so a 100 Mb file needs only a few MB of memory.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = np.full(records, length // records, dtype=np.int64)
+    sizes[:length % records] += 1
+    with open(path, "wb") as file:
+        for record, size in enumerate(sizes):
+            file.write(f">synthetic_{record + 1} length={size} gc={gc} seed={seed}\n".encode("ascii"))
+            #Bases that did not fill a whole line yet are carried over to the next block
+            pending = np.zeros(0, dtype=np.uint8)
+            for offset in range(0, size, BLOCK_SIZE):
+                block = generate_block(rng, min(BLOCK_SIZE, size - offset), gc, motif_density, orf_density)
+                bases = np.concatenate((pending, block))
+                full = len(bases) // line_width * line_width
+                lines = bases[:full].reshape(-1, line_width)
+                file.write(np.column_stack((lines, np.full(len(lines), ord("\n"), dtype=np.uint8))).tobytes())
+                pending = bases[full:]
+            if len(pending):
+                file.write(pending.tobytes() + b"\n")
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a seeded synthetic FASTA file for benchmarking")
+    parser.add_argument("output", help="FASTA file to write")
+    parser.add_argument("--length", default="1M", help="Total number of bases, e.g. 1k, 10M, 100M (default 1M)")
+    parser.add_argument("--records", type=int, default=1, help="Number of records")
+    parser.add_argument("--gc", type=float, default=0.5, help="Fraction of G and C bases")
+    parser.add_argument("--motif-density", type=float, default=2.0, help="Motifs planted per kb")
+    parser.add_argument("--orf-density", type=float, default=0.5, help="ORFs planted per kb")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args(argv)
+    write_fasta(args.output, parse_size(args.length), args.records, args.gc,
+                args.motif_density, args.orf_density, args.seed)
+    print(f"Created {args.output}")
+
+
+if __name__ == "__main__":
+    main()
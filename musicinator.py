@@ -1,16 +1,32 @@
 import argparse
-import pandas as pd
+import contextlib
+import io
 import numpy as np
 import os
-from packages.fasta_midi_converter import AAToMidiCSV
-from packages.map_pitch import map_pitch
-from packages.detect_motifs import generate_motif_hits
-from packages.calculate_gc import calculate_gc_content
-from packages.farruhs_packages import farruhs_packages
-from packages.translate_file import translate_file
-from packages.map_duration import map_note_to_duration, map_note_to_pitch
-from mido import Message, MidiFile, MidiTrack
-from packages.musicplots import plot_music_data
+import sys
+import tempfile
+from functools import lru_cache, partial
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+from packages.fasta_midi_converter import AAToMidiCSV, NoteTable, TABLE_FORMATS, format_missing
+from packages.map_pitch import find_orfs, shift_orf_pitch
+from packages.detect_motifs import generate_motif_hits, read_motif_table
+from packages.calculate_gc import calculate_gc_per_residue, gc_to_velocity
+from packages.farruhs_packages import farruhs_packages, repeat_instruments
+from packages.detect_repeats import TandemRepeats, find_context_repeats, find_tandem_repeats, MAX_PERIOD, MIN_COPIES
+from packages.translate_file import FRAMES, translate_file
+from packages.sequence_context import SequenceContext, file_hash
+from packages.get_tempo import TempoMap, tempo_map_inator, MULTIPLIER, GLOBAL_MULTIPLIER
+from packages.map_duration import map_notes_to_durations, compute_timeline
+from packages.midi_writer import PERCUSSION_CHANNEL, MidiTrackWriter, write_note_table, write_note_tables
+from packages.audio_renderer import SAMPLE_RATE, MIN_SAMPLE_RATE, MAX_SAMPLE_RATE, WavRenderer, write_note_table_wav
+from packages.musicplots import plot_music_data_async
+from packages.batch import run_batch
+from packages.pipeline import Pipeline, StageProfiler, CProfileHook
+from packages.stage_cache import StageCache, code_version, make_key
+from packages.streaming import DEFAULT_CHUNK_RESIDUES, MidiPortSink, MidiTextSink, stream_render
+from packages import parallel
+from packages.sweep import run_sweep, sweep_grid
 
 '''
 Welcome to the Musicinator! This program converts a protein FASTA file into a MIDI file.
@@ -21,118 +37,717 @@ It uses the following packages:
 - calculate_gc: Calculates the GC content of the sequence and maps it to MIDI velocity.
 - farruhs_packages: Applies additional transformations to the MIDI data.
 - translate_file: Translates the FASTA file into an amino acid sequence.
+- detect_repeats: Finds tandem repeats of any period for the tempo and the instruments.
 - map_duration: Maps the duration of the notes based on the amino acid sequence.
-- mido: A library for working with MIDI files.
+- midi_writer: Writes the MIDI file directly from the note table.
+- audio_renderer: Renders the note table to a WAV file with wavetables and envelopes.
+- batch: Renders many FASTA files or records in parallel.
+- pipeline: Runs the conversion as named stages and profiles them.
+- streaming: Streams the notes chunk by chunk into a growing MIDI file, stdout or a MIDI port.
+- stage_cache: Caches the outputs of the stages on disk, so changing one parameter only reruns the affected stages.
+- parallel: Splits one big sequence into chunks that are scanned on several processes from shared memory.
+- server: Keeps warm worker processes and renders FASTA text sent over HTTP or a Unix socket.
+- sweep: Renders a grid of parameter variants of one sequence from shared intermediates.
 - argparse: A library for parsing command line arguments.
-- pandas: A library for data manipulation and analysis.
 - numpy: A library for numerical computations.
 - os: A library for interacting with the operating system.
+Loaded only when they are needed, so -h and npz runs start without them:
+- pandas: Reads and writes the CSV/parquet note tables (parquet also needs pyarrow).
+- matplotlib: Draws the plots, skipped with --no-plots.
+- Biopython: Translates sequences with letters that are not nucleotide codes.
 
 '''
-def main():
+
+#MIDI resolution, a Duration of 1.0 in the table is TICKS_PER_BEAT / 4 ticks
+TICKS_PER_BEAT = 480
+
+def int_in_range(low, high=None):
+    # Returns an argparse type for whole numbers from low to high (no upper limit when high is None)
+    def parse(text):
+        try:
+            value = int(text)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid int value: {text!r}")
+        if value < low or (high is not None and value > high):
+            limit = f"from {low} to {high}" if high is not None else f"at least {low}"
+            raise argparse.ArgumentTypeError(f"must be {limit}, got {value}")
+        return value
+    return parse
+
+#counts and sizes that must be at least 1, and counts where 0 means all CPUs
+positive_int = int_in_range(1)
+non_negative_int = int_in_range(0)
+
+def check_format(parser, output_format, option="--format"):
+    # Stops before any stage runs when the table format needs a package that is not installed
+    missing = format_missing(output_format)
+    if missing:
+        parser.error(f"{option} {output_format}: {missing}")
+
+def add_music_options(parser):
+    # Options that change the music, shared by every command
+    parser.add_argument("--motif-table", help="CSV/TSV file of motif,drum_note pairs to use instead of the built-in motifs")
+    parser.add_argument("--reverse-complement", action="store_true", help="Also scan the reverse strand for motifs")
+    parser.add_argument("--gc-window", type=positive_int, default=12, help="Number of bases in each GC content window")
+    parser.add_argument("--gc-sliding", action="store_true", help="Use a sliding GC window centred on each codon instead of tiles")
+    parser.add_argument("--min-orf-length", type=int, default=0, help="Ignore ORFs shorter than this many residues")
+    parser.add_argument("--orf-policy", choices=["outermost", "nested"], default="outermost",
+                        help="Keep only the first start before each stop (outermost) or every start (nested)")
+    return parser
+
+def parse_frames(text):
+    # Turns "all" or a comma separated list like "+1,-1" into a list of reading frames
+    if text == "all":
+        return list(FRAMES)
+    frames = []
+    for frame in text.split(","):
+        frame = frame.strip()
+        frame = frame if frame[:1] in "+-" else f"+{frame}"
+        if frame not in FRAMES:
+            raise argparse.ArgumentTypeError(f"unknown reading frame {frame}, use {', '.join(FRAMES)} or all")
+        if frame not in frames:
+            frames.append(frame)
+    return frames
+
+def parse_tempo_pair(text):
+    # Turns "1.15:1.05" into the (multiplier, global multiplier) pair of tempo_inator
+    try:
+        multiplier, global_multiplier = (float(value) for value in text.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"tempo pair {text} must look like MULTIPLIER:GLOBAL_MULTIPLIER, e.g. 1.15:1.05")
+    return multiplier, global_multiplier
+
+def add_render_options(parser):
+    # Options shared by the single-file command and the batch command
+    add_music_options(parser)
+    parser.add_argument("--tandem-repeats", nargs="?", const="residues", choices=["residues", "bases"],
+                        help="Speed the tempo up with every copy of a tandem repeat and give its notes the instrument "
+                             "of its period, with repeats found in the residues (default) or the bases")
+    parser.add_argument("--repeat-max-period", type=int, default=MAX_PERIOD, help="Longest repeat unit for --tandem-repeats")
+    parser.add_argument("--repeat-min-copies", type=int, default=MIN_COPIES, help="Fewest copies of a unit for --tandem-repeats")
+    parser.add_argument("--frames", type=parse_frames,
+                        help="Reading frames to render, each as its own MIDI track and channel, e.g. +1,-1 or all "
+                             "for the six frames of both strands (default: only +1, as a single track)")
+    parser.add_argument("--tempo-map-only", action="store_true",
+                        help="Keep the tempo as change points instead of a per-note Tempo column")
+    parser.add_argument("--velocity-scale", type=float, default=1.27, help="Factor from GC percent to velocity (default 1.27)")
+    parser.add_argument("--tempo", type=parse_tempo_pair, default=(MULTIPLIER, GLOBAL_MULTIPLIER),
+                        metavar="MULTIPLIER:GLOBAL_MULTIPLIER",
+                        help="Tempo factor of every repeated residue and of every stop codon (default 1.15:1.05)")
+    parser.add_argument("--format", choices=TABLE_FORMATS, default="csv",
+                        help="Format of the note table: csv, or the binary npz/parquet (parquet needs pyarrow)")
+    parser.add_argument("--write-standardized", action="store_true",
+                        help="Also write the intermediate standardized table")
+    parser.add_argument("--no-plots", action="store_true", help="Skip the plots")
+    parser.add_argument("--wav", nargs="?", const="final_output_music.wav",
+                        help="Also render the music to a WAV file (final_output_music.wav, or <name>.wav in batch mode)")
+    parser.add_argument("--sample-rate", type=int_in_range(MIN_SAMPLE_RATE, MAX_SAMPLE_RATE), default=SAMPLE_RATE,
+                        help="Sample rate of the WAV file")
+    parser.add_argument("--sequence-cache", help="Directory for parsed FASTA files, repeated runs on the same file skip parsing")
+    parser.add_argument("--stage-cache", help="Directory for the outputs of the stages (translation, GC, motifs, ORFs, tempo, "
+                                              "note table), re-renders only recompute the stages whose inputs changed")
+    parser.add_argument("--stage-cache-size", type=float, default=2048, help="Size limit of the stage cache in MB (default 2048)")
+    parser.add_argument("--workers", type=non_negative_int, default=1,
+                        help="Scan one sequence on this many processes, chunk by chunk (default 1, 0 for all CPUs)")
+    parser.add_argument("--chunk-residues", type=positive_int, default=parallel.DEFAULT_CHUNK_RESIDUES,
+                        help="Residues per chunk with --workers")
+    parser.add_argument("--verbose", action="store_true", help="Print every motif hit for debugging")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time every stage and trace its peak memory, print a summary and write a JSON report")
+    parser.add_argument("--profile-report", default="profile_report.json", help="Where --profile writes the JSON report")
+    parser.add_argument("--profile-stage", choices=STAGE_NAMES + PARALLEL_ONLY_STAGES, help="Run cProfile around one stage and write <stage>.prof")
+    return parser
+
+def main(argv=None):
     # Parse command line arguments
-    # The input file is the FASTA file containing the protein sequence.
-    parser = argparse.ArgumentParser(description="Convert a protein FASTA to music")
+    # "batch" as the first argument renders many files at once, see run_batch_command.
+    # Otherwise the input file is the FASTA file containing the sequence.
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "batch":
+        return run_batch_command(argv[1:])
+    if argv and argv[0] == "stream":
+        return run_stream_command(argv[1:])
+    if argv and argv[0] == "serve":
+        return run_serve_command(argv[1:])
+    if argv and argv[0] == "sweep":
+        return run_sweep_command(argv[1:])
+    parser = argparse.ArgumentParser(description="Convert a protein FASTA to music",
+                                     epilog="Use 'musicinator.py batch -h' to render many files in parallel, "
+                                            "'musicinator.py stream -h' to stream the notes while they are made, "
+                                            "'musicinator.py serve -h' to render FASTA sent over HTTP, "
+                                            "'musicinator.py sweep -h' to render a grid of parameter variants.")
     parser.add_argument("input_file", help="Input FASTA file")
-    args = parser.parse_args()
-    input_file = args.input_file
+    add_render_options(parser)
+    args = parser.parse_args(argv)
+    check_format(parser, args.format)
+    render(args.input_file, args)
+
+def run_batch_command(argv):
+    # Renders a list of FASTA files, directories of FASTA files, or every record of a multi-record FASTA
+    # on a process pool. Each input writes <name>.csv, <name>.mid and <name>_plots/ to the output directory.
+    parser = argparse.ArgumentParser(prog="musicinator.py batch", description="Convert many FASTA files to music in parallel")
+    parser.add_argument("inputs", nargs="+", help="FASTA files or directories of FASTA files")
+    parser.add_argument("--output-dir", default="batch_output", help="Directory for the per-input outputs")
+    parser.add_argument("--jobs", type=positive_int, default=None, help="Number of worker processes (default: all CPUs)")
+    parser.add_argument("--split-records", action="store_true", help="Render every record of a multi-record FASTA as its own song")
+    add_render_options(parser)
+    args = parser.parse_args(argv)
+    check_format(parser, args.format)
+    results = run_batch(args.inputs, render_batch_item, args, args.output_dir, args.jobs,
+                        args.split_records, args.sequence_cache)
+    return 1 if any(not result.ok for result in results) else 0
+
+STREAM_UNSUPPORTED = ["--tandem-repeats", "--frames", "--tempo-map-only"]
+
+def run_stream_command(argv):
+    # Streams the notes of one FASTA file chunk by chunk, the first notes come out before the file is read to the end.
+    # The notes go to a .mid file that grows while it is written, to stdout as text (--output -), or to a MIDI port.
+    parser = argparse.ArgumentParser(prog="musicinator.py stream", description="Stream the music of a FASTA file while it is made")
+    parser.add_argument("input_file", help="Input FASTA file")
+    parser.add_argument("--output", default="final_output_music.mid",
+                        help="MIDI file to write (a .wav file renders audio instead), or - to print the MIDI messages to stdout")
+    parser.add_argument("--port", nargs="?", const="", default=None,
+                        help="Play on a MIDI output port instead (the default port when no name is given, needs mido)")
+    parser.add_argument("--chunk-residues", type=positive_int, default=DEFAULT_CHUNK_RESIDUES,
+                        help="Residues handled per chunk, smaller chunks give the first notes sooner")
+    parser.add_argument("--sample-rate", type=int_in_range(MIN_SAMPLE_RATE, MAX_SAMPLE_RATE), default=SAMPLE_RATE,
+                        help="Sample rate of a .wav output")
+    add_music_options(parser)
+    #Render options the stream can not follow: the repeats and frames are found on the whole sequence first,
+    #and the stream writes no note table for a tempo map
+    for option in STREAM_UNSUPPORTED:
+        parser.add_argument(option, nargs="?", const=True, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unsupported = [option for option in STREAM_UNSUPPORTED if getattr(args, option[2:].replace("-", "_")) is not None]
+    if unsupported:
+        parser.error(f"{', '.join(unsupported)} can not be streamed, use the render command (musicinator.py FILE) instead")
+    if args.port is not None:
+        sink = MidiPortSink(args.port or None, TICKS_PER_BEAT)
+    elif args.output == "-":
+        sink = MidiTextSink(sys.stdout, TICKS_PER_BEAT)
+    elif args.output.lower().endswith(".wav"):
+        sink = WavRenderer(args.output, TICKS_PER_BEAT, args.sample_rate)
+    else:
+        sink = MidiTrackWriter(args.output, TICKS_PER_BEAT)
+    motif_table = read_motif_table(args.motif_table) if args.motif_table else None
+    count = stream_render(args.input_file, sink, chunk_residues=args.chunk_residues, motif_table=motif_table,
+                          reverse_complement=args.reverse_complement, window_size=args.gc_window,
+                          sliding=args.gc_sliding, min_orf_length=args.min_orf_length, orf_policy=args.orf_policy)
+    if args.port is None and args.output != "-":
+        print(f"Created {args.output} ({count} notes)")
+    return 0
+
+#Query options a serve request may set, they are the render options of the same name (flags take no value or 1/0)
+SERVE_OPTIONS = ["reverse-complement", "gc-window", "gc-sliding", "min-orf-length", "orf-policy", "tandem-repeats",
+                 "repeat-max-period", "repeat-min-copies", "frames", "tempo-map-only", "velocity-scale", "tempo",
+                 "sample-rate"]
+SERVE_FLAGS = ["reverse-complement", "gc-sliding", "tempo-map-only"]
+#Smallest and largest value (None for no limit) of the numeric options of a serve request, so one request can not
+#crash a worker or keep it busy for long: a window of 0 bases, a huge repeat period or sample rate
+SERVE_LIMITS = {"gc_window": (1, 1 << 16), "min_orf_length": (0, None), "repeat_max_period": (1, 1000),
+                "repeat_min_copies": (2, None), "sample_rate": (MIN_SAMPLE_RATE, MAX_SAMPLE_RATE),
+                "velocity_scale": (0, 100)}
+#What a serve request can ask for with output=..., and the Content-Type it is sent with
+SERVE_OUTPUTS = {"midi": "audio/midi", "csv": "text/csv", "npz": "application/octet-stream",
+                 "parquet": "application/vnd.apache.parquet", "wav": "audio/wav"}
+#A short sequence with a motif, a repeat run and an ORF, rendered once by every server worker when it starts
+WARM_UP_FASTA = b">warm-up\nATGGCCATTGTAATGGGCCGCTGAAAGGGTGCCCGATAGCAGCAGCAGCAGTTTTTTTATAAAAGGCGGCTAG\n"
+
+class RequestParser(argparse.ArgumentParser):
+    # Parses the options of a serve request, a bad option is a ValueError (400) instead of exiting the worker
+    def error(self, message):
+        raise ValueError(message)
+
+@lru_cache(maxsize=None)
+def request_parser():
+    parser = RequestParser(prog="serve request", add_help=False)
+    add_render_options(parser)
+    return parser
+
+def run_serve_command(argv):
+    # Keeps a pool of warm worker processes and renders the FASTA text of every POST /render request,
+    # see packages/server.py. The options of a render go in the query string, e.g.
+    #   curl --data-binary @gene.fa "http://127.0.0.1:8765/render?output=csv&gc-window=24" -o gene.csv
+    #The server (and asyncio) is only imported by the commands that use it, to keep the start of the others fast
+    from packages import server
+    parser = argparse.ArgumentParser(prog="musicinator.py serve", description="Render FASTA sent over HTTP with warm workers")
+    parser.add_argument("--host", default=server.DEFAULT_HOST, help="Address to listen on (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=server.DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--unix", help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: all CPUs)")
+    parser.add_argument("--queue-size", type=int, default=server.DEFAULT_QUEUE_SIZE,
+                        help="Requests that may wait for a worker, more are answered with 503")
+    parser.add_argument("--max-body", type=float, default=server.DEFAULT_MAX_BODY / 2**20,
+                        help="Largest FASTA body accepted, in MB")
+    parser.add_argument("--motif-table", help="CSV/TSV file of motif,drum_note pairs used for every request")
+    parser.add_argument("--stage-cache", help="Directory for the outputs of the stages, shared by all requests")
+    parser.add_argument("--stage-cache-size", type=float, default=2048, help="Size limit of the stage cache in MB (default 2048)")
+    args = parser.parse_args(argv)
+    settings = {"motif_table": args.motif_table, "stage_cache": args.stage_cache, "stage_cache_size": args.stage_cache_size}
+    address = args.unix or f"http://{args.host}:{args.port}"
+    server.serve(partial(render_request, settings), args.host, args.port, args.unix, args.workers, args.queue_size,
+                 int(args.max_body * 2**20), warm=partial(warm_worker, settings),
+                 ready=lambda listening: print(f"Serving on {address}, POST /render with a FASTA body", flush=True))
+    return 0
+
+def render_request(settings, body, query):
+    # Runs in a server worker: renders the FASTA text of one request and returns the path of the output file.
+    # settings are the serve options that hold for every request, query the query string of the request.
+    argv, output = [], "midi"
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        if key == "output":
+            output = value
+        elif key not in SERVE_OPTIONS:
+            raise ValueError(f"unknown option {key}, use output or one of {', '.join(SERVE_OPTIONS)}")
+        elif key in SERVE_FLAGS:
+            if value.lower() not in ("0", "false", "no"):
+                argv.append(f"--{key}")
+        else:
+            argv.append(f"--{key}={value}" if value else f"--{key}")
+    if output not in SERVE_OUTPUTS:
+        raise ValueError(f"unknown output {output}, use one of {', '.join(SERVE_OUTPUTS)}")
+    if format_missing(output):
+        raise ValueError(format_missing(output))
+    args = request_parser().parse_args(argv + ["--no-plots"])
+    for name, (low, high) in SERVE_LIMITS.items():
+        value = getattr(args, name)
+        if value < low or (high is not None and value > high) or value != value:
+            limit = f"from {low} to {high}" if high is not None else f"at least {low}"
+            raise ValueError(f"{name.replace('_', '-')} must be {limit}, got {value}")
+    if not all(0 < factor <= 100 for factor in args.tempo):
+        raise ValueError(f"the tempo factors must be above 0 and at most 100, got {args.tempo[0]}:{args.tempo[1]}")
+    if args.frames and output != "midi":
+        raise ValueError("frames are rendered as MIDI tracks, use output=midi")
+    args.motif_table, args.stage_cache, args.stage_cache_size = (settings["motif_table"], settings["stage_cache"],
+                                                                 settings["stage_cache_size"])
+    context = SequenceContext.from_bytes(body)
+    with tempfile.TemporaryDirectory(prefix="musicinator-") as directory, contextlib.redirect_stdout(io.StringIO()):
+        if output in TABLE_FORMATS:
+            args.format = output
+        outputs = {"midi": os.path.join(directory, "song.mid"), "wav": os.path.join(directory, "song.wav")}
+        table_out = os.path.join(directory, f"song.{args.format}")
+        if output == "wav":
+            args.wav = outputs["wav"]
+        try:
+            render(context, args, table_out=table_out, midi_out=outputs["midi"] if output == "midi" else None,
+                   plot_dir=directory, profile_out=os.devnull, cprofile_out=os.devnull)
+        except Exception as error:
+            #Letters that are not nucleotide codes make Biopython raise, that is a bad FASTA (400), not a server error
+            from Bio.Data.CodonTable import TranslationError
+            if isinstance(error, TranslationError):
+                raise ValueError(f"the sequence can not be translated: {error}") from None
+            raise
+        #The output outlives the directory of the render, the server sends it and removes it
+        handle, path = tempfile.mkstemp(prefix="musicinator-", suffix=os.path.splitext(outputs.get(output, table_out))[1])
+        os.close(handle)
+        os.replace(outputs.get(output, table_out), path)
+    from packages import server
+    return server.Rendered(SERVE_OUTPUTS[output], path)
+
+def warm_worker(settings):
+    # Runs once in every server worker before its first request: fills the lookup tables and caches
+    # (codon table, motif scanner, wavetables) so the first real request is as fast as the others
+    for output in ("midi", "wav"):
+        os.unlink(render_request(settings, WARM_UP_FASTA, f"output={output}&tandem-repeats").path)
+
+def run_sweep_command(argv):
+    # Renders every combination of the given GC windows, velocity scales, tempo multipliers and motif tables
+    # for one FASTA file, one <variant>.mid per combination plus sweep.csv listing the parameters of each.
+    # Translation, ORFs, durations and the timeline are computed once for all variants, see packages/sweep.py.
+    parser = argparse.ArgumentParser(prog="musicinator.py sweep", conflict_handler="resolve",
+                                     description="Render many parameter variants of one FASTA file")
+    parser.add_argument("input_file", help="Input FASTA file")
+    add_music_options(parser)
+    parser.add_argument("--gc-window", type=positive_int, nargs="+", default=[12], help="GC window sizes to sweep")
+    parser.add_argument("--velocity-scale", type=float, nargs="+", default=[1.27],
+                        help="Factors from GC percent to velocity to sweep")
+    parser.add_argument("--tempo", type=parse_tempo_pair, nargs="+", default=[(MULTIPLIER, GLOBAL_MULTIPLIER)],
+                        help="Tempo MULTIPLIER:GLOBAL_MULTIPLIER pairs to sweep (default 1.15:1.05)")
+    parser.add_argument("--motif-table", nargs="+", default=["builtin"],
+                        help="Motif tables to sweep, 'builtin' for the built-in motifs")
+    parser.add_argument("--tandem-repeats", nargs="?", const="residues", choices=["residues", "bases"],
+                        help="Follow tandem repeats in every variant, found in the residues (default) or the bases")
+    parser.add_argument("--repeat-max-period", type=int, default=MAX_PERIOD, help="Longest repeat unit for --tandem-repeats")
+    parser.add_argument("--repeat-min-copies", type=int, default=MIN_COPIES, help="Fewest copies of a unit for --tandem-repeats")
+    parser.add_argument("--tempo-map-only", action="store_true",
+                        help="Keep the tempo as change points instead of a per-note Tempo column")
+    parser.add_argument("--write-tables", choices=TABLE_FORMATS, help="Also write the note table of every variant in this format")
+    parser.add_argument("--output-dir", default="sweep_output", help="Directory for the variants")
+    parser.add_argument("--jobs", type=positive_int, default=None, help="Number of worker processes writing the variants (default: all CPUs)")
+    parser.add_argument("--sequence-cache", help="Directory for parsed FASTA files, repeated runs on the same file skip parsing")
+    args = parser.parse_args(argv)
+    check_format(parser, args.write_tables, "--write-tables")
+    context = SequenceContext.from_fasta(args.input_file, cache_dir=args.sequence_cache)
+    motif_tables = [None if path == "builtin" else path for path in args.motif_table]
+    variants = sweep_grid(args.gc_window, args.velocity_scale, args.tempo, motif_tables)
+    #The translation is made once, for the repeats and for all the variants
+    aa = translate_file(context)
+    repeats = find_repeats(context, aa, args) if args.tandem_repeats else None
+    paths = run_sweep(context, variants, args.output_dir, args.jobs, args.write_tables, TICKS_PER_BEAT,
+                      sliding=args.gc_sliding, reverse_complement=args.reverse_complement,
+                      min_orf_length=args.min_orf_length, orf_policy=args.orf_policy, repeats=repeats,
+                      tempo_column=not args.tempo_map_only, aa=aa)
+    print(f"Created {len(paths)} variants in {args.output_dir} (parameters in {os.path.join(args.output_dir, 'sweep.csv')})")
+    return 0
+
+def render_batch_item(source, args, output_dir, name):
+    # Worker for the batch command, writes the outputs of one input under its own name
+    render(source, args,
+           table_out=os.path.join(output_dir, f"{name}.{args.format}"),
+           midi_out=os.path.join(output_dir, f"{name}.mid"),
+           standardized_out=os.path.join(output_dir, f"{name}_standardized.{args.format}"),
+           plot_dir=os.path.join(output_dir, f"{name}_plots"),
+           profile_out=os.path.join(output_dir, f"{name}_profile.json"),
+           cprofile_out=os.path.join(output_dir, f"{name}_{args.profile_stage}.prof"),
+           wav_out=os.path.join(output_dir, f"{name}.wav") if args.wav else None)
+
+def render_frames(source, args, table_out=None, midi_out="final_output_music.mid",
+                  standardized_out=None, plot_dir="example_file_and_output", profile_out=None, cprofile_out=None,
+                  wav_out=None):
+    # Renders every reading frame of --frames as its own voice. The sequence is parsed once, and each frame
+    # runs the whole conversion on its own view of it (shifted, or reverse complemented for -1/-2/-3).
+    # The table, plots, WAV and profile of a frame get a _frame<frame> suffix, and the MIDI file
+    # holds one track per frame. The tempo of the first frame drives the song.
+    if isinstance(source, SequenceContext):
+        context = source
+    else:
+        context = SequenceContext.from_fasta(source, cache_dir=args.sequence_cache)
+    wav_out = wav_out or args.wav
+    tracks = []
+    for voice, frame in enumerate(args.frames):
+        def suffix(path):
+            root, extension = os.path.splitext(path)
+            return f"{root}_frame{frame}{extension}"
+        state = render(context, args,
+                       table_out=suffix(table_out or f"final_output_music.{args.format}"), midi_out=None,
+                       standardized_out=suffix(standardized_out or f"standardized_output_music.{args.format}"),
+                       plot_dir=suffix(plot_dir), profile_out=suffix(profile_out or args.profile_report),
+                       cprofile_out=suffix(cprofile_out or f"{args.profile_stage}.prof"),
+                       wav_out=suffix(wav_out) if wav_out else None, frame=frame, voice=voice)
+        tracks.append((state.table, 2 * state.start_ticks, state.duration_ticks))
+    write_note_tables(midi_out, tracks, TICKS_PER_BEAT)
+    print(f"Created {midi_out} ({len(tracks)} tracks: {', '.join(args.frames)})")
+    return tracks
 
-    #uses the translate_file function to convert the FASTA file into an amino acid sequence.
-    aa_string = translate_file(input_file)
-    
-    #uses the AAToMidiCSV class to convert the amino acid sequence into a MIDI CSV format.
-    # The output is saved as a CSV file named "standardized_output_music.csv".
-    converter = AAToMidiCSV(aa_string, "standardized_output_music.csv")
-    df = converter.process()
+def render(source, args, table_out=None, midi_out="final_output_music.mid",
+           standardized_out=None, plot_dir="example_file_and_output", profile_out=None, cprofile_out=None,
+           wav_out=None, frame="+1", voice=None):
+    # Runs the whole conversion for one FASTA path (or an already parsed SequenceContext).
+    # The conversion is a list of named stages (RENDER_STAGES) run by a Pipeline on one shared state.
+    # With --profile every stage is timed and its peak memory is traced, the summary is printed
+    # and written as JSON to profile_out. --profile-stage runs cProfile around one stage.
+    # With --workers other than 1 the per-residue stages run chunk by chunk on a process pool instead (PARALLEL_STAGES).
+    # With --frames every frame is rendered on its own by render_frames, as voice number 'voice'.
+    if args.frames and voice is None:
+        return render_frames(source, args, table_out, midi_out, standardized_out, plot_dir, profile_out,
+                             cprofile_out, wav_out)
+    state = SimpleNamespace(frame=frame, voice=voice,
+        source=source, args=args,
+        table_out=table_out or f"final_output_music.{args.format}",
+        standardized_out=standardized_out or f"standardized_output_music.{args.format}",
+        midi_out=midi_out, wav_out=wav_out or args.wav, plot_dir=plot_dir, keys={}, cache=None)
+    if args.stage_cache:
+        state.cache = StageCache(args.stage_cache, int(args.stage_cache_size * 2**20))
 
-    #uses calculate_gc_content to calculate the GC content of the sequence.
-    # The GC content is then mapped to MIDI velocity using a scaling factor of 1.27.
-    # The window size for GC content calculation is set to 12.
-    gc_profile = calculate_gc_content(input_file, window_size=12)
-    df['Velocity'] = np.floor(np.array(gc_profile[:len(df)]) * 1.27 * 100) / 100
+    hooks = []
+    profiler = None
+    if args.profile:
+        profiler = StageProfiler()
+        hooks.append(profiler)
+    if args.profile_stage:
+        hooks.append(CProfileHook(args.profile_stage, cprofile_out))
 
+    pipeline = Pipeline(hooks)
+    #--verbose prints the motif hits in order, so it always runs the serial stages
+    stages = PARALLEL_STAGES if args.workers != 1 and not args.verbose else RENDER_STAGES
+    for name, stage in stages:
+        pipeline.add(name, stage)
+    try:
+        pipeline.run(state)
+    finally:
+        if profiler is not None:
+            profiler.close()
 
+    if state.cache is not None:
+        print(f"Stage cache: reused {', '.join(state.cache.hits) or 'nothing'}, "
+              f"computed {', '.join(state.cache.misses) or 'nothing'}")
+    if profiler is not None:
+        profile_out = profile_out or args.profile_report
+        profiler.write_json(profile_out)
+        print(profiler.summary())
+        print(f"Created {profile_out}")
+    return state
+
+def cached_stage(state, stage, compute, **parts):
+    # Returns the dict of arrays made by compute(), loaded from the stage cache when --stage-cache is used.
+    # The key is a hash of the parts: the input digest, the parameters, the keys of the stages it builds on
+    # and the code version of the package, so only the stages whose parts changed are computed again.
+    key = make_key(stage, **parts)
+    state.keys[stage] = key
+    if state.cache is None:
+        return compute()
+    return state.cache.fetch(stage, key, compute)
+
+#The stages of render. Each one reads and sets attributes of the shared state and returns the number of items it handled.
+
+def stage_parse(state):
+    #uses the SequenceContext class to parse the FASTA file once, all packages below read from it.
+    #With --sequence-cache the parsed file is stored by content hash and loaded memory-mapped next time.
+    if isinstance(state.source, SequenceContext):
+        state.context = state.source
+    else:
+        state.context = SequenceContext.from_fasta(state.source, cache_dir=state.args.sequence_cache)
+    #Other reading frames are read from a shifted or reverse complemented copy of the sequence
+    state.context = state.context.frame(state.frame)
+    state.input_digest = state.context.content_digest() if state.cache is not None else None
+    return state.context.total_length
+
+def stage_translate(state):
+    #uses the translate_file function to convert the sequences into an amino acid sequence.
+    arrays = cached_stage(state, "translate",
+                          lambda: {"aa": np.frombuffer(translate_file(state.context).encode("ascii"), dtype=np.uint8)},
+                          input=state.input_digest, version=code_version(translate_file, SequenceContext))
+    state.aa_string = np.asarray(arrays["aa"]).tobytes().decode("ascii")
+    return len(state.aa_string)
+
+def stage_repeats(state):
+    #with --tandem-repeats the detect_repeats package finds the tandem repeats in the residues (period 2 and more,
+    #period 1 is already followed by the tempo) or in the bases (microsatellites, placed on the codons they cover).
+    #The tempo and motifs stages then speed up every copy of a repeat and give its notes the instrument of its period.
+    args = state.args
+    state.repeats = None
+    if not args.tandem_repeats:
+        return
+    def compute():
+        repeats = find_repeats(state.context, state.aa_string, args)
+        return {"starts": repeats.starts, "ends": repeats.ends, "periods": repeats.periods}
+    arrays = cached_stage(state, "repeats", compute, translate=state.keys["translate"], source=args.tandem_repeats,
+                          max_period=args.repeat_max_period, min_copies=args.repeat_min_copies,
+                          version=code_version(find_tandem_repeats, SequenceContext))
+    state.repeats = TandemRepeats(arrays["starts"], arrays["ends"], arrays["periods"])
+    return len(state.repeats)
+
+def find_repeats(context, aa_string, args):
+    # Finds the tandem repeats of --tandem-repeats in the residues or in the bases, as residue positions
+    if args.tandem_repeats == "bases":
+        return find_context_repeats(context, max_period=args.repeat_max_period,
+                                    min_copies=args.repeat_min_copies).to_residues(context)
+    return find_tandem_repeats(aa_string, max_period=args.repeat_max_period, min_copies=args.repeat_min_copies)
+
+def stage_note_table(state):
+    #uses the AAToMidiCSV class to convert the amino acid sequence into a column-oriented NoteTable.
+    # With --write-standardized the standardized table is saved as "standardized_output_music.csv".
+    args = state.args
+    converter = AAToMidiCSV(state.aa_string, state.standardized_out)
+    arrays = cached_stage(state, "note_table", lambda: converter.process(save=False).to_arrays(),
+                          translate=state.keys["translate"], version=code_version(AAToMidiCSV))
+    state.table = NoteTable(arrays)
+    if args.write_standardized:
+        state.table.save(state.standardized_out, args.format)
+        print(f"{args.format.upper()} exported to {state.standardized_out}")
+    return len(state.table)
+
+def stage_gc(state):
+    #uses calculate_gc_per_residue to calculate the GC content around the codon of every amino acid.
+    # The GC content is then mapped to MIDI velocity using a scaling factor of 1.27 (--velocity-scale).
+    # The window size for GC content calculation is set to 12 by default.
+    args = state.args
+    arrays = cached_stage(state, "gc",
+                          lambda: {"gc_profile": calculate_gc_per_residue(state.context, window_size=args.gc_window,
+                                                                          sliding=args.gc_sliding)},
+                          input=state.input_digest, window_size=args.gc_window, sliding=args.gc_sliding,
+                          version=code_version(calculate_gc_per_residue, SequenceContext))
+    state.gc_profile = arrays["gc_profile"]
+    state.table['Velocity'] = gc_to_velocity(state.gc_profile, scale=state.args.velocity_scale)
+    return len(state.gc_profile)
+
+def stage_tempo(state):
     #uses farruhs_packages to calculate the number of repeats in the sequence.
     #the number of repeats is then mapped to MIDI tempo.
-    #With each repeat, the tempo is multiplied by a 1.15.
-    df = farruhs_packages(aa_string, df)
+    #With each repeat, the tempo is multiplied by a 1.15 (the first number of --tempo).
+    #With --tempo-map-only the tempo is kept as a map of change points instead of a column.
+    multiplier, global_multiplier = state.args.tempo
+    def compute():
+        tempomap = tempo_map_inator(state.aa_string, multiplier, global_multiplier)
+        return {"positions": tempomap.positions, "values": tempomap.values}
+    arrays = cached_stage(state, "tempo", compute, translate=state.keys["translate"], multiplier=multiplier,
+                          global_multiplier=global_multiplier, version=code_version(tempo_map_inator))
+    tempomap = TempoMap(arrays["positions"], arrays["values"], len(state.aa_string))
+    state.table = farruhs_packages(state.aa_string, state.table, tempo_column=not state.args.tempo_map_only,
+                                   tempomap=tempomap, repeats=state.repeats)
+    return len(tempomap)
 
+def stage_motifs(state):
     #uses the generate_motif_hits function to detect motifs in the amino acid sequence.
     #The motifs are then mapped to MIDI instrument and channel.
-    entire_length = len(df['Time'].to_list())
-    instrument_list, channel_list = generate_motif_hits(input_file, entire_length)
-    df['Instrument'] = instrument_list
-    df['Channel'] = channel_list
-
-    #uses the map_note_to_duration function to map the notes to their corresponding durations.
-    #The duration is then calculated based on the previous note's duration.
-    #The time is calculated as the cumulative sum of the durations.
-    #The time is then used to create a time column in the dataframe.
-    df["Duration"] = df["Note"].apply(map_note_to_duration)
-    df['Time'] = 0.0
-    for i in range(1, len(df)):
-        df.at[i,'Time'] = df.at[i - 1,'Time'] + df.at[i - 1,'Duration']
-
-    
-    #uses the map_note_to_pitch function to map the notes to their corresponding pitches.
-    #the pitch is then modified based on a present open reading frame (ORF).
-    #The ORF is detected using the map_pitch function.
-    #The ORF is then used to modify the pitch of the notes in the dataframe.
-    orfs = map_pitch(aa_string)
-    for start, end in orfs:
-        mask = (df.index >= start) & (df.index <= end) & (df['Note'] != 0)
-        df.loc[mask, 'Note'] -= 1
-
-    
-    #saves the final output as a CSV file named "final_output_music.csv".
-    print("Created final_output_music.csv")
-    df.to_csv("final_output_music.csv", index=False)
-    plot_music_data(df, gc_profile)
-
-    #uses the mido library to create a MIDI file from the dataframe.
-    midi_out = MidiFile()
-    track = MidiTrack()
-    midi_out.tracks.append(track)
-    
-    # Set the tempo and program change (instrument)
-    track.append(Message('program_change', program=0, time=0))
-
-    ticks_per_beat = midi_out.ticks_per_beat
-    tempo = 500000
-    time_multiplier = ticks_per_beat/(4) #is adjusted to 4 beats per measure
-
-    # Set the tempo in microseconds per beat
-    prev_time = 0
-    
-    # Loop through the dataframe and create MIDI messages
-    #for each note in the dataframe.
-    # The parameters for each note are set based on the values in the dataframe.
-    # The note is played for the specified duration and velocity.
-    # The time is calculated based on the previous note's time and the duration of the current note.
-    # The note is then turned off after the specified duration.
-    for _, row in df.iterrows():
-        note = int(row['Note'])
-        velocity = int(row.get('Velocity', 64))
-        start_time = float(row['Time'])
-        duration = float(row['Duration'])
-
-        #start_time is converted to ticks based on the time multiplier.
-        # The duration is also converted to ticks.
-        # The previous time is updated to the current start time.
-        start_ticks = int((start_time - prev_time) * time_multiplier)
-        duration_ticks = int(duration * time_multiplier)
-        prev_time = start_time
-
-        # Append the note on and note off messages to the track
-        # The note on message is sent with the specified note, velocity, and start time.
-        # The note off message is sent with the specified note and duration.
-        track.append(Message('note_on', note=note, velocity=velocity, time=start_ticks))
-        track.append(Message('note_off', note=note, velocity=0, time=duration_ticks))
-    print("Created final_output_music.mid")
-    # Save the MIDI file
-    # The MIDI file is saved as "final_output_music.mid".
-    midi_out.save("final_output_music.mid")
-    
+    args = state.args
+    #With --verbose every hit is printed, so the hits are always computed
+    def compute():
+        motif_table = read_motif_table(args.motif_table) if args.motif_table else None
+        instrument_list, channel_list = generate_motif_hits(state.context, len(state.table), motif_table,
+                                                            args.reverse_complement, args.verbose)
+        return {"instrument": instrument_list, "channel": channel_list}
+    if args.verbose:
+        arrays = compute()
+    else:
+        arrays = cached_stage(state, "motifs", compute, input=state.input_digest, length=len(state.table),
+                              motif_table=file_hash(args.motif_table) if args.motif_table else None,
+                              reverse_complement=args.reverse_complement,
+                              version=code_version(generate_motif_hits, SequenceContext))
+    state.table['Instrument'] = arrays["instrument"]
+    state.table['Channel'] = arrays["channel"]
+    if state.repeats is not None:
+        repeat_instruments(state.table, state.repeats)
+    return int(np.count_nonzero(arrays["channel"] == 9))
+
+def stage_duration(state):
+    #uses the map_notes_to_durations function to map all notes to their durations with one lookup.
+    #The time is the cumulative sum of the durations of the previous notes.
+    #The durations are quantized to MIDI ticks in the same step, for the MIDI file.
+    state.table['Duration'] = map_notes_to_durations(state.table['Note'])
+    time, state.start_ticks, state.duration_ticks = compute_timeline(state.table['Duration'], TICKS_PER_BEAT / 4)
+    state.table['Time'] = time
+    return len(time)
+
+def stage_orf(state):
+    #the pitch is modified based on a present open reading frame (ORF).
+    #The ORFs are detected using the find_orfs function, which returns start and end arrays.
+    #Every note inside an ORF is lowered by one in a single pass over the table.
+    args = state.args
+    arrays = cached_stage(state, "orf",
+                          lambda: dict(zip(("starts", "ends"), find_orfs(state.aa_string, args.min_orf_length, args.orf_policy))),
+                          translate=state.keys["translate"], min_length=args.min_orf_length, policy=args.orf_policy,
+                          version=code_version(find_orfs))
+    state.table['Note'] = shift_orf_pitch(state.table['Note'], arrays["starts"], arrays["ends"],
+                                          stack=args.orf_policy == "nested")
+    return len(arrays["starts"])
+
+def stage_scan(state):
+    #uses scan_parallel to translate the sequence and compute the GC content, tempo, motifs and durations
+    #chunk by chunk on --workers processes. The chunks are stitched in order, so the result is the same as the serial stages.
+    args = state.args
+    state.keys["translate"] = make_key("translate", input=state.input_digest,
+                                       version=code_version(translate_file, SequenceContext))
+    def compute():
+        motif_table = read_motif_table(args.motif_table) if args.motif_table else None
+        scan = parallel.scan_parallel(state.context, args.workers or None, args.chunk_residues, args.gc_window,
+                                      args.gc_sliding, motif_table, args.reverse_complement, TICKS_PER_BEAT / 4,
+                                      *args.tempo)
+        arrays = {name: getattr(scan, name) for name in ("gc", "instrument", "channel", "time", "duration",
+                                                          "start_ticks", "duration_ticks")}
+        arrays.update(aa=np.frombuffer(scan.aa.encode("ascii"), dtype=np.uint8),
+                      tempo_positions=scan.tempo.positions, tempo_values=scan.tempo.values)
+        return arrays
+    state.scan = cached_stage(state, "scan", compute, input=state.input_digest, window_size=args.gc_window,
+                              sliding=args.gc_sliding, motif_table=file_hash(args.motif_table) if args.motif_table else None,
+                              reverse_complement=args.reverse_complement, multiplier=args.tempo[0],
+                              global_multiplier=args.tempo[1], version=code_version(parallel, SequenceContext))
+    state.aa_string = np.asarray(state.scan["aa"]).tobytes().decode("ascii")
+    return len(state.aa_string)
+
+def stage_apply_scan(state):
+    #copies the results of the parallel scan into the note table: velocity, tempo, instrument, channel, duration and time.
+    scan = state.scan
+    state.gc_profile = scan["gc"]
+    state.table['Velocity'] = gc_to_velocity(state.gc_profile, scale=state.args.velocity_scale)
+    tempomap = TempoMap(scan["tempo_positions"], scan["tempo_values"], len(state.aa_string))
+    state.table = farruhs_packages(state.aa_string, state.table, tempo_column=not state.args.tempo_map_only,
+                                   tempomap=tempomap, repeats=state.repeats)
+    state.table['Instrument'] = scan["instrument"]
+    state.table['Channel'] = scan["channel"]
+    if state.repeats is not None:
+        repeat_instruments(state.table, state.repeats)
+    state.table['Duration'] = scan["duration"]
+    state.table['Time'] = scan["time"]
+    state.start_ticks = np.asarray(scan["start_ticks"])
+    state.duration_ticks = np.asarray(scan["duration_ticks"])
+    return len(state.table)
+
+def stage_voice(state):
+    #with --frames every frame is its own voice: the Track column holds its number,
+    #and its notes move to the channel of the same number (drum hits stay on the percussion channel).
+    if state.voice is None:
+        return
+    channels = state.table['Channel']
+    state.table['Track'] = state.voice
+    state.table['Channel'] = np.where(channels == PERCUSSION_CHANNEL, channels, state.voice)
+    return len(state.table)
+
+def stage_plots(state):
+    #starts the plots in a separate process, they render while the CSV and MIDI files are written.
+    #With --no-plots this stage is skipped entirely.
+    state.plots = None
+    if not state.args.no_plots:
+        state.plots = plot_music_data_async(state.table, state.gc_profile, output_dir=state.plot_dir)
+
+def stage_table_output(state):
+    #saves the final output as a CSV file named "final_output_music.csv",
+    #or with --format npz/parquet as a binary table of the typed columns (read it back with read_note_table).
+    state.table.save(state.table_out, state.args.format)
+    print(f"Created {state.table_out}")
+    return len(state.table)
+
+def stage_midi(state):
+    #uses the write_note_table function to encode the MIDI file straight from the table columns.
+    #Tempo, Channel and Instrument are written as set_tempo and program_change events.
+    #Each note is followed by a rest as long as the note itself, the spacing the MIDI export has always used.
+    #With --frames the tracks of all frames are written together by render_frames instead.
+    if state.midi_out is None:
+        return
+    write_note_table(state.midi_out, state.table, 2 * state.start_ticks, state.duration_ticks, TICKS_PER_BEAT)
+    print(f"Created {state.midi_out}")
+    return len(state.table)
+
+def stage_audio(state):
+    #with --wav the music is also rendered to a WAV file, from the same ticks and tempo as the MIDI file.
+    if state.wav_out:
+        write_note_table_wav(state.wav_out, state.table, 2 * state.start_ticks, state.duration_ticks,
+                             TICKS_PER_BEAT, state.args.sample_rate)
+        print(f"Created {state.wav_out}")
+        return len(state.table)
+
+def stage_plots_wait(state):
+    #waits for the plots, so errors in them are not lost
+    if state.plots is not None:
+        state.plots.result()
+        print(f"Created plots in {state.plot_dir}")
+
+RENDER_STAGES = [
+    ("parse", stage_parse),
+    ("translate", stage_translate),
+    ("repeats", stage_repeats),
+    ("note_table", stage_note_table),
+    ("gc", stage_gc),
+    ("tempo", stage_tempo),
+    ("motifs", stage_motifs),
+    ("duration", stage_duration),
+    ("orf", stage_orf),
+    ("voice", stage_voice),
+    ("plots", stage_plots),
+    ("table_output", stage_table_output),
+    ("midi", stage_midi),
+    ("audio", stage_audio),
+    ("plots_wait", stage_plots_wait),
+]
+STAGE_NAMES = [name for name, stage in RENDER_STAGES]
+
+#The stages of render with --workers: scan replaces translate, gc, tempo, motifs and duration
+PARALLEL_STAGES = [
+    ("parse", stage_parse),
+    ("scan", stage_scan),
+    ("repeats", stage_repeats),
+    ("note_table", stage_note_table),
+    ("apply_scan", stage_apply_scan),
+    ("orf", stage_orf),
+    ("voice", stage_voice),
+    ("plots", stage_plots),
+    ("table_output", stage_table_output),
+    ("midi", stage_midi),
+    ("audio", stage_audio),
+    ("plots_wait", stage_plots_wait),
+]
+PARALLEL_ONLY_STAGES = ["scan", "apply_scan"]
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
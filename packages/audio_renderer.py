@@ -0,0 +1,316 @@
+import wave
+from functools import lru_cache
+
+import numpy as np
+
+from packages.get_tempo import tempo_block
+from packages.midi_writer import PERCUSSION_CHANNEL, table_tempos
+
+'''
+Renders notes straight to a WAV file, without a synthesizer or a GPU.
+Every General MIDI program gets one shared wavetable (a single cycle built from harmonics that
+depend on the instrument family) and an ADSR envelope, and every drum key on the percussion channel
+gets a one-shot sample synthesized from noise and tones. The notes are timed with the same ticks and
+tempo (set_tempo rounding included) as the MIDI export, so the audio lines up with the .mid file.
+The samples are computed with NumPy one block at a time: all notes that sound in a block are
+flattened into one array of (note, sample) pairs, looked up in the wavetables, shaped by their
+envelopes and summed with bincount. Finished blocks are written to disk right away, so memory stays
+flat however long the song is, and notes can be added block by block like with MidiTrackWriter.
+'''
+
+SAMPLE_RATE = 44100
+#Sample rates the command line and the server accept
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 192000
+#Samples per wavetable cycle
+TABLE_SIZE = 2048
+HARMONICS = 16
+#The sizes in a WAV header are 32 bits
+WAV_MAX_BYTES = (1 << 32) - 1 - 36
+#Headroom for notes that overlap, the sum is soft-clipped with tanh
+MASTER_GAIN = 0.5
+
+#Per General MIDI family (8 programs each): harmonic rolloff, odd harmonics only,
+#attack, decay (seconds), sustain level and release (seconds)
+_FAMILIES = [
+    (1.6, False, 0.005, 0.40, 0.30, 0.15),  # Piano
+    (2.2, False, 0.002, 0.30, 0.10, 0.20),  # Chromatic percussion
+    (1.2, False, 0.010, 0.05, 0.90, 0.05),  # Organ
+    (1.4, False, 0.003, 0.30, 0.20, 0.10),  # Guitar
+    (2.0, False, 0.005, 0.20, 0.60, 0.05),  # Bass
+    (1.0, False, 0.080, 0.10, 0.80, 0.20),  # Strings
+    (1.1, False, 0.100, 0.10, 0.80, 0.30),  # Ensemble
+    (0.9, False, 0.040, 0.10, 0.80, 0.10),  # Brass
+    (1.0, True, 0.030, 0.10, 0.80, 0.08),   # Reed
+    (3.0, False, 0.030, 0.05, 0.90, 0.08),  # Pipe
+    (1.0, True, 0.005, 0.05, 0.90, 0.05),   # Synth lead
+    (1.8, False, 0.300, 0.20, 0.80, 0.50),  # Synth pad
+    (1.3, False, 0.100, 0.30, 0.60, 0.40),  # Synth effects
+    (1.5, False, 0.004, 0.30, 0.30, 0.15),  # Ethnic
+    (2.5, False, 0.001, 0.20, 0.00, 0.10),  # Percussive
+    (0.8, False, 0.010, 0.20, 0.50, 0.20),  # Sound effects
+]
+_ENVELOPES = np.array([family[2:] for family in _FAMILIES for _ in range(8)], dtype=np.float64)
+
+
+@lru_cache(maxsize=None)
+def wavetables():
+    """Returns one single-cycle wavetable per General MIDI program (0-127) as a (128, TABLE_SIZE) array."""
+    phase = np.arange(TABLE_SIZE) / TABLE_SIZE
+    harmonics = np.arange(1, HARMONICS + 1)
+    partials = np.sin(2 * np.pi * harmonics[:, None] * phase)
+    tables = np.empty((128, TABLE_SIZE), dtype=np.float64)
+    for program in range(128):
+        rolloff, odd_only = _FAMILIES[program // 8][:2]
+        #Programs of one family get a bit darker one after another
+        amplitudes = harmonics ** -(rolloff + 0.1 * (program % 8))
+        if odd_only:
+            amplitudes = np.where(harmonics % 2 == 1, amplitudes, 0)
+        table = amplitudes @ partials
+        tables[program] = table / np.abs(table).max()
+    return tables
+
+
+def drum_sound(key, sample_rate=SAMPLE_RATE):
+    """Synthesizes the one-shot sample of a General MIDI drum key (the same key always gives the same sound)."""
+    rng = np.random.default_rng(key)
+
+    def shape(seconds, decay):
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        return t, np.exp(-t * decay)
+
+    def sweep(t, low, high, speed):
+        #Sine whose pitch falls from high to low
+        frequency = low + (high - low) * np.exp(-t * speed)
+        return np.sin(2 * np.pi * np.cumsum(frequency) / sample_rate)
+
+    if key in (35, 36):  # Bass drums
+        t, envelope = shape(0.4, 12)
+        sound = sweep(t, 50, 150, 30)
+    elif key in (37, 38, 39, 40):  # Side stick, snares and clap
+        t, envelope = shape(0.25, 25)
+        sound = 0.7 * rng.uniform(-1, 1, len(t)) + 0.5 * np.sin(2 * np.pi * 180 * t)
+    elif key in (41, 43, 45, 47, 48, 50):  # Toms, higher keys are higher toms
+        t, envelope = shape(0.4, 8)
+        low = 80 + 15 * (key - 41)
+        sound = sweep(t, low, 1.5 * low, 20)
+    elif key in (42, 44):  # Closed and pedal hi-hat
+        t, envelope = shape(0.08, 60)
+        sound = np.diff(rng.uniform(-1, 1, len(t) + 1))
+    elif key == 56:  # Cowbell
+        t, envelope = shape(0.3, 15)
+        sound = 0.5 * (np.sign(np.sin(2 * np.pi * 540 * t)) + np.sign(np.sin(2 * np.pi * 800 * t)))
+    elif key in (46, 49, 51, 52, 53, 55, 57, 59):  # Open hi-hat and cymbals
+        t, envelope = shape(1.0, 10 if key == 46 else 4)
+        sound = np.diff(rng.uniform(-1, 1, len(t) + 1)) + 0.3 * np.sin(2 * np.pi * 3200 * t)
+    else:  # Anything else: a short tone at the pitch of the key with some noise
+        t, envelope = shape(0.2, 20)
+        sound = np.sin(2 * np.pi * 440 * 2 ** ((key - 69) / 12) * t) + 0.3 * rng.uniform(-1, 1, len(t))
+    sound = sound * envelope
+    return sound / max(np.abs(sound).max(), 1e-9)
+
+
+@lru_cache(maxsize=None)
+def drum_bank(sample_rate=SAMPLE_RATE):
+    """Returns the drum samples of all 128 keys concatenated, with the offset and length of every key."""
+    sounds = [drum_sound(key, sample_rate) for key in range(128)]
+    lengths = np.array([len(sound) for sound in sounds], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return np.concatenate(sounds), offsets, lengths
+
+
+def adsr(t, held, attack, decay, sustain, release):
+    """
+    ADSR envelope at sample t of notes that are held for 'held' samples, with attack, decay and release
+    in samples. After the note is released the level it had at that moment fades out linearly.
+    """
+    def level(t):
+        rise = t / np.maximum(attack, 1)
+        fall = 1 - (1 - sustain) * (t - attack) / np.maximum(decay, 1)
+        return np.where(t < attack, rise, np.where(t < attack + decay, fall, sustain))
+    fade = np.clip(1 - (t - held) / np.maximum(release, 1), 0, 1)
+    return np.where(t < held, level(t), level(held) * fade)
+
+
+class WavRenderer:
+    '''
+    Streams notes into a 16-bit mono WAV file.
+    Notes are added in blocks with add_notes(), the same arguments as MidiEventWriter.add_notes(),
+    in order of their start tick. Audio before the start of the last added note can not change
+    any more, so it is rendered and written right away, block_size samples at a time.
+    Notes with pitch 0 (rests) and velocity 0 are silent. On the percussion channel (9) the
+    Instrument column holds the drum key, like in the MIDI export.
+    '''
+    block_size = 1 << 16
+
+    def __init__(self, path, ticks_per_beat=480, sample_rate=SAMPLE_RATE):
+        self.path = path
+        self.ticks_per_beat = ticks_per_beat
+        self.sample_rate = sample_rate
+        self.notes_written = 0
+        self.samples_written = 0
+        self.file = open(path, "wb")
+        self.wave = wave.open(self.file, "wb")
+        self.wave.setnchannels(1)
+        self.wave.setsampwidth(2)
+        self.wave.setframerate(sample_rate)
+        self._tables = wavetables()
+        self._bank, self._drum_offsets, self._drum_lengths = drum_bank(sample_rate)
+        #Timeline of the notes added so far: tick of the last start, its time in tick * microseconds per beat, and the tempo
+        self._tick = 0
+        self._clock = 0
+        self._micros_per_beat = 500_000
+        self._notes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def add_notes(self, notes, velocities, start_ticks, duration_ticks,
+                  channels=None, instruments=None, tempos=None):
+        '''Adds a block of notes, see MidiEventWriter.add_notes(), and writes the audio that is final.'''
+        count = len(notes)
+        if count == 0:
+            return
+        first_note = self.notes_written
+        self.notes_written += count
+        notes = np.asarray(notes, dtype=np.int64) & 0x7F
+        velocities = np.clip(np.asarray(velocities, dtype=np.int64), 0, 127)
+        starts = np.asarray(start_ticks, dtype=np.int64)
+        durations = np.asarray(duration_ticks, dtype=np.int64)
+        channels = np.zeros(count, np.int64) if channels is None else np.asarray(channels, dtype=np.int64) & 0x0F
+        instruments = np.ones(count, np.int64) if instruments is None else np.asarray(instruments, dtype=np.int64)
+
+        #The tempo of a note holds from its start to the next start, rounded like the set_tempo events
+        tempos = tempo_block(tempos, slice(0, count), first_note)
+        if tempos is None:
+            micros = np.full(count, self._micros_per_beat, dtype=np.int64)
+        else:
+            micros = np.clip(np.round(60_000_000 / tempos), 1, 0xFFFFFF).astype(np.int64)
+        previous_starts = np.concatenate(([self._tick], starts[:-1]))
+        previous_micros = np.concatenate(([self._micros_per_beat], micros[:-1]))
+        clock = self._clock + np.cumsum((starts - previous_starts) * previous_micros)
+        self._tick, self._clock, self._micros_per_beat = int(starts[-1]), int(clock[-1]), int(micros[-1])
+
+        to_samples = self.sample_rate / (1e6 * self.ticks_per_beat)
+        begin = np.rint(clock * to_samples).astype(np.int64)
+        held = np.rint((clock + durations * micros) * to_samples).astype(np.int64) - begin
+
+        drums = channels == PERCUSSION_CHANNEL
+        programs = np.clip(instruments - 1, 0, 127)
+        keys = np.where(drums, instruments, notes) & 0x7F
+        envelope = _ENVELOPES[programs] * [self.sample_rate, self.sample_rate, 1, self.sample_rate]
+        #Drums always play their whole sample, tones ring on for their release
+        length = np.where(drums, self._drum_lengths[keys], held + envelope[:, 3].astype(np.int64))
+        frequency = 440 * 2 ** ((keys - 69) / 12)
+        block = {
+            "begin": begin, "end": begin + length, "held": held, "drum": drums, "program": programs,
+            "step": frequency * TABLE_SIZE / self.sample_rate, "offset": self._drum_offsets[keys],
+            "gain": MASTER_GAIN * velocities / 127, "attack": envelope[:, 0], "decay": envelope[:, 1],
+            "sustain": envelope[:, 2], "release": envelope[:, 3],
+        }
+        audible = (velocities > 0) & (drums | (notes > 0))
+        block = {name: values[audible] for name, values in block.items()}
+        if self._notes is not None:
+            block = {name: np.concatenate((self._notes[name], values)) for name, values in block.items()}
+        self._notes = block
+        self._render_until(int(begin[-1]))
+
+    def _render_until(self, stop):
+        while self.samples_written < stop:
+            end = min(self.samples_written + self.block_size, stop)
+            self._write(self._render(self.samples_written, end))
+        #Notes that have ended are not needed any more
+        if self._notes is not None:
+            keep = self._notes["end"] > self.samples_written
+            self._notes = {name: values[keep] for name, values in self._notes.items()}
+
+    def _render(self, start, stop):
+        '''Returns the mixed samples start:stop of the notes that sound in them.'''
+        notes = self._notes
+        out = np.zeros(stop - start, dtype=np.float64)
+        if notes is None:
+            return out
+        active = np.flatnonzero((notes["begin"] < stop) & (notes["end"] > start))
+        first = np.maximum(notes["begin"][active], start)
+        lengths = np.minimum(notes["end"][active], stop) - first
+        total = int(lengths.sum())
+        if total == 0:
+            return out
+
+        #One entry per (note, sample): the note, the sample in the block and the sample since the note began
+        note = np.repeat(active, lengths)
+        position = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths - (first - start), lengths)
+        t = position + start - notes["begin"][note]
+
+        values = np.empty(total, dtype=np.float64)
+        drum = notes["drum"][note]
+        values[drum] = self._bank[notes["offset"][note[drum]] + t[drum]]
+        tone, tone_note, tone_t = ~drum, note[~drum], t[~drum]
+        #Wavetable lookup with linear interpolation, the phase follows from the sample since the note began
+        phase = (tone_t * notes["step"][tone_note]) % TABLE_SIZE
+        index = phase.astype(np.int64)
+        fraction = phase - index
+        program = notes["program"][tone_note]
+        wave_values = (self._tables[program, index] * (1 - fraction)
+                       + self._tables[program, (index + 1) % TABLE_SIZE] * fraction)
+        values[tone] = wave_values * adsr(tone_t, notes["held"][tone_note], notes["attack"][tone_note],
+                                          notes["decay"][tone_note], notes["sustain"][tone_note],
+                                          notes["release"][tone_note])
+        values *= notes["gain"][note]
+        out += np.bincount(position, weights=values, minlength=stop - start)
+        return out
+
+    def _write(self, samples):
+        if 2 * (self.samples_written + len(samples)) > WAV_MAX_BYTES:
+            raise ValueError(f"The audio is longer than a WAV file can hold ({WAV_MAX_BYTES // 2 // self.sample_rate // 3600} "
+                             f"hours at {self.sample_rate} Hz), use a shorter sequence or a lower sample rate.")
+        pcm = np.round(np.tanh(samples) * 32767).astype("<i2")
+        self.wave.writeframes(pcm.tobytes())
+        self.samples_written += len(samples)
+
+    def flush(self):
+        '''Flushes the audio written so far to disk, the WAV header is always up to date.'''
+        self.file.flush()
+
+    def close(self):
+        '''Renders the notes that are still ringing and closes the file.'''
+        if self.file.closed:
+            return
+        try:
+            if self._notes is not None and len(self._notes["end"]):
+                self._render_until(int(self._notes["end"].max()))
+        finally:
+            self.wave.close()
+            self.file.close()
+
+
+def write_wav(path, notes, velocities, start_ticks, duration_ticks, channels=None,
+              instruments=None, tempos=None, ticks_per_beat=480, sample_rate=SAMPLE_RATE):
+    '''Renders notes to a WAV file at path.'''
+    with WavRenderer(path, ticks_per_beat, sample_rate) as renderer:
+        for start in range(0, len(notes), renderer.block_size):
+            block = slice(start, start + renderer.block_size)
+            renderer.add_notes(notes[block], velocities[block], start_ticks[block], duration_ticks[block],
+                               None if channels is None else channels[block],
+                               None if instruments is None else instruments[block],
+                               _tempo_slice(tempos, block))
+    return path
+
+
+def _tempo_slice(tempos, block):
+    #A TempoMap covers the whole song and is indexed by the renderer itself
+    if tempos is None or hasattr(tempos, "expand"):
+        return tempos
+    return tempos[block]
+
+
+def write_note_table_wav(path, table, start_ticks, duration_ticks, ticks_per_beat=480, sample_rate=SAMPLE_RATE):
+    '''Renders a NoteTable (or DataFrame) to a WAV file, with the same columns and ticks as write_note_table.'''
+    tempos = table_tempos(table)
+    if tempos is not None and not hasattr(tempos, "expand"):
+        tempos = np.asarray(tempos)
+    return write_wav(path, np.asarray(table['Note']), np.asarray(table['Velocity']), start_ticks, duration_ticks,
+                     np.asarray(table['Channel']), np.asarray(table['Instrument']), tempos, ticks_per_beat, sample_rate)
@@ -0,0 +1,137 @@
+import contextlib
+import io
+import os
+import re
+import tempfile
+import time
+import traceback
+from collections import namedtuple
+
+from packages.sequence_context import SequenceContext
+
+'''
+Batch rendering of many FASTA files, or of every record of a multi-record FASTA file,
+spread over a pool of worker processes.
+Every item writes its own outputs to the output directory, and a failing item is reported
+without stopping the others.
+'''
+
+FASTA_EXTENSIONS = (".fasta", ".fa", ".fna", ".ffn", ".fas")
+
+#One unit of work: the output name, the FASTA path, and for split records the record index and the cached context
+BatchItem = namedtuple("BatchItem", ["name", "path", "record_index", "cache_dir", "digest"])
+
+#Outcome of one item, error holds the traceback of a failed item
+BatchResult = namedtuple("BatchResult", ["name", "ok", "seconds", "error"])
+
+
+def safe_name(text):
+    """Turns a file name or FASTA header into a name that is safe to use for output files."""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text).strip("._") or "record"
+
+
+def unique_names(names):
+    """
+    Returns the names with a number added to every name that is used more than once
+    ("gene", "gene" -> "gene_1", "gene_2"), so two inputs never write to the same output files.
+    """
+    names = list(names)
+    counts = {}
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+    taken = {name for name, count in counts.items() if count == 1}
+    unique, numbers = [], {}
+    for name in names:
+        if counts[name] == 1:
+            unique.append(name)
+            continue
+        #A number that another input already uses as its own name (a file called gene_2) is skipped
+        number = numbers.get(name, 0)
+        while True:
+            number += 1
+            candidate = f"{name}_{number}"
+            if candidate not in taken:
+                break
+        numbers[name] = number
+        taken.add(candidate)
+        unique.append(candidate)
+    return unique
+
+
+def collect_inputs(paths, split_records=False, cache_dir=None):
+    """
+    Expands the input paths (FASTA files or directories of FASTA files) into BatchItems.
+    Files with the same name (a/gene.fa and b/gene.fa) get numbered output names, see unique_names.
+    With split_records every record of every file becomes its own item. The file is then parsed once
+    into a SequenceContext cached in cache_dir, and the workers load it memory-mapped.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith(FASTA_EXTENSIONS)))
+        else:
+            files.append(path)
+
+    items = []
+    for path, stem in zip(files, unique_names(safe_name(os.path.splitext(os.path.basename(path))[0]) for path in files)):
+        if not split_records:
+            items.append(BatchItem(stem, path, None, None, None))
+            continue
+        context = SequenceContext.from_fasta(path, cache_dir=cache_dir)
+        for index, header in enumerate(context.headers):
+            record_id = safe_name(header.split()[0]) if header.split() else "record"
+            items.append(BatchItem(f"{stem}_{index + 1:05d}_{record_id}", path, index, cache_dir, context.digest))
+    return items
+
+
+def load_item(item):
+    """Returns what a worker should render for an item: the FASTA path, or the SequenceContext of one record."""
+    if item.record_index is None:
+        return item.path
+    return SequenceContext.load(item.cache_dir, item.digest).select(item.record_index)
+
+
+def _run_item(worker, item, options, output_dir):
+    #Runs in a worker process, the output of the pipeline is swallowed so the progress lines stay readable
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            worker(load_item(item), options, output_dir, item.name)
+    except Exception:
+        return BatchResult(item.name, False, time.perf_counter() - started, traceback.format_exc())
+    return BatchResult(item.name, True, time.perf_counter() - started, None)
+
+
+def run_batch(paths, worker, options, output_dir, jobs=None, split_records=False, cache_dir=None):
+    """
+    Renders every input with worker(source, options, output_dir, name) on a process pool of 'jobs' workers
+    (all CPUs by default), printing one progress line per finished item.
+    Returns the list of BatchResults.
+    """
+    #multiprocessing is only loaded when a batch runs, it is not needed to start the other commands
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    os.makedirs(output_dir, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        if split_records and cache_dir is None:
+            cache_dir = stack.enter_context(tempfile.TemporaryDirectory(dir=output_dir))
+        items = collect_inputs(paths, split_records, cache_dir)
+        total = len(items)
+        results = []
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(_run_item, worker, item, options, output_dir): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    result = future.result()
+                except Exception:
+                    #The worker process itself died, the other items still run
+                    result = BatchResult(item.name, False, 0.0, traceback.format_exc())
+                results.append(result)
+                status = "ok    " if result.ok else "FAILED"
+                print(f"[{len(results)}/{total}] {status} {result.name} ({result.seconds:.2f}s)")
+                if not result.ok:
+                    print(result.error.rstrip().splitlines()[-1])
+    failed = sum(not result.ok for result in results)
+    print(f"Rendered {total - failed} of {total} inputs into {output_dir}" + (f", {failed} failed" if failed else ""))
+    return results
@@ -1,24 +1,143 @@
-from Bio import SeqIO
-from Bio.SeqUtils import gc_fraction
+import numpy as np
 
-def calculate_gc_content(fasta_path, window_size=12):
+from packages.translate_file import read_records
+
+# Bases counted as G/C and bases counted in the length, the same as gc_fraction(ambiguous="remove")
+_GC_BASES = np.zeros(256, dtype=np.int32)
+_GC_BASES[list(b"CGScgs")] = 1
+_COUNTED_BASES = np.zeros(256, dtype=np.int32)
+_COUNTED_BASES[list(b"CGSATWUcgsatwu")] = 1
+
+# Window positions handled at a time, bounds the size of the prefix-sum arrays
+_BLOCK_SIZE = 1 << 20
+
+
+def check_window_sizes(window_sizes):
+    """Raises ValueError for a window size that is not a positive whole number of bases."""
+    for window_size in window_sizes:
+        if int(window_size) != window_size or window_size < 1:
+            raise ValueError(f"The GC window size must be a positive number of bases, got {window_size}.")
+
+
+def window_starts(anchors, length, window_size=12, sliding=False):
+    """
+    Returns the start of the window used for every anchor position in a sequence of 'length' bases.
+    Tiled windows cut the sequence into consecutive blocks of window_size bases.
+    Sliding windows are centred on the anchor and moved inwards at the ends of the sequence.
+    """
+    if sliding:
+        return np.clip(anchors - window_size // 2, 0, max(length - window_size, 0))
+    return anchors // window_size * window_size
+
+
+def gc_windows(sequence, anchors, window_size=12, sliding=False, offset=0, length=None):
+    """
+    Calculates the GC content (percent) of the window around every anchor position with prefix sums.
+    Each window costs two lookups, so any window size runs in O(n).
+    sequence can also be a piece of a longer sequence: offset is where the piece starts and length the
+    length of the whole sequence (anchors are positions in the whole sequence, and the piece must hold their windows).
+    """
+    return gc_windows_multi(sequence, anchors, [window_size], sliding, offset, length)[0]
+
+
+def gc_windows_multi(sequence, anchors, window_sizes, sliding=False, offset=0, length=None):
+    """
+    Like gc_windows for several window sizes at once, returns one row of GC percentages per window size.
+    The prefix sums are made once for every block of anchors and shared by all window sizes.
+    """
+    check_window_sizes(window_sizes)
+    data = np.frombuffer(sequence, dtype=np.uint8)
+    length = offset + len(data) if length is None else length
+    anchors = np.asarray(anchors, dtype=np.int64)
+    gc = np.zeros((len(window_sizes), len(anchors)), dtype=np.float64)
+    for block in range(0, len(anchors), _BLOCK_SIZE):
+        windows = []
+        for window_size in window_sizes:
+            starts = window_starts(anchors[block:block + _BLOCK_SIZE], length, window_size, sliding)
+            windows.append((starts, np.minimum(starts + window_size, length)))
+        if len(windows[0][0]) == 0:
+            continue
+        low = min(int(starts.min()) for starts, ends in windows)
+        high = max(int(ends.max()) for starts, ends in windows)
+        bases = data[low - offset:high - offset]
+        gc_sum = np.concatenate(([0], np.cumsum(_GC_BASES[bases], dtype=np.int64)))
+        counted_sum = np.concatenate(([0], np.cumsum(_COUNTED_BASES[bases], dtype=np.int64)))
+        for row, (starts, ends) in enumerate(windows):
+            gc_count = gc_sum[ends - low] - gc_sum[starts - low]
+            counted = counted_sum[ends - low] - counted_sum[starts - low]
+            # Windows without a countable base have a GC content of 0, like gc_fraction
+            np.divide(gc_count * 100, counted, out=gc[row, block:block + _BLOCK_SIZE], where=counted > 0)
+    return gc
+
+
+def gc_to_velocity(gc_percent, scale=1.27):
+    """Scales GC content (percent) to MIDI velocity, truncated to an integer in 0-127."""
+    return np.clip(np.floor(np.asarray(gc_percent) * scale), 0, 127).astype(np.uint8)
+
+
+def _residue_gc(fasta_path, window_sizes, sliding):
+    check_window_sizes(window_sizes)
+    profiles = []
+    for sequence in read_records(fasta_path):
+        codons = np.arange(0, len(sequence), 3, dtype=np.int64)
+        # Tiles start at codon boundaries when window_size is a multiple of 3, sliding windows centre on the middle base
+        anchors = codons + 1 if sliding else codons
+        profiles.append(gc_windows_multi(sequence, anchors, window_sizes, sliding))
+    if not profiles:
+        raise ValueError("No sequences found in the FASTA file.")
+    return np.concatenate(profiles, axis=1)
+
+
+def calculate_gc_per_residue(fasta_path, window_size=12, sliding=False):
+    """
+    Calculates the GC content (percent) for every translated amino acid of a FASTA file.
+    Each residue gets the GC content of the window around its codon: the tile that contains
+    the codon, or with sliding=True a window of window_size bases centred on the codon.
+    Every record is handled on its own and padded to whole codons, like translate_file,
+    so the result has one value per residue of the translated protein.
+
+    Returns:
+        float32 array of GC percentages, one per residue
+    """
+    return _residue_gc(fasta_path, [window_size], sliding)[0].astype(np.float32)
+
+
+def calculate_gc_sweep(fasta_path, window_sizes, sliding=False):
+    """
+    Calculates calculate_gc_per_residue for several window sizes in one pass over the sequence.
+
+    Returns:
+        float32 array with one row of GC percentages per window size, one column per residue
+    """
+    return _residue_gc(fasta_path, list(window_sizes), sliding).astype(np.float32)
+
+
+def calculate_gc_velocity(fasta_path, window_size=12, sliding=False, scale=1.27):
+    """
+    Calculates codon-aligned GC content for every translated amino acid and scales it to MIDI velocity.
+
+    Returns:
+        uint8 array of velocities, one per residue
+    """
+    return gc_to_velocity(_residue_gc(fasta_path, [window_size], sliding)[0], scale)
+
+
+def calculate_gc_content(fasta_path, window_size=12, sliding=False):
     """
     Calculates GC content for every 'window_size' nucleotides in a FASTA sequence.
 
     Args:
         fasta_path (str): Path to the FASTA file.
-        window_size (int): Size of the sliding window (default is 12).
+        window_size (int): Size of the window (default is 12).
+        sliding (bool): Use a sliding window centred on every base instead of tiles.
 
     Returns:
-        List of tuples: Each tuple contains (start_position, gc_percent)
+        float32 array with the GC percent of every nucleotide, for all records one after the other
     """
-    record = SeqIO.read(fasta_path, "fasta")
-    sequence = record.seq.upper()
-    gc_values = []
-
-    for i in range(0, len(sequence), window_size):
-        window_seq = sequence[i:i + window_size]
-        gc = gc_fraction(window_seq) * 100
-        gc_values.extend([gc] * len(window_seq))  # Repeat value per base
-
-    return gc_values  # <-- Only the list of floats
\ No newline at end of file
+    profiles = []
+    for sequence in read_records(fasta_path):
+        anchors = np.arange(len(sequence), dtype=np.int64)
+        profiles.append(gc_windows(sequence, anchors, window_size, sliding).astype(np.float32))
+    if not profiles:
+        raise ValueError("No sequences found in the FASTA file.")
+    return np.concatenate(profiles)
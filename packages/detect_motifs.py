@@ -1,6 +1,11 @@
 # motif_detection.py
-from Bio import SeqIO
-import pandas as pd
+import itertools
+import re
+from functools import lru_cache
+
+import numpy as np
+
+from packages.translate_file import read_records
 
 # Motif to biological explanation and percussion mapping
 motif_to_instrument = {
@@ -37,64 +42,240 @@ motif_to_drum = {
     "TAG": 49, "TGA": 49, "TAA": 49   # Crash cymbals
 }
 
-def generate_motif_hits(fasta_file,length):
+# IUPAC nucleotide codes and the bases each one stands for
+iupac_codes = {
+    "A": "A", "C": "C", "G": "G", "T": "T", "U": "T",
+    "R": "AG", "Y": "CT", "S": "CG", "W": "AT", "K": "GT", "M": "AC",
+    "B": "CGT", "D": "AGT", "H": "ACT", "V": "ACG", "N": "ACGT"
+}
+
+_COMPLEMENT = str.maketrans("ACGTURYSWKMBDHVN", "TGCAAYRSWMKVHDBN")
+
+# 2-bit code for every byte, anything that is not A/C/G/T gets 4 and never matches
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate("ACGT"):
+    _BASE_CODES[ord(_base)] = _code
+    _BASE_CODES[ord(_base.lower())] = _code
+
+
+def expand_iupac(motif):
+    """Returns every concrete A/C/G/T motif that a (possibly degenerate) IUPAC motif stands for."""
+    try:
+        choices = [iupac_codes[base] for base in motif.upper()]
+    except KeyError as err:
+        raise ValueError(f"Motif {motif} contains a base that is not an IUPAC code: {err}") from None
+    return ["".join(bases) for bases in itertools.product(*choices)]
+
+
+def motif_reverse_complement(motif):
+    """Returns the reverse complement of a (possibly degenerate) IUPAC motif."""
+    return motif.upper().translate(_COMPLEMENT)[::-1]
+
+
+def read_motif_table(path):
     """
-    Given a FASTA file, find motifs and generate a list of hits, 
-    including motif, instrument, percussion, and amino acid positions.
-    Returns a DataFrame of the motif hits.
+    Reads a user-supplied motif table.
+    Each line holds a motif and its MIDI drum note, separated by a comma, tab or spaces.
+    Blank lines, lines starting with '#' and a header line are skipped.
+    Drum notes must be MIDI note numbers (0-127), a note out of range is a ValueError naming the line.
+    Returns a dict of motif to drum note, in file order.
     """
-    # Read sequence from FASTA file
-    sequences = list(SeqIO.parse(fasta_file, "fasta"))
-    if not sequences:
-        raise ValueError("No sequences found in the FASTA file.")
-    
-    instrument_list = [1 for i in range(length)]
-    channel_list = [0 for i in range(length)]
+    table = {}
+    with open(path, "r") as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = re.split(r"[,\t ]+", line)
+            if len(fields) < 2 or not fields[1].isdigit():
+                continue
+            drum_note = int(fields[1])
+            if drum_note > 127:
+                raise ValueError(f"Drum note {drum_note} of motif {fields[0]} on line {number} of the motif table {path} "
+                                 f"is not a MIDI note (0-127).")
+            table[fields[0].upper()] = drum_note
+    if not table:
+        raise ValueError(f"No motifs found in the motif table {path}.")
+    return table
+
 
+class MotifScanner:
+    """
+    Compiled multi-motif scanner.
+    Every motif (IUPAC bases expanded, reverse complement added on request) is turned into
+    2-bit k-mer codes grouped by length. Scanning encodes the DNA once and rolls the k-mer
+    code forward one base at a time, so every motif length is checked in the same linear pass
+    with NumPy lookups instead of one str.find loop per motif.
+    When two motifs share a k-mer, the later entry of the table wins.
+    """
+    max_motif_length = 32   # k-mer codes are packed into uint64
+    dense_length = 8        # lengths up to this use a direct 4**k lookup array
+    block_size = 1 << 22    # bases scanned per block, keeps memory bounded
+
+    def __init__(self, motif_table, reverse_complement=False):
+        self.motifs = list(motif_table)
+        self.drum_notes = np.array([motif_table[motif] for motif in self.motifs], dtype=np.uint8)
+        self.reverse_complement = reverse_complement
+
+        patterns = {}
+        for motif_id, motif in enumerate(self.motifs):
+            if not 0 < len(motif) <= self.max_motif_length:
+                raise ValueError(f"Motif {motif} must be 1 to {self.max_motif_length} bases long.")
+            variants = set(expand_iupac(motif))
+            if reverse_complement:
+                variants.update(expand_iupac(motif_reverse_complement(motif)))
+            codes = patterns.setdefault(len(motif), {})
+            for variant in variants:
+                codes[_kmer_code(variant)] = motif_id
+
+        self.index = {}
+        for length, codes in patterns.items():
+            keys = np.fromiter(codes.keys(), dtype=np.uint64, count=len(codes))
+            ids = np.fromiter(codes.values(), dtype=np.int32, count=len(codes))
+            if length <= self.dense_length:
+                lookup = np.full(4 ** length, -1, dtype=np.int32)
+                lookup[keys] = ids
+                self.index[length] = lookup
+            else:
+                order = np.argsort(keys)
+                self.index[length] = (keys[order], ids[order])
+        self.longest = max(self.index) if self.index else 0
 
-    dna_sequence = str(sequences[0].seq).upper()
-    print(f"DNA sequence: {dna_sequence[:50]}...")  # Print first 50 bases for debugging
+    def scan(self, dna_sequence):
+        """
+        Finds every motif hit in a DNA string (str or bytes).
+        Returns two arrays, the 0-based start positions and the motif ids (index into self.motifs),
+        sorted by position and then by motif id.
+        """
+        if isinstance(dna_sequence, str):
+            dna_sequence = dna_sequence.encode("ascii")
+        data = np.frombuffer(dna_sequence, dtype=np.uint8)
+        positions, motif_ids = [], []
+        for start in range(0, len(data), self.block_size):
+            block = _BASE_CODES[data[start:start + self.block_size + self.longest - 1]]
+            block_positions, block_ids = self._scan_block(block, min(self.block_size, len(block)))
+            positions.append(block_positions + start)
+            motif_ids.append(block_ids)
+        if not positions:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+        positions = np.concatenate(positions)
+        motif_ids = np.concatenate(motif_ids)
+        order = np.lexsort((motif_ids, positions))
+        return positions[order], motif_ids[order]
 
-    # Find motifs in DNA sequence
-    motif_results = []
-    for motif, instrument in motif_to_instrument.items():
-        pos = 0
-        while True:
-            index = dna_sequence.find(motif, pos)
-            if index == -1:
+    def _scan_block(self, codes, limit):
+        """Scans one encoded block and keeps the hits that start before 'limit'."""
+        valid = codes < 4
+        bases = (codes & 3).astype(np.uint64)
+        kmers = np.zeros(len(codes), dtype=np.uint64)
+        ok = np.ones(len(codes), dtype=bool)
+        positions, motif_ids = [], []
+        for length in range(1, self.longest + 1):
+            size = len(codes) - length + 1
+            if size <= 0:
                 break
-            # Check if the instrument and drum note are correct
-            if motif in motif_to_instrument:
-                print(f"Found motif: {motif} at position {index} with instrument: {instrument} and drum note: {motif_to_drum[motif]}")
+            # kmers[i] now holds the code of codes[i:i + length]
+            kmers = (kmers[:size] << np.uint64(2)) | bases[length - 1:]
+            ok = ok[:size] & valid[length - 1:]
+            if length not in self.index:
+                continue
+            lookup = self.index[length]
+            if isinstance(lookup, tuple):
+                keys, ids = lookup
+                slot = np.minimum(np.searchsorted(keys, kmers), len(keys) - 1)
+                found = np.where(keys[slot] == kmers, ids[slot], -1)
             else:
-                print(f"ERROR: Motif {motif} not found in motif_to_instrument mapping!")
+                found = lookup[kmers]
+            hits = np.flatnonzero((found[:limit] >= 0) & ok[:limit])
+            positions.append(hits)
+            motif_ids.append(found[hits])
+        if not positions:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+        return np.concatenate(positions), np.concatenate(motif_ids)
 
-            motif_results.append({
-                "motif": motif,
-                "instrument": instrument,  # Correct instrument
-                "start": index,
-                "end": index + len(motif) - 1,
-                "aa_position": index // 3,  # Position in the protein sequence
-                "drum_note": motif_to_drum[motif],  # Correct drum note
-                "channel": motif  # Add motif to the 'channel'
-            })
-            pos = index + 1
 
-    # Sort motifs by amino acid position
-    motif_results.sort(key=lambda x: x["aa_position"])
+def _kmer_code(kmer):
+    code = 0
+    for base in kmer:
+        code = (code << 2) | int(_BASE_CODES[ord(base)])
+    return code
 
-    # Convert to DataFrame
-    df = pd.DataFrame(motif_results)
 
-    # Debugging: Print the first few rows of the resulting DataFrame to ensure the instrument is assigned correctly
-    print(f"Motif hits DataFrame:\n{df.head()}")  # Show the DataFrame with hits
+@lru_cache(maxsize=16)
+def _compile_scanner(motif_items, reverse_complement):
+    return MotifScanner(dict(motif_items), reverse_complement)
 
-    df_position_locations = df['aa_position'].to_list()
-    df_instrument = df['drum_note'].to_list()
+
+def get_motif_scanner(motif_table=None, reverse_complement=False):
+    """
+    Returns a compiled MotifScanner for a motif table (the built-in motif_to_drum by default).
+    Compiled scanners are cached, so repeated calls with the same table are free.
+    """
+    if motif_table is None:
+        motif_table = {motif: motif_to_drum[motif] for motif in motif_to_instrument}
+    return _compile_scanner(tuple(motif_table.items()), reverse_complement)
+
+
+def find_motif_hits(dna_sequence, motif_table=None, reverse_complement=False):
+    """
+    Finds all motifs in a DNA string in one pass.
+    Returns two arrays: the nucleotide start positions and the drum note of each hit.
+    """
+    scanner = get_motif_scanner(motif_table, reverse_complement)
+    positions, motif_ids = scanner.scan(dna_sequence.upper())
+    return positions, scanner.drum_notes[motif_ids]
 
 
-    for i in range(len(df_position_locations)):
-        instrument_list[df_position_locations[i]] = df_instrument[i]
-        channel_list[df_position_locations[i]] = 9
+def generate_motif_hits(fasta_file, length, motif_table=None, reverse_complement=False, verbose=False):
+    """
+    Given a FASTA file (or SequenceContext), find motifs in the first record and map them onto the amino acid positions.
+    Returns two uint8 arrays of the given length: the instrument (drum note where a motif starts,
+    1 elsewhere) and the channel (9, the percussion channel, where a motif starts, 0 elsewhere).
+    When several motifs land on the same amino acid, the one later in the motif table wins.
+    Per-hit debug printing is only done when verbose is True.
+    """
+    # Read the first sequence from the FASTA file
+    dna_sequence = next(read_records(fasta_file), None)
+    if dna_sequence is None:
+        raise ValueError("No sequences found in the FASTA file.")
 
+    instrument_list = np.ones(length, dtype=np.uint8)
+    channel_list = np.zeros(length, dtype=np.uint8)
+
+    dna_sequence = dna_sequence.upper()
+    scanner = get_motif_scanner(motif_table, reverse_complement)
+    positions, motif_ids = scanner.scan(dna_sequence)
+
+    if verbose:
+        print(f"DNA sequence: {dna_sequence[:50].decode('ascii')}...")  # Print first 50 bases for debugging
+        for index, motif_id in zip(positions.tolist(), motif_ids.tolist()):
+            motif = scanner.motifs[motif_id]
+            instrument = motif_to_instrument.get(motif, "custom")
+            print(f"Found motif: {motif} at position {index} with instrument: {instrument} "
+                  f"and drum note: {scanner.drum_notes[motif_id]}")
+        print(f"Motif hits: {len(positions)}")
+
+    # Position in the protein sequence, hits past the translated length are dropped
+    aa_positions = positions // 3
+    keep = aa_positions < length
+    assign_motif_hits(instrument_list, channel_list, aa_positions[keep], positions[keep], motif_ids[keep],
+                      scanner.drum_notes)
     return instrument_list, channel_list
+
+
+def assign_motif_hits(instrument_list, channel_list, aa_positions, positions, motif_ids, drum_notes):
+    """
+    Writes the drum note and the percussion channel of motif hits into the instrument and channel arrays,
+    at the amino acid index of each hit. When several motifs land on the same amino acid, the one later
+    in the motif table wins, then the later position.
+    """
+    if len(positions) == 0:
+        return
+
+    # Keep the last hit per amino acid, ordered by motif table order and then position
+    order = np.lexsort((positions, motif_ids, aa_positions))
+    sorted_aa = aa_positions[order]
+    winners = order[np.append(sorted_aa[1:] != sorted_aa[:-1], True)]
+
+    instrument_list[aa_positions[winners]] = drum_notes[motif_ids[winners]]
+    channel_list[aa_positions[winners]] = 9
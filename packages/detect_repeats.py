@@ -0,0 +1,199 @@
+import numpy as np
+
+from packages.get_tempo import TempoMap
+
+'''
+Finds maximal tandem repeats: stretches where a unit of 1 to max_period letters repeats back to back,
+like "QPQPQP" (period 2), "GPPGPPGPP" (period 3) or a CA microsatellite in the bases.
+For every period p the sequence is compared with itself shifted by p. A run of positions i where
+sequence[i] == sequence[i + p] is a region with period p that can not be extended, so every run gives
+one maximal repeat. The comparison is done in blocks with the runs that are still open carried over,
+so the scan is linear in the sequence length for a bounded period and its memory does not grow with it.
+A repeat is only kept with its primitive period: "AAAAAA" is reported with period 1, not 2 or 3.
+The repeats are given as intervals that the tempo (tempo_map) and the instruments
+(farruhs_packages.repeat_instruments) can follow.
+'''
+
+MAX_PERIOD = 50
+MIN_COPIES = 3
+MIN_LENGTH = 6
+#Letters that never count as part of a repeat: unknown residues and stop codons, or unknown bases
+RESIDUE_IGNORE = b"X*"
+BASE_IGNORE = b"NRYSWKMBDHV"
+#Residues or bases compared at a time
+BLOCK_SIZE = 1 << 22
+
+#Every further copy of a repeat speeds the tempo up by this factor, up to MAX_TEMPO_COPIES copies
+REPEAT_MULTIPLIER = 1.05
+MAX_TEMPO_COPIES = 16
+
+
+class TandemRepeats:
+    """
+    Maximal tandem repeats as intervals, sorted by start: the region starts[k]:ends[k] repeats a unit
+    of periods[k] letters (the last copy can be partial). Periods are floats once the intervals are
+    converted from bases to residues with to_residues().
+    """
+    def __init__(self, starts, ends, periods):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.periods = np.asarray(periods)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def copies(self):
+        """Number of copies of the unit in every repeat."""
+        return (self.ends - self.starts) / self.periods
+
+    def non_overlapping(self):
+        """Returns the repeats with overlaps removed: where two repeats overlap, the one that starts first keeps the overlap."""
+        if len(self) == 0:
+            return self
+        covered = np.maximum.accumulate(self.ends)
+        starts = np.maximum(self.starts, np.concatenate(([0], covered[:-1])))
+        keep = starts < self.ends
+        return TandemRepeats(starts[keep], self.ends[keep], self.periods[keep])
+
+    def to_residues(self, context):
+        """
+        Converts repeats found in the bases of a SequenceContext (find_context_repeats) to residue positions of
+        its translation: every codon that overlaps a repeat is part of it, and the period is counted in codons.
+        """
+        offsets = np.asarray(context.record_offsets)
+        residue_offsets = np.concatenate(([0], np.cumsum(-(-np.diff(offsets) // 3))))
+        record = np.searchsorted(offsets, self.starts, side="right") - 1
+        local_starts, local_ends = self.starts - offsets[record], self.ends - offsets[record]
+        return TandemRepeats(residue_offsets[record] + local_starts // 3, residue_offsets[record] + -(-local_ends // 3),
+                             self.periods / 3)
+
+    def tempo_map(self, length, multiplier=REPEAT_MULTIPLIER, max_copies=MAX_TEMPO_COPIES):
+        """
+        Returns a TempoMap of factors for 'length' positions: 1 outside repeats, and multiplier ** k from the
+        k-th copy of a repeat on (k counted from 0 and capped at max_copies). Only the change points are made.
+        """
+        covered = np.maximum.accumulate(self.ends) if len(self) else self.ends
+        clipped = np.maximum(self.starts, np.concatenate(([0], covered[:-1])))
+        keep = clipped < self.ends
+        origins, starts, ends, periods = self.starts[keep], clipped[keep], self.ends[keep], self.periods[keep]
+
+        #Every copy that overlaps the part of the repeat that is left, k counted from the original start
+        first = np.floor((starts - origins) / periods).astype(np.int64)
+        counts = np.ceil((ends - origins) / periods).astype(np.int64) - first
+        repeat = np.repeat(np.arange(len(starts)), counts)
+        copy = first[repeat] + np.arange(len(repeat)) - np.repeat(np.cumsum(counts) - counts, counts)
+        copy_starts = np.maximum(origins[repeat] + np.ceil(copy * periods[repeat]).astype(np.int64), starts[repeat])
+        inside = copy_starts < ends[repeat]
+        copy, copy_starts = copy[inside], copy_starts[inside]
+
+        #The factor goes back to 1 at the end of a repeat, unless the next copy or repeat starts right there
+        positions = np.concatenate(([0], ends, copy_starts))
+        values = np.concatenate(([1.0], np.ones(len(ends)), multiplier ** np.minimum(copy, max_copies)))
+        order = np.lexsort((np.concatenate(([-2], np.full(len(ends), -1), copy)), positions))
+        positions, values = positions[order], values[order]
+        last = np.concatenate((positions[1:] != positions[:-1], [True])) & (positions < length)
+        positions, values = positions[last], values[last]
+        change = np.concatenate(([True], values[1:] != values[:-1]))
+        return TempoMap(positions[change], values[change], length)
+
+
+def _runs(equal, offset, open_start):
+    #Returns the starts and ends of the runs of True in equal (positions offset...) that end inside it,
+    #and the start of the run that is still open at its end (-1 when there is none)
+    if len(equal) == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64), open_start
+    edges = np.diff(np.concatenate(([open_start >= 0], equal)).astype(np.int8))
+    starts = np.flatnonzero(edges == 1) + offset
+    ends = np.flatnonzero(edges == -1) + offset
+    if open_start >= 0:
+        starts = np.concatenate(([open_start], starts))
+    if equal[-1]:
+        return starts[:-1], ends, int(starts[-1])
+    return starts, ends, -1
+
+
+def _scan(read, length, max_period, min_copies, min_length, ignore, block_size):
+    #Finds the runs of every period 1..max_period in the sequence read(start, stop) of the given length
+    valid_letter = np.ones(256, dtype=bool)
+    valid_letter[np.frombuffer(ignore, dtype=np.uint8)] = False
+    open_starts = np.full(max_period + 1, -1, dtype=np.int64)
+    empty = np.empty(0, dtype=np.int64)
+    found = {period: ([empty], [empty]) for period in range(1, max_period + 1)}
+
+    def keep(period, starts, ends):
+        #The run i..j of equal letters is the region i:j+period
+        regions = ends - starts + period
+        kept = regions >= max(min_copies * period, min_length)
+        found[period][0].append(starts[kept])
+        found[period][1].append(ends[kept] + period)
+
+    for block_start in range(0, length, block_size):
+        block_stop = min(block_start + block_size, length)
+        window = np.asarray(read(block_start, min(block_stop + max_period, length)), dtype=np.uint8)
+        valid = valid_letter[window]
+        for period in range(1, max_period + 1):
+            count = max(min(block_stop, length - period) - block_start, 0)
+            equal = (window[:count] == window[period:period + count]) & valid[:count] & valid[period:period + count]
+            starts, ends, open_starts[period] = _runs(equal, block_start, open_starts[period])
+            keep(period, starts, ends)
+    for period in range(1, max_period + 1):
+        if open_starts[period] >= 0:
+            keep(period, np.array([open_starts[period]]), np.array([length - period]))
+
+    #Drops every repeat that lies inside a repeat of a period that divides its own
+    runs = {period: (np.concatenate(starts), np.concatenate(ends)) for period, (starts, ends) in found.items()}
+    results = []
+    for period, (starts, ends) in runs.items():
+        primitive = np.ones(len(starts), dtype=bool)
+        for divisor in range(1, period):
+            if period % divisor or len(starts) == 0:
+                continue
+            divisor_starts, divisor_ends = runs[divisor]
+            index = np.searchsorted(divisor_starts, starts, side="right") - 1
+            inside = index >= 0
+            inside[inside] = divisor_ends[index[inside]] >= ends[inside]
+            primitive &= ~inside
+        results.append((starts[primitive], ends[primitive], np.full(primitive.sum(), period, dtype=np.int64)))
+    return results
+
+
+def _collect(results, min_period):
+    results = [result for result in results if len(result[2]) and result[2][0] >= min_period]
+    if not results:
+        return TandemRepeats([], [], np.empty(0, dtype=np.int64))
+    starts, ends, periods = (np.concatenate(parts) for parts in zip(*results))
+    order = np.lexsort((periods, starts))
+    return TandemRepeats(starts[order], ends[order], periods[order])
+
+
+def find_tandem_repeats(sequence, min_period=2, max_period=MAX_PERIOD, min_copies=MIN_COPIES, min_length=MIN_LENGTH,
+                        ignore=RESIDUE_IGNORE, block_size=BLOCK_SIZE):
+    """
+    Finds the maximal tandem repeats of a sequence (str, bytes or uint8 array, e.g. the translated residues)
+    with a primitive period from min_period to max_period, at least min_copies copies long and
+    covering at least min_length letters. Letters in ignore never take part in a repeat.
+    Repeats of period 1 are found by default too (tempo_inator already follows them), but not returned.
+    """
+    if isinstance(sequence, str):
+        sequence = sequence.encode("ascii")
+    codes = np.frombuffer(sequence, dtype=np.uint8) if isinstance(sequence, bytes) else np.asarray(sequence, dtype=np.uint8)
+    results = _scan(lambda start, stop: codes[start:stop], len(codes), max_period, min_copies, min_length,
+                    ignore, block_size)
+    return _collect(results, min_period)
+
+
+def find_context_repeats(context, min_period=1, max_period=MAX_PERIOD, min_copies=MIN_COPIES, min_length=MIN_LENGTH,
+                         ignore=BASE_IGNORE, block_size=BLOCK_SIZE):
+    """
+    Finds the maximal tandem repeats (microsatellites and longer units) in the bases of every record
+    of a SequenceContext, reading block_size bases at a time. The positions are those of the
+    concatenated sequence, use to_residues() to place them on the translation.
+    """
+    parts = []
+    for record in range(len(context)):
+        offset = int(context.record_offsets[record])
+        found = _scan(lambda start, stop: np.frombuffer(context.bases(offset + start, offset + stop), dtype=np.uint8),
+                      context.record_length(record), max_period, min_copies, min_length, ignore, block_size)
+        parts.extend((starts + offset, ends + offset, periods) for starts, ends, periods in found)
+    return _collect(parts, min_period)
@@ -1,13 +1,52 @@
+import numpy as np
+
 from packages.multiplier import multiply
-from packages.get_tempo import tempo_inator
+from packages.get_tempo import tempo_map_inator
+
+#Instrument (General MIDI program) of the notes inside a tandem repeat, by the period of the repeat in residues:
+#Vibraphone below period 2 (microsatellites found in the bases), Marimba from period 2,
+#Orchestral Harp from period 4, String Ensemble from period 10
+REPEAT_INSTRUMENTS = ((0, 12), (2, 13), (4, 47), (10, 49))
 
-def farruhs_packages(string, df):
+def farruhs_packages(string, table, tempo_column=True, tempomap=None, repeats=None):
    """Calls the two functions imported above. 
-      This package was created to reduce clutter in main."""
+      This package was created to reduce clutter in main.
+      Works on any table with a 'Tempo' column (a NoteTable or a DataFrame).
+      With tempo_column=False the per-note Tempo column of a NoteTable is replaced by a tempo map
+      (table.tempo_map) that only stores the points where the tempo changes.
+      A tempo map that was already made for the string (e.g. loaded from the stage cache) can be passed as tempomap.
+      With repeats (TandemRepeats from detect_repeats) every further copy of a tandem repeat also speeds the tempo up."""
+
+   if tempomap is None:
+      tempomap = tempo_map_inator(string) #Makes a map of multipliers for the tempo
+   if repeats is not None:
+      tempomap = tempomap.multiplied(repeats.tempo_map(len(string)))
+
+   if not tempo_column:
+      #The map is scaled by the base tempo of the table, the default tempo is the same for every note
+      table.tempo_map = tempomap.scaled(float(table['Tempo'][0]))
+      del table['Tempo']
+      return table
+
+   #Modifies the table to have varying tempo by multiplying the default tempo with the multipliers that were made in reference to repeats
+   table['Tempo'] = multiply(table['Tempo'], tempomap.expand()) 
 
-   tempomultipliers = tempo_inator(string) #Makes a list of multipliers for the tempo
+   return table
 
-   #Modifies the dataframe to have varying tempo by sending in a list of the default tempo and multiplying it with a list of multiplying factor list that was made in reference to repeats
-   df['Tempo'] = multiply(df['Tempo'].to_list(), tempomultipliers) 
+def repeat_instruments(table, repeats):
+   """Gives the notes inside tandem repeats (TandemRepeats from detect_repeats) the instrument of their period,
+      see REPEAT_INSTRUMENTS. Drum hits on the percussion channel keep their drum."""
 
-   return df
\ No newline at end of file
+   repeats = repeats.non_overlapping()
+   thresholds = np.array([period for period, instrument in REPEAT_INSTRUMENTS])
+   programs = np.array([instrument for period, instrument in REPEAT_INSTRUMENTS])
+   lengths = repeats.ends - repeats.starts
+   notes = np.repeat(repeats.starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+   chosen = np.repeat(programs[np.searchsorted(thresholds, repeats.periods, side="right") - 1], lengths)
+   instruments = np.array(table['Instrument'])
+   inside = notes < len(instruments)
+   notes, chosen = notes[inside], chosen[inside]
+   melodic = np.asarray(table['Channel'])[notes] != 9
+   instruments[notes[melodic]] = chosen[melodic]
+   table['Instrument'] = instruments
+   return table
@@ -1,4 +1,171 @@
-import pandas as pd
+import importlib.util
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+#Formats a NoteTable can be saved in, parquet needs the optional pyarrow package
+TABLE_FORMATS = ("csv", "npz", "parquet")
+PARQUET_MISSING = "Writing parquet files needs the pyarrow package (pip install pyarrow)."
+
+
+def format_missing(output_format):
+    #Returns why a table can not be saved in output_format here (None when it can), without importing pyarrow
+    if output_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        return PARQUET_MISSING
+    return None
+
+
+class NoteTable:
+    '''
+    Column-oriented table of MIDI notes.
+    Every column is a NumPy array of the same length, stored with a compact dtype:
+    uint8 for Note, Velocity, Instrument, Channel, Track, Pan, Volume and Expression,
+    float32 for Duration, and float64 for Time (float32 can not tell neighbouring notes apart
+    past 2**24 time units, about 1.7e7 residues) and Tempo (the tempo multipliers compound).
+    The table only becomes a pandas DataFrame when to_dataframe() or to_csv() is called.
+    Instead of a Tempo column the table can carry a tempo map (tempo_map, see get_tempo.TempoMap),
+    which only stores the notes where the tempo changes and is expanded when the table is exported.
+    '''
+    columns = ("Time", "Note", "Duration", "Velocity", "Instrument", "Channel",
+               "Track", "Tempo", "Pan", "Volume", "Expression")
+    dtypes = {
+        "Time": np.float64, "Note": np.uint8, "Duration": np.float32,
+        "Velocity": np.uint8, "Instrument": np.uint8, "Channel": np.uint8,
+        "Track": np.uint8, "Tempo": np.float64, "Pan": np.uint8,
+        "Volume": np.uint8, "Expression": np.uint8
+    }
+
+    def __init__(self, data):
+        lengths = {len(values) for values in data.values()}
+        if len(lengths) > 1:
+            raise ValueError("All NoteTable columns must have the same length.")
+        self._data = {}
+        self.tempo_map = None
+        for name, values in data.items():
+            self[name] = values
+
+    def __len__(self):
+        if not self._data:
+            return 0
+        return len(next(iter(self._data.values())))
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def __getitem__(self, name):
+        return self._data[name]
+
+    def __delitem__(self, name):
+        del self._data[name]
+
+    def __setitem__(self, name, values):
+        dtype = self.dtypes.get(name)
+        if np.isscalar(values):
+            values = np.full(len(self), values, dtype=dtype)
+        else:
+            values = np.asarray(values, dtype=dtype)
+        if self._data and len(values) != len(self):
+            raise ValueError(f"Column {name} has length {len(values)}, expected {len(self)}.")
+        self._data[name] = values
+
+    def to_arrays(self):
+        '''
+        Returns the columns as a dict of NumPy arrays (without the tempo map).
+        '''
+        return dict(self._data)
+
+    def to_dataframe(self):
+        '''
+        Exports the table to a pandas DataFrame with the columns in MIDI CSV order.
+        '''
+        data = dict(self._data)
+        if "Tempo" not in data and self.tempo_map is not None:
+            data["Tempo"] = self.tempo_map.expand()
+        ordered = [name for name in self.columns if name in data]
+        ordered += [name for name in data if name not in self.columns]
+        #pandas is only loaded for a CSV/parquet export, the rest of the pipeline runs without it
+        import pandas as pd
+        return pd.DataFrame({name: data[name] for name in ordered})
+
+    def to_csv(self, path):
+        self.to_dataframe().to_csv(path, index=False)
+
+    def to_npz(self, path):
+        '''
+        Saves the typed columns to an uncompressed .npz file, one array per column.
+        A tempo map is stored as its change points. read_note_table() memory-maps the columns back.
+        '''
+        arrays = self.to_arrays()
+        if self.tempo_map is not None:
+            arrays["__tempo_positions"] = self.tempo_map.positions
+            arrays["__tempo_values"] = self.tempo_map.values
+        np.savez(path, **arrays)
+
+    def to_parquet(self, path):
+        try:
+            self.to_dataframe().to_parquet(path, index=False)
+        except ImportError as err:
+            raise ImportError(PARQUET_MISSING) from err
+
+    def save(self, path, output_format=None):
+        '''
+        Saves the table as csv, npz or parquet. The format defaults to the extension of path.
+        '''
+        output_format = output_format or os.path.splitext(path)[1].lstrip(".").lower()
+        if output_format not in TABLE_FORMATS:
+            raise ValueError(f"Unknown table format {output_format}, expected one of {', '.join(TABLE_FORMATS)}.")
+        getattr(self, f"to_{output_format}")(path)
+
+
+def read_note_table(path, mmap=True):
+    '''
+    Loads a NoteTable saved by NoteTable.save.
+    The columns of an .npz file are memory-mapped (read-only) unless mmap is False, parquet and csv files are read with pandas.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npz":
+        arrays = _map_npz(path) if mmap else dict(np.load(path))
+        tempo_positions = arrays.pop("__tempo_positions", None)
+        tempo_values = arrays.pop("__tempo_values", None)
+        table = NoteTable(arrays)
+        if tempo_positions is not None:
+            from packages.get_tempo import TempoMap
+            table.tempo_map = TempoMap(tempo_positions, tempo_values, len(table))
+        return table
+    import pandas as pd
+    if extension == ".parquet":
+        df = pd.read_parquet(path, memory_map=mmap)
+    else:
+        df = pd.read_csv(path)
+    return NoteTable({name: df[name].to_numpy() for name in df.columns})
+
+
+def _map_npz(path):
+    #Memory-maps every member of an uncompressed .npz file, the .npy data of a stored member is a plain byte range of the file
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as file:
+        for info in archive.infolist():
+            name = info.filename[:-len(".npy")] if info.filename.endswith(".npy") else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", file.read(4))
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+            if 0 in shape:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(file.name, dtype=dtype, mode="r", offset=file.tell(), shape=shape,
+                                     order="F" if fortran_order else "C")
+    return arrays
+
 
 class AAToMidiCSV:
     '''
@@ -15,63 +182,57 @@ class AAToMidiCSV:
     Time, Note, Duration, Velocity, Instrument, Channel, Track, Tempo, Pan, Volume, Expression
     The Time column is the cumulative time for each note, starting from 0.0.
     '''
+    aa_to_midi = {
+        'A': 60, 'C': 62, 'D': 64, 'E': 65, 'F': 67, 'G': 69, 'H': 71,
+        'I': 60, 'K': 62, 'L': 64, 'M': 65, 'N': 67, 'P': 69, 'Q': 71,
+        'R': 60, 'S': 62, 'T': 64, 'V': 65, 'W': 67, 'Y': 69, '*': 0
+    }
+    defaults = {
+        "Velocity": 63, "Instrument": 1, "Channel": 0, "Track": 0,
+        "Tempo": 120, "Pan": 64, "Volume": 100, "Expression": 80,
+        "Duration": 1.0
+    }
+    # Lookup table indexed by the amino acid byte, unknowns default to C4.
+    # Built once for the class, so a long-running server does not rebuild it for every sequence.
+    note_lookup = np.full(256, 60, dtype=np.uint8)
+    for aa, note in aa_to_midi.items():
+        note_lookup[ord(aa)] = note
+    del aa, note
+
     def __init__(self, aa_sequence, csv_out="output.csv"):
         self.aa_sequence = aa_sequence.upper()
         self.csv_out = csv_out
-        self.aa_to_midi = {
-            'A': 60, 'C': 62, 'D': 64, 'E': 65, 'F': 67, 'G': 69, 'H': 71,
-            'I': 60, 'K': 62, 'L': 64, 'M': 65, 'N': 67, 'P': 69, 'Q': 71,
-            'R': 60, 'S': 62, 'T': 64, 'V': 65, 'W': 67, 'Y': 69, '*': 0
-        }
-        self.defaults = {
-            "Velocity": 63, "Instrument": 1, "Channel": 0, "Track": 0,
-            "Tempo": 120, "Pan": 64, "Volume": 100, "Expression": 80,
-            "Duration": 1.0
-        }
 
-    def convert_to_midi_rows(self):
+    def convert_to_note_table(self):
         '''
-        Converts the amino acid sequence to MIDI rows.
+        Converts the amino acid sequence to a NoteTable.
         Each row corresponds to a note in the MIDI format.
         The Time column is the cumulative time for each note, starting from 0.0.
         Sets the default values for the MIDI parameters.
-        The output is a list of dictionaries, each representing a row in the CSV.
         '''
-        time = 0.0
-        data = []
-        #for every amino acid in the sequence, get the corresponding MIDI note
-        # and create a row with the default values
-        for aa in self.aa_sequence:
-            note = self.aa_to_midi.get(aa, 60)  # Default to C4 for unknowns
-            row = {
-                "Time": time,
-                "Note": note,
-                "Duration": self.defaults["Duration"],
-                "Velocity": self.defaults["Velocity"],
-                "Instrument": self.defaults["Instrument"],
-                "Channel": self.defaults["Channel"],
-                "Track": self.defaults["Track"],
-                "Tempo": self.defaults["Tempo"],
-                "Pan": self.defaults["Pan"],
-                "Volume": self.defaults["Volume"],
-                "Expression": self.defaults["Expression"]
-            }
-            data.append(row)
-            time += self.defaults["Duration"]
-        return data
-
-    def process(self, save=True):
+        codes = np.frombuffer(self.aa_sequence.encode("ascii"), dtype=np.uint8)
+        n = len(codes)
+        duration = self.defaults["Duration"]
+        data = {
+            "Time": np.arange(n, dtype=np.float64) * duration,
+            "Note": self.note_lookup[codes],
+        }
+        for name in NoteTable.columns:
+            if name not in data:
+                data[name] = np.full(n, self.defaults[name], dtype=NoteTable.dtypes[name])
+        return NoteTable(data)
+
+    def process(self, save=True, output_format="csv"):
         '''
         Processes the amino acid sequence and converts it to MIDI CSV format.
+        With output_format "npz" or "parquet" the table is saved in that binary format instead.
         '''
-        # Convert the amino acid sequence to MIDI rows
+        # Convert the amino acid sequence to a note table
         if not self.aa_sequence:
-            raise ValueError("Amino acid sequence is empty. Please provide a valid sequence.")      
-        rows = self.convert_to_midi_rows()
-        df = pd.DataFrame(rows)
-        
-        # Reorder columns to match MIDI CSV format
+            raise ValueError("Amino acid sequence is empty. Please provide a valid sequence.")
+        table = self.convert_to_note_table()
+
         if save:
-            df.to_csv(self.csv_out, index=False)
-            print(f"CSV exported to {self.csv_out}")
-        return df
+            table.save(self.csv_out, output_format)
+            print(f"{output_format.upper()} exported to {self.csv_out}")
+        return table
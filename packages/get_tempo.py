@@ -1,43 +1,165 @@
-def tempo_inator(translatedsequences):
+import numpy as np
 
-    """This function takes in a string and creates a list with values that are going to be used as multipliers to
-        affect the base tempo of the music."""
+#Tempo multiplier for each residue of a repeat run, and the global multiplier that compounds with every repeat until a stop codon
+MULTIPLIER = 1.15
+GLOBAL_MULTIPLIER = 1.05
+
+class TempoMap:
+
+    """Tempo values stored as change points only.
+       values[k] applies from note positions[k] up to the next change point, for 'length' notes in total."""
+
+    def __init__(self, positions, values, length):
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.length = length
+
+    def __len__(self):
+        return len(self.positions)
+
+    @classmethod
+    def from_values(cls, values):
+        """Builds a TempoMap from per-note values, keeping only the notes where the value changes."""
+        values = np.asarray(values, dtype=np.float64)
+        change = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1]))) if len(values) else np.empty(0, dtype=np.int64)
+        return cls(change, values[change], len(values))
+
+    def scaled(self, base_tempo):
+        """Returns a new TempoMap with every value multiplied by base_tempo, e.g. to turn multipliers into beats per minute."""
+        return TempoMap(self.positions, base_tempo * self.values, self.length)
+
+    def multiplied(self, other):
+        """Returns a new TempoMap with the values of this map and another one of the same length multiplied note by note."""
+        positions = np.union1d(self.positions, other.positions)
+        values = self.values_at(positions) * other.values_at(positions)
+        change = np.concatenate(([True], values[1:] != values[:-1])) if len(values) else np.empty(0, dtype=bool)
+        return TempoMap(positions[change], values[change], self.length)
+
+    def values_at(self, index):
+        """Returns the values at the given note positions."""
+        return self.values[np.searchsorted(self.positions, index, side="right") - 1]
+
+    def expand(self, start=0, stop=None):
+        """Returns the per-note values for notes start:stop as an array."""
+        stop = self.length if stop is None else min(stop, self.length)
+        return self.values_at(np.arange(start, stop, dtype=np.int64))
+
+def tempo_block(tempos, block, first_note=0):
+
+    """Returns the tempos of the notes in 'block' (a slice) as a float64 array, from a per-note Tempo column or a TempoMap.
+       A TempoMap is indexed from first_note on, for writers that get the notes of a longer song in blocks. None stays None."""
+
+    if tempos is None:
+        return None
+    if hasattr(tempos, "expand"):
+        return tempos.expand(first_note + block.start, first_note + block.stop)
+    return np.asarray(tempos[block], dtype=np.float64)
+
+def tempo_map_inator(translatedsequences, multiplier=MULTIPLIER, globalmultiplier=GLOBAL_MULTIPLIER):
+
+    """Computes the tempo multipliers of tempo_inator with run-length array operations and returns them as a TempoMap.
+       Only the positions where the multiplier can change are evaluated: repeats, the residue after a repeat and stop codons."""
+
+    return tempo_maps_inator(translatedsequences, [(multiplier, globalmultiplier)])[0]
+
+def tempo_maps_inator(translatedsequences, multipliers):
+
+    """Returns one TempoMap per (multiplier, globalmultiplier) pair, e.g. for a parameter sweep.
+       The repeat runs and stop codons only depend on the sequence, so they are found once for all pairs."""
 
     #First test whether the input is a string
     if not isinstance(translatedsequences, str):
         raise TypeError("The input must be a string.")
-    
-    
-    else:
-        #Sets a few variables to be used as counters and multipliers
-        counter = 1
-        multiplier = 1.15
-        globalmultiplier = 1.05
-        globalmultipliercounter = 1
-        tempo = []
-
-        #Interates through the string sequence to check for repeats
-        for x in enumerate(translatedsequences):
-            
-            #The first index is accounted for
-            if x[0] == 0:
-                a = translatedsequences[x[0]]
-                tempo.append(counter)
-            
-            #Checks a window of size two for repeats, if there is, increases the counters
-            else:
-                a = translatedsequences[x[0]-1]
-                b = translatedsequences[x[0]]
-
-                if x[1] == "*": #This is a multiplier that occurs for each instance of a repeat, and resets when there is a stop codon
-                    globalmultipliercounter=1
-                if a==b:
-                    #Each instance of a repeat makes it faster and resets when the repeat breaks
-                    globalmultipliercounter*=globalmultiplier
-                    tempo.append(counter*multiplier*globalmultipliercounter)
-                    counter+=1
-                else:
-                    #Reset regular counter
-                    counter = 1
-                    tempo.append(counter*globalmultipliercounter)
-        return tempo
+
+    codes = np.frombuffer(translatedsequences.encode("ascii"), dtype=np.uint8)
+    length = len(codes)
+    if length == 0:
+        return [TempoMap([], [], 0) for _ in multipliers]
+
+    #A repeat is a residue equal to the one before it, a stop codon (not at the first index) resets the global multiplier
+    repeats = np.flatnonzero(codes[1:] == codes[:-1]) + 1
+    resets = np.flatnonzero(codes[1:] == ord("*")) + 1
+
+    after_repeats = repeats + 1
+    candidates = np.unique(np.concatenate(([0], repeats, after_repeats[after_repeats < length], resets)))
+
+    #Number of global multiplications since the last reset, counted with the repeats up to each candidate
+    repeats_so_far = np.searchsorted(repeats, candidates, side="right")
+    repeats_before_reset = np.concatenate(([0], np.searchsorted(repeats, resets, side="left")))
+    last_reset = np.searchsorted(resets, candidates, side="right")
+    compounded = repeats_so_far - repeats_before_reset[last_reset]
+
+    #Inside a run the counter is the distance to the first residue of the run
+    if len(repeats):
+        slot = np.minimum(np.searchsorted(repeats, candidates), len(repeats) - 1)
+        is_repeat = repeats[slot] == candidates
+        new_run = np.concatenate(([True], np.diff(repeats) != 1))
+        run_start = repeats[np.maximum.accumulate(np.where(new_run, np.arange(len(repeats)), 0))] - 1
+        counter = candidates - run_start[slot]
+
+    tempomaps = []
+    for multiplier, globalmultiplier in multipliers:
+        #Powers are built by repeated multiplication, so the values are exactly those of the original loop
+        powers = np.cumprod(np.concatenate(([1.0], np.full(int(compounded.max()), globalmultiplier))))
+        values = powers[compounded]
+        if len(repeats):
+            values = np.where(is_repeat, counter * multiplier * values, values)
+
+        #Keeps the change points only
+        change = np.concatenate(([True], values[1:] != values[:-1]))
+        tempomaps.append(TempoMap(candidates[change], values[change], length))
+    return tempomaps
+
+class TempoStream:
+
+    """Computes the same multipliers as tempo_map_inator for a sequence that arrives in chunks.
+       The state that crosses a chunk boundary is carried over: the last residue, where the current repeat run started,
+       how many repeats were counted since the last stop codon, and the powers of the global multiplier made so far."""
+
+    def __init__(self, multiplier=MULTIPLIER, globalmultiplier=GLOBAL_MULTIPLIER):
+        self.multiplier = multiplier
+        self.globalmultiplier = globalmultiplier
+        self.position = 0
+        self.last_code = -1
+        self.run_start = 0
+        self.compounded = 0
+        self.powers = np.ones(1)
+
+    def feed(self, translatedsequences):
+        """Returns the multipliers of the next chunk of residues as an array."""
+        codes = np.frombuffer(translatedsequences.encode("ascii"), dtype=np.uint8).astype(np.int64)
+        if len(codes) == 0:
+            return np.empty(0)
+        index = np.arange(self.position, self.position + len(codes), dtype=np.int64)
+        previous = np.concatenate(([self.last_code], codes[:-1]))
+        is_repeat = codes == previous
+        is_reset = (codes == ord("*")) & (index > 0)
+
+        #Repeats counted since the last stop codon (a stop codon that repeats the residue before it counts itself)
+        repeats = np.cumsum(is_repeat)
+        reset_base = np.concatenate(([-self.compounded], (repeats - is_repeat)[is_reset]))
+        compounded = repeats - reset_base[np.cumsum(is_reset)]
+
+        #Powers are extended by repeated multiplication, so they are exactly those of tempo_map_inator
+        needed = int(compounded.max()) + 1
+        if needed > len(self.powers):
+            more = np.cumprod(np.concatenate(([self.powers[-1]], np.full(needed - len(self.powers), self.globalmultiplier))))
+            self.powers = np.concatenate((self.powers, more[1:]))
+        values = self.powers[compounded]
+
+        #Inside a run the counter is the distance to the first residue of the run
+        run_start = np.maximum.accumulate(np.concatenate(([self.run_start], np.where(is_repeat, -1, index))))[1:]
+        values = np.where(is_repeat, (index - run_start) * self.multiplier * values, values)
+
+        self.position += len(codes)
+        self.last_code = int(codes[-1])
+        self.run_start = int(run_start[-1])
+        self.compounded = int(compounded[-1])
+        return values
+
+def tempo_inator(translatedsequences):
+
+    """This function takes in a string and creates an array with values that are going to be used as multipliers to
+        affect the base tempo of the music."""
+
+    return tempo_map_inator(translatedsequences).expand()
@@ -2,6 +2,8 @@
 Dictionaries to connect different note values to amino acids and their weights.
 The note values are based on MIDI note numbers, and the amino acid size are used to determine the duration of each note.
 """
+import numpy as np
+
 note_to_aa = {
     60: 'X',  # Default or unknown
     61: 'R', 62: 'N', 63: 'D', 64: 'C', 65: 'E', 66: 'Q', 67: 'G',
@@ -36,4 +38,33 @@ def map_note_to_duration(note):
 # Pitch mapping function (0 = rest)
 def map_note_to_pitch(note):
     aa = note_to_aa.get(note, 'X')
-    return 0 if aa == 'X' or aa == '*' else note
\ No newline at end of file
+    return 0 if aa == 'X' or aa == '*' else note
+
+# Lookup arrays indexed by MIDI note number (0-127), built once from the functions above
+note_duration_lookup = np.array([map_note_to_duration(note) for note in range(128)], dtype=np.float32)
+note_pitch_lookup = np.array([map_note_to_pitch(note) for note in range(128)], dtype=np.uint8)
+
+# Batch duration mapping, works on a whole array of notes at once
+def map_notes_to_durations(notes):
+    return note_duration_lookup[np.asarray(notes, dtype=np.intp)]
+
+# Batch pitch mapping (0 = rest)
+def map_notes_to_pitches(notes):
+    return note_pitch_lookup[np.asarray(notes, dtype=np.intp)]
+
+# Timeline from the note durations
+def compute_timeline(durations, ticks_per_unit=None):
+    """
+    Returns the start time of every note, the cumulative sum of the durations before it.
+    When ticks_per_unit is given, the durations are also quantized to integer MIDI ticks
+    (truncated, like int()) and (times, start_ticks, duration_ticks) is returned instead.
+    """
+    durations = np.asarray(durations, dtype=np.float64)
+    times = np.zeros(len(durations), dtype=np.float64)
+    np.cumsum(durations[:-1], out=times[1:])
+    if ticks_per_unit is None:
+        return times
+    duration_ticks = (durations * ticks_per_unit).astype(np.int64)
+    start_ticks = np.zeros(len(durations), dtype=np.int64)
+    np.cumsum(duration_ticks[:-1], out=start_ticks[1:])
+    return times, start_ticks, duration_ticks
@@ -1,26 +1,60 @@
 #!/usr/bin/env python3
-import pandas as pd
+import numpy as np
+
+def find_orfs(aa_sequence, min_length=0, policy="outermost"):
+    """
+    Finds open reading frames (ORFs) in an amino acid sequence in one linear pass.
+    An ORF starts with 'M' and ends at the next '*', with no '*' in between.
+    Returns two int64 arrays, the start and end (inclusive) positions of every ORF.
+
+    min_length is the smallest ORF (start to stop, both included) that is kept.
+    policy decides what happens with several 'M's before the same '*':
+    "outermost" keeps only the first one, so ORFs never overlap (the map_pitch behaviour),
+    "nested" keeps every one, giving nested ORFs that share their stop.
+    """
+    if policy not in ("outermost", "nested"):
+        raise ValueError(f"Unknown ORF policy {policy}, expected 'outermost' or 'nested'.")
+
+    codes = np.frombuffer(aa_sequence.encode("ascii"), dtype=np.uint8)
+    stops = np.flatnonzero(codes == ord('*'))
+    starts = np.flatnonzero(codes == ord('M'))
+
+    #Index of the first stop after every start, starts without a stop after them are not ORFs
+    next_stop = np.searchsorted(stops, starts)
+    closed = next_stop < len(stops)
+    starts, next_stop = starts[closed], next_stop[closed]
+
+    if policy == "outermost":
+        #All starts between the same two stops share one ORF, the first start wins
+        next_stop, first = np.unique(next_stop, return_index=True)
+        starts = starts[first]
+
+    ends = stops[next_stop]
+    keep = ends - starts + 1 >= min_length
+    return starts[keep], ends[keep]
+
+def shift_orf_pitch(notes, starts, ends, step=1, stack=False):
+    """
+    Lowers every note inside the ORF intervals by 'step', rests (note 0) are left alone.
+    All intervals are applied in one pass with a difference array.
+    With stack=True a note inside several nested ORFs is lowered once per ORF.
+    Returns the shifted notes as a new array with the dtype of 'notes'.
+    """
+    notes = np.asarray(notes)
+    coverage = np.zeros(len(notes) + 1, dtype=np.int64)
+    np.add.at(coverage, starts, 1)
+    np.add.at(coverage, np.asarray(ends) + 1, -1)
+    depth = np.cumsum(coverage[:-1])
+    if not stack:
+        depth = np.minimum(depth, 1)
+    shift = np.where(notes != 0, depth * step, 0)
+    return np.clip(notes.astype(np.int64) - shift, 0, 127).astype(notes.dtype)
 
 def map_pitch(aa_sequence):
     """
     Identifies non-overlapping open reading frames (ORFs) in an amino acid sequence.
     An ORF starts with 'M' and ends with '*', with no '*' in between.
+    Returns a list of (start, end) tuples.
     """
-    orfs = []
-    used_positions = set()
-    i = 0
-
-    while i < len(aa_sequence):
-        if aa_sequence[i] == 'M' and i not in used_positions:
-            for j in range(i + 1, len(aa_sequence)):
-                if aa_sequence[j] == '*':
-                    if '*' not in aa_sequence[i+1:j]:
-                        # Check if any position in this ORF is already used
-                        if not any(pos in used_positions for pos in range(i, j+1)):
-                            orfs.append((i, j))
-                            used_positions.update(range(i, j+1))  # Mark as used
-                            i = j  # Jump to end of this ORF
-                    break
-        i += 1
-
-    return orfs
\ No newline at end of file
+    starts, ends = find_orfs(aa_sequence)
+    return list(zip(starts.tolist(), ends.tolist()))
@@ -0,0 +1,313 @@
+import struct
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from packages.get_tempo import tempo_block
+
+'''
+Writes Standard MIDI Files straight from note arrays.
+Events are encoded with NumPy into a byte buffer (delta times as variable-length quantities,
+running status for repeated channel messages) and streamed into the track chunk on disk.
+The track length is patched into the chunk header when the writer is closed.
+The event building lives in MidiEventWriter, so the same events can also be sent to other sinks
+(see streaming.py, which plays them on a MIDI port or prints them).
+'''
+
+PERCUSSION_CHANNEL = 9
+
+# Event kinds, in the order they are written when they fall on the same tick
+_NOTE_OFF, _SET_TEMPO, _PROGRAM_CHANGE, _NOTE_ON = 0, 1, 2, 3
+
+
+class MidiEventWriter(ABC):
+    '''
+    Turns blocks of notes into sorted MIDI event columns and hands them to _write().
+    Notes are added in blocks with add_notes() and must come in order of their start tick.
+    Tempo changes are coalesced into set_tempo meta events, and a program_change is only sent
+    when the instrument of a channel changes. On the percussion channel (9) the Instrument
+    column already holds a General MIDI drum key, so it is played as the note number instead.
+    Events are only handed on once no later note can come before them, so a writer can be fed
+    a song block by block (see streaming.py) and produces the same events as one big block.
+    '''
+    block_size = 1 << 16
+
+    def __init__(self, ticks_per_beat=480):
+        self.ticks_per_beat = ticks_per_beat
+        self.reset()
+
+    def reset(self):
+        '''Forgets the notes, tempo and programs written so far, to start a new track.'''
+        self.notes_written = 0
+        self._last_tempo = -1
+        self._last_program = np.full(16, -1, dtype=np.int16)
+        self._pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def add_notes(self, notes, velocities, start_ticks, duration_ticks,
+                  channels=None, instruments=None, tempos=None):
+        '''
+        Adds a block of notes. channels defaults to 0, instruments (1-based General MIDI
+        program numbers, or drum keys on channel 9) default to 1, and tempos (beats per minute)
+        default to none, which leaves the MIDI default of 120 bpm. tempos can also be a
+        TempoMap covering the whole song, indexed by the position of the note in the song.
+        '''
+        count = len(notes)
+        first_note = self.notes_written
+        if channels is None:
+            channels = np.zeros(count, dtype=np.uint8)
+        if instruments is None:
+            instruments = np.ones(count, dtype=np.uint8)
+        for start in range(0, count, self.block_size):
+            block = slice(start, start + self.block_size)
+            self._add_block(
+                np.asarray(notes[block], dtype=np.int64),
+                np.asarray(velocities[block], dtype=np.int64),
+                np.asarray(start_ticks[block], dtype=np.int64),
+                np.asarray(duration_ticks[block], dtype=np.int64),
+                np.asarray(channels[block], dtype=np.int64),
+                np.asarray(instruments[block], dtype=np.int64),
+                tempo_block(tempos, block, first_note),
+            )
+
+    def _add_block(self, notes, velocities, starts, durations, channels, instruments, tempos):
+        count = len(notes)
+        if count == 0:
+            return
+        index = np.arange(self.notes_written, self.notes_written + count, dtype=np.int64)
+        self.notes_written += count
+        channels = channels & 0x0F
+        drums = channels == PERCUSSION_CHANNEL
+        notes = np.where(drums, instruments, notes) & 0x7F
+        velocities = np.clip(velocities, 0, 127)
+
+        events = [
+            _events(starts + durations, _NOTE_OFF, index, 0x80 | channels, notes, np.zeros(count, np.int64)),
+            _events(starts, _NOTE_ON, index, 0x90 | channels, notes, velocities),
+        ]
+
+        if tempos is not None:
+            # set_tempo holds microseconds per beat, only sent when it changes
+            micros = np.clip(np.round(60_000_000 / tempos), 1, 0xFFFFFF).astype(np.int64)
+            previous = np.concatenate(([self._last_tempo], micros[:-1]))
+            change = np.flatnonzero(micros != previous)
+            self._last_tempo = int(micros[-1])
+            events.append(_events(starts[change], _SET_TEMPO, index[change], np.full(len(change), 0xFF),
+                                  np.full(len(change), 0x51), np.full(len(change), 3),
+                                  micros[change] >> 16 & 0xFF, micros[change] >> 8 & 0xFF, micros[change] & 0xFF))
+
+        programs = np.clip(instruments - 1, 0, 127)
+        for channel in np.unique(channels[~drums]).tolist():
+            on_channel = np.flatnonzero((channels == channel) & ~drums)
+            channel_programs = programs[on_channel]
+            previous = np.concatenate(([self._last_program[channel]], channel_programs[:-1]))
+            change = on_channel[channel_programs != previous]
+            self._last_program[channel] = channel_programs[-1]
+            events.append(_events(starts[change], _PROGRAM_CHANGE, index[change],
+                                  0xC0 | channels[change], programs[change]))
+
+        if self._pending is not None:
+            events.append(self._pending)
+        events = {key: np.concatenate([event[key] for event in events]) for key in events[0]}
+        order = np.lexsort((events["kind"], events["index"], events["kind"] != _NOTE_OFF, events["tick"]))
+        events = {key: values[order] for key, values in events.items()}
+
+        # Later notes start at or after the last start of this block, so everything before it is final
+        ready = events["tick"] < starts[-1]
+        self._pending = {key: values[~ready] for key, values in events.items()}
+        self._write({key: values[ready] for key, values in events.items()})
+
+    @abstractmethod
+    def _write(self, events):
+        '''Handles a block of sorted event columns (see _events), every subclass writes or sends them.'''
+
+    def flush_pending(self):
+        '''Hands on the events that were held back for later notes, call it once no more notes come.'''
+        if self._pending is not None:
+            self._write(self._pending)
+            self._pending = None
+
+    def close(self):
+        self.flush_pending()
+
+
+class MidiTrackWriter(MidiEventWriter):
+    '''
+    Streams note events into a MIDI file, one track at a time (a single track unless tracks is given,
+    call next_track() to move on to the next one).
+    The events are encoded with running status and appended to the track chunk, and the
+    track length is patched into the chunk header by flush() and close().
+    '''
+    def __init__(self, path, ticks_per_beat=480, tracks=1):
+        super().__init__(ticks_per_beat)
+        self.path = path
+        self.tracks = tracks
+        self.tracks_started = 0
+        self.file = open(path, "wb")
+        self.file.write(b"MThd" + struct.pack(">IHHH", 6, 1, tracks, ticks_per_beat))
+        self._start_track()
+
+    def _start_track(self):
+        self.file.write(b"MTrk")
+        self._length_offset = self.file.tell()
+        self.file.write(b"\x00\x00\x00\x00")
+        self.track_length = 0
+        self._last_tick = 0
+        self._running_status = -1
+        self.tracks_started += 1
+
+    def _end_track(self):
+        self.flush_pending()
+        # End of track meta event
+        end_of_track = b"\x00\xff\x2f\x00"
+        self.file.write(end_of_track)
+        self.track_length += len(end_of_track)
+        self._patch_length()
+
+    def next_track(self):
+        '''Ends the current track and starts the next one, its ticks start at 0 again.'''
+        if self.tracks_started >= self.tracks:
+            raise ValueError(f"The file was opened with {self.tracks} tracks.")
+        self._end_track()
+        self.reset()
+        self._start_track()
+
+    def _write(self, events):
+        if len(events["tick"]) == 0:
+            return
+        data, self._last_tick, self._running_status = _encode_events(events, self._last_tick, self._running_status)
+        self.file.write(data)
+        self.track_length += len(data)
+
+    def _patch_length(self):
+        position = self.file.tell()
+        self.file.seek(self._length_offset)
+        self.file.write(struct.pack(">I", self.track_length))
+        self.file.seek(position)
+
+    def flush(self):
+        '''
+        Patches the length of the events written so far into the track header and flushes the file,
+        so a file that is still growing can already be read (it only lacks the end of track event).
+        '''
+        self._patch_length()
+        self.file.flush()
+
+    def close(self):
+        '''Flushes the remaining events, ends the track and patches the track length.
+        Tracks that were never started are written empty, so the file always holds as many tracks as its header says.'''
+        if self.file.closed:
+            return
+        self._end_track()
+        while self.tracks_started < self.tracks:
+            self._start_track()
+            self._end_track()
+        self.file.close()
+
+
+def event_messages(events):
+    '''Yields (tick, message bytes) for sorted event columns, with the full status byte on every message.'''
+    data = events["data"]
+    for tick, status, size, row in zip(events["tick"].tolist(), events["status"].tolist(),
+                                       events["size"].tolist(), range(len(data))):
+        yield tick, bytes([status]) + data[row, :size].tobytes()
+
+
+def _events(ticks, kind, index, status, *body):
+    '''Builds a dict of event columns, body holds up to 5 data bytes per event.'''
+    count = len(ticks)
+    data = np.zeros((count, 5), dtype=np.uint8)
+    for column, values in enumerate(body):
+        data[:, column] = values
+    return {
+        "tick": np.asarray(ticks, dtype=np.int64),
+        "kind": np.full(count, kind, dtype=np.int64),
+        "index": np.asarray(index, dtype=np.int64),
+        "status": np.asarray(status, dtype=np.int64) + np.zeros(count, dtype=np.int64),
+        "data": data,
+        "size": np.full(count, len(body), dtype=np.int64),
+    }
+
+
+def _encode_events(events, last_tick, running_status):
+    '''
+    Encodes sorted events into bytes.
+    Returns the bytes, the tick of the last event and the running status after it.
+    '''
+    ticks = events["tick"]
+    status = events["status"]
+    size = events["size"]
+    deltas = np.diff(ticks, prepend=last_tick)
+    if deltas.max() > 0x0FFFFFFF:
+        raise ValueError("MIDI delta times must fit in 28 bits.")
+
+    # Variable-length quantity: 7 bits per byte, high bit set on all but the last byte
+    vlq_size = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+    # Channel messages that repeat the previous status byte drop it, meta events reset running status
+    channel_message = status < 0xF0
+    previous_status = np.concatenate(([running_status], np.where(channel_message, status, -1)[:-1]))
+    write_status = ~(channel_message & (status == previous_status))
+
+    lengths = vlq_size + write_status + size
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    data = np.zeros(int(lengths.sum()), dtype=np.uint8)
+
+    for byte in range(4):
+        has_byte = vlq_size > byte
+        shift = 7 * (vlq_size[has_byte] - 1 - byte)
+        value = (deltas[has_byte] >> shift) & 0x7F
+        value |= np.where(byte < vlq_size[has_byte] - 1, 0x80, 0)
+        data[offsets[has_byte] + byte] = value
+
+    body = offsets + vlq_size
+    data[body[write_status]] = status[write_status]
+    body += write_status
+    for column in range(5):
+        has_column = size > column
+        data[body[has_column] + column] = events["data"][has_column, column]
+
+    last_status = int(status[-1]) if channel_message[-1] else -1
+    return data.tobytes(), int(ticks[-1]), last_status
+
+
+def write_midi(path, notes, velocities, start_ticks, duration_ticks, channels=None,
+               instruments=None, tempos=None, ticks_per_beat=480):
+    '''Writes one track of notes to a MIDI file at path.'''
+    with MidiTrackWriter(path, ticks_per_beat) as writer:
+        writer.add_notes(notes, velocities, start_ticks, duration_ticks, channels, instruments, tempos)
+    return path
+
+
+def write_note_table(path, table, start_ticks, duration_ticks, ticks_per_beat=480):
+    '''
+    Writes a NoteTable (or DataFrame) to a MIDI file, using its Note, Velocity, Channel,
+    Instrument and Tempo columns (or tempo map) and the given start and duration ticks.
+    '''
+    return write_midi(path, table['Note'], table['Velocity'], start_ticks, duration_ticks,
+                      table['Channel'], table['Instrument'], table_tempos(table), ticks_per_beat)
+
+
+def write_note_tables(path, tracks, ticks_per_beat=480):
+    '''
+    Writes several NoteTables to one MIDI file, one track each. tracks is a list of
+    (table, start_ticks, duration_ticks). Tempo events apply to every track of a MIDI file,
+    so only the tempo of the first table is written and the other tracks follow it.
+    '''
+    with MidiTrackWriter(path, ticks_per_beat, len(tracks)) as writer:
+        for number, (table, start_ticks, duration_ticks) in enumerate(tracks):
+            if number:
+                writer.next_track()
+            writer.add_notes(table['Note'], table['Velocity'], start_ticks, duration_ticks,
+                             table['Channel'], table['Instrument'], table_tempos(table) if number == 0 else None)
+    return path
+
+
+def table_tempos(table):
+    '''Returns the tempo of a NoteTable (or DataFrame): its Tempo column, its tempo map, or None.'''
+    return table['Tempo'] if 'Tempo' in table else getattr(table, 'tempo_map', None)
@@ -1,7 +1,8 @@
-import matplotlib.pyplot as plt
 import os
+
+import numpy as np
 '''
-Takes a MIDI DataFrame and an optional GC profile, and generates various plots.
+Takes a MIDI note table (NoteTable or DataFrame) and an optional GC profile, and generates various plots.
 the plots include:
 1. Distribution of notes
 2. Velocity over time
@@ -12,79 +13,163 @@ the plots include:
 7. GC content profile (if provided)
 Outputs the plots to the specified directory.
 
+The plots are drawn with the non-interactive Agg canvas in a separate process, so matplotlib does not hold
+the GIL while the render goes on. Only the small summary of the table is sent to that process.
+Line plots are decimated to at most 'pixel_budget' points (the minimum and maximum of every bucket are kept,
+so peaks stay visible), and bar charts are drawn from bincounts, so the plotting cost no longer grows
+with the length of the sequence.
+matplotlib is only imported when the first plot is drawn, so runs with --no-plots never load it.
 '''
 
-def plot_music_data(df, gc_profile=None, output_dir='example_file_and_output'):
+#Default number of points kept for every line plot
+PIXEL_BUDGET = 2000
+#Values read at a time when looking for the first occurrence of every bar
+_BLOCK_SIZE = 1 << 16
+
+
+def minmax_decimate(x, y, pixel_budget=PIXEL_BUDGET):
+    """
+    Reduces a line to about pixel_budget points, keeping the minimum and maximum of every bucket in order.
+    Returns the decimated x and y arrays (unchanged when the line is already short enough).
+    """
+    y = np.asarray(y)
+    x = np.arange(len(y)) if x is None else np.asarray(x)
+    if len(y) <= pixel_budget:
+        return x, y
+    bucket = -(-len(y) // max(pixel_budget // 2, 1))
+    buckets = -(-len(y) // bucket)
+    padded = np.pad(y, (0, buckets * bucket - len(y)), mode="edge").reshape(buckets, bucket)
+    offsets = np.arange(buckets) * bucket
+    keep = np.concatenate((offsets + padded.argmin(axis=1), offsets + padded.argmax(axis=1)))
+    keep = np.unique(np.minimum(keep, len(y) - 1))
+    return x[keep], y[keep]
+
+
+def _counts(values, scale=1):
+    #Bincount of the (scaled) values, returns the values that occur and how often
+    values = np.asarray(values)
+    codes = np.rint(values * scale).astype(np.int64) if scale != 1 else values.astype(np.int64)
+    counts = np.bincount(codes - codes.min()) if len(codes) else np.zeros(0, dtype=np.int64)
+    present = np.flatnonzero(counts)
+    return (present + (codes.min() if len(codes) else 0)) / scale, counts[present]
+
+
+def _by_count(values, counts, column):
+    #Orders the bars like pandas value_counts(): most frequent first, ties in the order they first occur
+    column = np.asarray(column)
+    first = {}
+    for start in range(0, len(column), _BLOCK_SIZE):
+        block = column[start:start + _BLOCK_SIZE]
+        for value in np.unique(block).tolist():
+            if value not in first:
+                first[value] = start + int(np.argmax(block == value))
+        #Usually every value shows up in the first blocks
+        if len(first) == len(values):
+            break
+    order = np.lexsort((np.array([first[value] for value in values.tolist()]), -counts))
+    return values[order], counts[order]
+
+
+def summarize_music_data(table, gc_profile=None, pixel_budget=PIXEL_BUDGET):
+    """
+    Precomputes everything the plots need as small arrays: bincounts for the bar charts and
+    decimated lines for the plots over time. This is the only step that reads the full table.
+    """
+    time = np.asarray(table['Time'])
+    summary = {
+        'notes': _counts(table['Note']),
+        'durations': _counts(table['Duration'], scale=4),
+        'instruments': _by_count(*_counts(table['Instrument']), table['Instrument']),
+        'channels': _by_count(*_counts(table['Channel']), table['Channel']),
+        'velocity': minmax_decimate(time, table['Velocity'], pixel_budget),
+        'pitch': minmax_decimate(time, table['Note'], pixel_budget),
+        'gc': None if gc_profile is None else minmax_decimate(None, gc_profile, pixel_budget),
+    }
+    return summary
+
+
+def _figure():
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def _bar(values, counts, xlabel, title, path, labels=None):
+    figure = _figure()
+    axes = figure.add_subplot()
+    positions = np.arange(len(values))
+    axes.bar(positions, counts)
+    axes.set_xticks(positions)
+    axes.set_xticklabels(labels if labels is not None else [f"{value:g}" for value in values], rotation=90)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel('Count')
+    axes.set_title(title)
+    figure.tight_layout()
+    figure.savefig(path)
+
+
+def _line(x, y, xlabel, ylabel, title, path):
+    figure = _figure()
+    axes = figure.add_subplot()
+    axes.plot(x, y)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel(ylabel)
+    axes.set_title(title)
+    figure.tight_layout()
+    figure.savefig(path)
+
+
+def render_plots(summary, output_dir='example_file_and_output'):
+    """Draws the plots of a summary made by summarize_music_data and saves them to output_dir."""
     # Make sure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
     # 1. Note distribution
-    plt.figure()
-    df['Note'].value_counts().sort_index().plot(kind='bar')
-    plt.xlabel('MIDI Note')
-    plt.ylabel('Count')
-    plt.title('Distribution of Notes')
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'note_distribution.png'))
-    plt.close()
+    _bar(*summary['notes'], 'MIDI Note', 'Distribution of Notes',
+         os.path.join(output_dir, 'note_distribution.png'))
 
     # 2. Velocity over time
-    plt.figure()
-    plt.plot(df['Time'], df['Velocity'])
-    plt.xlabel('Time')
-    plt.ylabel('Velocity')
-    plt.title('Velocity (GC Content) Over Time')
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'velocity_over_time.png'))
-    plt.close()
+    _line(*summary['velocity'], 'Time', 'Velocity', 'Velocity (GC Content) Over Time',
+          os.path.join(output_dir, 'velocity_over_time.png'))
 
     # 3. Duration distribution
-    plt.figure()
-    df['Duration'].value_counts().sort_index().plot(kind='bar')
-    plt.xlabel('Duration')
-    plt.ylabel('Count')
-    plt.title('Distribution of Note Durations')
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'duration_distribution.png'))
-    plt.close()
+    _bar(*summary['durations'], 'Duration', 'Distribution of Note Durations',
+         os.path.join(output_dir, 'duration_distribution.png'))
 
     # 4a. Instrument usage
-    plt.figure()
-    df['Instrument'].value_counts().plot(kind='bar')
-    plt.xlabel('Instrument')
-    plt.ylabel('Count')
-    plt.title('Instrument Usage')
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'instrument_usage.png'))
-    plt.close()
+    _bar(*summary['instruments'], 'Instrument', 'Instrument Usage',
+         os.path.join(output_dir, 'instrument_usage.png'))
 
     # 4b. Channel usage
-    plt.figure()
-    df['Channel'].value_counts().plot(kind='bar')
-    plt.xlabel('Channel')
-    plt.ylabel('Count')
-    plt.title('Channel Usage')
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'channel_usage.png'))
-    plt.close()
+    _bar(*summary['channels'], 'Channel', 'Channel Usage',
+         os.path.join(output_dir, 'channel_usage.png'))
 
     # 5. Pitch over time
-    plt.figure()
-    plt.plot(df['Time'], df['Note'])
-    plt.xlabel('Time')
-    plt.ylabel('Note (Pitch)')
-    plt.title('Pitch Over Time')
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'pitch_over_time.png'))
-    plt.close()
+    _line(*summary['pitch'], 'Time', 'Note (Pitch)', 'Pitch Over Time',
+          os.path.join(output_dir, 'pitch_over_time.png'))
 
     # 6. GC content profile (optional)
-    if gc_profile is not None:
-        plt.figure()
-        plt.plot(gc_profile)
-        plt.xlabel('Window Index')
-        plt.ylabel('GC Content')
-        plt.title('GC Content Profile')
-        plt.tight_layout()
-        plt.savefig(os.path.join(output_dir, 'gc_content_profile.png'))
-        plt.close()
+    if summary['gc'] is not None:
+        _line(*summary['gc'], 'Residue', 'GC Content', 'GC Content Profile',
+              os.path.join(output_dir, 'gc_content_profile.png'))
+
+
+def plot_music_data(df, gc_profile=None, output_dir='example_file_and_output', pixel_budget=PIXEL_BUDGET):
+    """Generates all plots and waits for them to be saved."""
+    render_plots(summarize_music_data(df, gc_profile, pixel_budget), output_dir)
+
+
+def plot_music_data_async(table, gc_profile=None, output_dir='example_file_and_output', pixel_budget=PIXEL_BUDGET):
+    """
+    Summarizes the table right away and draws the plots in a separate process, so the caller can go on
+    (e.g. write the MIDI file) while they render. Returns a Future; call result() to wait for the plots.
+    """
+    #multiprocessing is only loaded when plots are drawn
+    from concurrent.futures import ProcessPoolExecutor
+    summary = summarize_music_data(table, gc_profile, pixel_budget)
+    executor = ProcessPoolExecutor(max_workers=1)
+    future = executor.submit(render_plots, summary, output_dir)
+    executor.shutdown(wait=False)
+    return future
@@ -0,0 +1,146 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from packages.detect_motifs import get_motif_scanner
+from packages.get_tempo import GLOBAL_MULTIPLIER, MULTIPLIER, TempoMap, TempoStream
+from packages.sequence_context import SequenceContext
+from packages.streaming import duration_chunks, gc_chunks, motif_chunks, note_chunks, translate_chunks
+
+'''
+Multi-core processing of a single big sequence.
+The parsed sequence (the packed arrays of a SequenceContext) is copied once into shared memory,
+and every worker process attaches to it instead of getting the sequence pickled.
+Each record is split into codon-aligned chunks of residues. A worker reads its chunk plus a margin
+of bases on both sides, so GC windows and motifs that cross a chunk boundary are computed from the
+real neighbours (a motif is only counted by the chunk it starts in), and runs the same steps as the
+streaming pipeline: translation, GC, motif hits and durations.
+The parent collects the chunks in order and stitches them: the time and tick offsets of the earlier
+chunks are added, and the repeat-run tempo state is carried from one chunk to the next with
+TempoStream while the workers go on with the later chunks. ORFs are found on the stitched protein.
+The results are exactly those of the serial pipeline, whatever the number of workers or chunk size.
+'''
+
+#Residues per chunk, large enough that the per-chunk overhead does not matter
+DEFAULT_CHUNK_RESIDUES = 1 << 20
+
+_worker = None
+
+
+def share_context(context):
+    """
+    Copies the arrays of a SequenceContext into shared memory blocks.
+    Returns the blocks (unlink them when done) and a small picklable spec to attach to them with attach_context.
+    """
+    from multiprocessing import shared_memory
+    blocks, arrays = [], {}
+    for name in SequenceContext._arrays:
+        values = np.ascontiguousarray(getattr(context, name))
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+        blocks.append(block)
+        arrays[name] = (block.name, values.shape, values.dtype.str)
+    return blocks, {"headers": context.headers, "arrays": arrays}
+
+
+def attach_context(spec):
+    """Builds a SequenceContext on top of the shared memory blocks of share_context. Returns the context and the blocks."""
+    from multiprocessing import shared_memory
+    blocks, arrays = [], []
+    for name in SequenceContext._arrays:
+        block_name, shape, dtype = spec["arrays"][name]
+        #The workers share the resource tracker of the parent, which unlinks the blocks when it is done
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    return SequenceContext(spec["headers"], *arrays), blocks
+
+
+def _init_worker(spec, options):
+    global _worker
+    context, blocks = attach_context(spec)
+    _worker = SimpleNamespace(context=context, blocks=blocks, options=options)
+
+
+def chunk_tasks(context, chunk_residues=DEFAULT_CHUNK_RESIDUES):
+    """Returns (record, start, stop, residue) for every codon-aligned chunk of every record, in order."""
+    tasks = []
+    residue = 0
+    for record in range(len(context)):
+        length = context.record_length(record)
+        for start in range(0, length, 3 * chunk_residues):
+            stop = min(start + 3 * chunk_residues, length)
+            tasks.append((record, start, stop, residue))
+            residue += -(-(stop - start) // 3)
+    return tasks
+
+
+def _scan_chunk(task):
+    #Runs in a worker: reads the bases of one chunk and its margins from shared memory and runs the per-chunk steps
+    record, start, stop, residue = task
+    context, options = _worker.context, _worker.options
+    offset = int(context.record_offsets[record])
+    length = context.record_length(record)
+    margin = options["margin"]
+    low, high = max(0, start - margin), min(length, stop + margin)
+    chunk = SimpleNamespace(record=record, start=start, residue=residue,
+                            bases=context.bases(offset + start, offset + stop),
+                            left=context.bases(offset + low, offset + start),
+                            right=context.bases(offset + stop, offset + high), length=length)
+    chunks = translate_chunks([chunk])
+    chunks = note_chunks(chunks)
+    chunks = gc_chunks(chunks, options["window_size"], options["sliding"])
+    chunks = motif_chunks(chunks, options["motif_table"], options["reverse_complement"])
+    chunk = next(duration_chunks(chunks, options["ticks_per_unit"]))
+    table = chunk.table
+    return {"aa": chunk.aa, "gc": chunk.gc, "instrument": table['Instrument'], "channel": table['Channel'],
+            "duration": table['Duration'], "start_ticks": chunk.start_ticks, "duration_ticks": chunk.duration_ticks}
+
+
+def scan_parallel(context, workers=None, chunk_residues=DEFAULT_CHUNK_RESIDUES, window_size=12, sliding=False,
+                  motif_table=None, reverse_complement=False, ticks_per_unit=120, multiplier=MULTIPLIER,
+                  globalmultiplier=GLOBAL_MULTIPLIER):
+    """
+    Runs translation, GC content, motif hits, durations and the tempo multipliers of a SequenceContext
+    on 'workers' processes (all CPUs by default) and stitches the chunks.
+    Returns a SimpleNamespace with aa (str), gc (float32 per residue), instrument and channel (uint8),
+    tempo (the multipliers of tempo_map_inator with multiplier and globalmultiplier, as a TempoMap),
+    duration, time, start_ticks and duration_ticks.
+    """
+    #multiprocessing is only loaded when the parallel scan runs, see share_context too
+    from concurrent.futures import ProcessPoolExecutor
+    scanner = get_motif_scanner(motif_table, reverse_complement)
+    options = {"window_size": window_size, "sliding": sliding, "motif_table": motif_table,
+               "reverse_complement": reverse_complement, "margin": max(window_size, scanner.longest),
+               "ticks_per_unit": ticks_per_unit}
+    tasks = chunk_tasks(context, chunk_residues)
+    blocks, spec = share_context(context)
+    parts = {name: [] for name in ("gc", "instrument", "channel", "time", "duration", "start_ticks", "duration_ticks", "tempo")}
+    aa = []
+    tempo = TempoStream(multiplier, globalmultiplier)
+    time_offset, tick_offset = 0.0, 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(spec, options)) as pool:
+            #map returns the chunks in order, each one is stitched while the workers go on with the next ones
+            for result in pool.map(_scan_chunk, tasks):
+                aa.append(result["aa"])
+                for name in ("gc", "instrument", "channel", "duration", "duration_ticks"):
+                    parts[name].append(result[name])
+                #The time is the cumulative sum of the durations, continued from the chunks before
+                durations = result["duration"].astype(np.float64)
+                parts["time"].append(time_offset + np.concatenate(([0.0], np.cumsum(durations[:-1]))))
+                parts["start_ticks"].append(tick_offset + result["start_ticks"])
+                time_offset += float(durations.sum())
+                tick_offset += int(result["duration_ticks"].sum())
+                parts["tempo"].append(tempo.feed(result["aa"]))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    aa = "".join(aa)
+    empty = {"gc": np.float32, "instrument": np.uint8, "channel": np.uint8, "time": np.float64, "duration": np.float32,
+             "start_ticks": np.int64, "duration_ticks": np.int64, "tempo": np.float64}
+    result = {name: np.concatenate(values) if values else np.empty(0, dtype=empty[name]) for name, values in parts.items()}
+    result["tempo"] = TempoMap.from_values(result["tempo"])
+    return SimpleNamespace(aa=aa, **result)
@@ -0,0 +1,130 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+'''
+A small runner for named pipeline stages.
+A stage is a function that takes the shared state object, updates it and returns the number
+of items it produced (or None). Hooks are told before and after every stage, which is how
+timing, memory tracking and cProfile are attached without touching the stages themselves.
+'''
+
+
+class Pipeline:
+    '''
+    Runs named stages in order on one state object.
+    hooks are objects with optional before_stage(name, state) and after_stage(name, state, items) methods.
+    '''
+    def __init__(self, hooks=()):
+        self.stages = []
+        self.hooks = list(hooks)
+
+    def add(self, name, func):
+        self.stages.append((name, func))
+        return self
+
+    def run(self, state):
+        for name, func in self.stages:
+            for hook in self.hooks:
+                if hasattr(hook, "before_stage"):
+                    hook.before_stage(name, state)
+            items = func(state)
+            for hook in reversed(self.hooks):
+                if hasattr(hook, "after_stage"):
+                    hook.after_stage(name, state, items)
+        return state
+
+
+class StageProfiler:
+    '''
+    Records wall time, CPU time, peak traced memory (tracemalloc) and item count for every stage.
+    peak_bytes is the most memory traced at any point of the stage, including what earlier stages still hold,
+    retained_bytes is how much more is traced after the stage than before it.
+    Tracing memory slows the run down, so it is only started when this hook is used.
+    '''
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.records = []
+        self._started_tracing = False
+
+    def before_stage(self, name, state):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+            self._memory = tracemalloc.get_traced_memory()[0]
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def after_stage(self, name, state, items):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        peak = retained = None
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            retained = current - self._memory
+        self.records.append({"stage": name, "wall_seconds": wall, "cpu_seconds": cpu,
+                             "peak_bytes": peak, "retained_bytes": retained, "items": items})
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def report(self):
+        '''Returns the records plus totals as a dict, ready for json.dump.'''
+        return {
+            "stages": self.records,
+            "total_wall_seconds": sum(record["wall_seconds"] for record in self.records),
+            "total_cpu_seconds": sum(record["cpu_seconds"] for record in self.records),
+            "peak_bytes": max((record["peak_bytes"] or 0 for record in self.records), default=0),
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=2)
+
+    def summary(self):
+        '''Formats the records as a text table.'''
+        lines = [f"{'stage':<16}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'kept MB':>10}{'items':>12}"]
+        for record in self.records:
+            peak = "-" if record["peak_bytes"] is None else f"{record['peak_bytes'] / 2**20:.1f}"
+            retained = "-" if record["retained_bytes"] is None else f"{record['retained_bytes'] / 2**20:.1f}"
+            items = "-" if record["items"] is None else str(record["items"])
+            lines.append(f"{record['stage']:<16}{record['wall_seconds']:>10.3f}{record['cpu_seconds']:>10.3f}"
+                         f"{peak:>10}{retained:>10}{items:>12}")
+        report = self.report()
+        lines.append(f"{'total':<16}{report['total_wall_seconds']:>10.3f}{report['total_cpu_seconds']:>10.3f}"
+                     f"{report['peak_bytes'] / 2**20:>10.1f}")
+        return "\n".join(lines)
+
+
+class CProfileHook:
+    '''
+    Runs cProfile around a single stage and writes the stats to path (readable with pstats or snakeviz).
+    '''
+    def __init__(self, stage, path=None, top=15):
+        self.stage = stage
+        self.path = path or f"{stage}.prof"
+        self.top = top
+        self.profile = None
+
+    def before_stage(self, name, state):
+        if name == self.stage:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def after_stage(self, name, state, items):
+        if name != self.stage or self.profile is None:
+            return
+        self.profile.disable()
+        self.profile.dump_stats(self.path)
+        output = io.StringIO()
+        pstats.Stats(self.profile, stream=output).sort_stats("cumulative").print_stats(self.top)
+        print(f"cProfile of stage '{name}' written to {os.path.abspath(self.path)}")
+        print(output.getvalue())
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+
+import numpy as np
+
+from packages.translate_file import DEFAULT_CHUNK_SIZE, fasta_chunks, frame_bases, stream_fasta
+
+'''
+Parses a FASTA file once and keeps the nucleotides as a packed 2-bit array
+(A=0, C=1, G=2, T=3, four bases per byte) plus a bit mask of ambiguous positions.
+The original letters of the ambiguous bases (N, IUPAC codes, ...) are kept in a small side table,
+so every record can be decoded back to exactly the (upper-cased) sequence that was read.
+All packages that read FASTA files also accept a SequenceContext instead of a path.
+'''
+
+#Bump when the cache layout changes, old cache entries are then ignored
+CACHE_VERSION = 1
+
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGT"):
+    _BASE_CODES[_base] = _code
+_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of a file, read through mmap in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for start in range(0, len(data), DEFAULT_CHUNK_SIZE):
+                    digest.update(data[start:start + DEFAULT_CHUNK_SIZE])
+    return digest.hexdigest()
+
+
+class SequenceContext:
+    """
+    Parsed nucleotide sequences of one FASTA file.
+    packed holds 2 bits per base, ambiguous is a bit mask (np.packbits) of the bases that are not A/C/G/T,
+    exception_positions/exception_bases hold the letters of those bases, and record_offsets
+    marks where each record starts and ends in the concatenated sequence.
+    """
+    _arrays = ("packed", "ambiguous", "exception_positions", "exception_bases", "record_offsets")
+
+    def __init__(self, headers, packed, ambiguous, exception_positions, exception_bases, record_offsets, digest=None):
+        self.headers = list(headers)
+        self.packed = packed
+        self.ambiguous = ambiguous
+        self.exception_positions = exception_positions
+        self.exception_bases = exception_bases
+        self.record_offsets = record_offsets
+        self.digest = digest
+
+    def __len__(self):
+        return len(self.headers)
+
+    @property
+    def total_length(self):
+        return int(self.record_offsets[-1])
+
+    def record_length(self, index):
+        return int(self.record_offsets[index + 1] - self.record_offsets[index])
+
+    @classmethod
+    def from_fasta(cls, path, cache_dir=None):
+        """
+        Parses a FASTA file into a SequenceContext.
+        With cache_dir, the parsed arrays are stored under the SHA-256 of the file content and later
+        calls load them memory-mapped instead of parsing the file again.
+        """
+        digest = file_hash(path) if cache_dir else None
+        if cache_dir:
+            cached = cls.load(cache_dir, digest)
+            if cached is not None:
+                return cached
+
+        context = cls.from_chunks(stream_fasta(path))
+        context.digest = digest
+        if cache_dir:
+            context.save(cache_dir)
+        return context
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Parses FASTA text that is already in memory (e.g. the body of a server request) into a SequenceContext."""
+        return cls.from_chunks(fasta_chunks(data))
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """Builds a SequenceContext from (header, chunk, end_of_record) tuples, as yielded by stream_fasta."""
+        headers, offsets = [], [0]
+        packed, ambiguous, exception_positions, exception_bases = [], [], [], []
+        carry = np.empty(0, dtype=np.uint8)
+        position = 0
+        new_record = True
+        for header, chunk, end_of_record in chunks:
+            if new_record:
+                headers.append(header)
+            letters = np.frombuffer(chunk.upper(), dtype=np.uint8)
+            codes = _BASE_CODES[letters]
+            unknown = np.flatnonzero(codes == 4)
+            exception_positions.append(unknown + position)
+            exception_bases.append(letters[unknown])
+            position += len(letters)
+            new_record = end_of_record
+            if end_of_record:
+                offsets.append(position)
+
+            #Packs whole bytes of the mask (8 bases) and carries the rest into the next chunk
+            codes = np.concatenate((carry, codes))
+            cut = len(codes) - len(codes) % 8
+            carry = codes[cut:]
+            packed.append(_pack(codes[:cut]))
+            ambiguous.append(np.packbits(codes[:cut] == 4))
+
+        if len(carry):
+            padded = np.concatenate((carry, np.zeros(8 - len(carry), dtype=np.uint8)))
+            packed.append(_pack(padded))
+            ambiguous.append(np.packbits(np.concatenate((carry == 4, np.zeros(8 - len(carry), dtype=bool)))))
+        if not headers:
+            raise ValueError("No sequences found in the FASTA file.")
+
+        def join(parts, dtype):
+            return np.concatenate(parts).astype(dtype, copy=False) if parts else np.empty(0, dtype=dtype)
+
+        return cls(headers, join(packed, np.uint8), join(ambiguous, np.uint8),
+                   join(exception_positions, np.int64), join(exception_bases, np.uint8),
+                   np.array(offsets, dtype=np.int64))
+
+    def content_digest(self):
+        """
+        Returns a hash that identifies the sequences: the file digest when there is one,
+        otherwise a SHA-256 of the headers and the parsed arrays (e.g. for a record picked with select).
+        """
+        if self.digest is not None:
+            return self.digest
+        digest = hashlib.sha256(json.dumps(self.headers).encode("utf-8"))
+        for name in self._arrays:
+            digest.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        return digest.hexdigest()
+
+    def select(self, index):
+        """Returns a new SequenceContext that only holds record 'index'."""
+        return SequenceContext.from_chunks([(self.headers[index], self.record(index), True)])
+
+    def save(self, cache_dir):
+        """Writes the arrays as .npy files to cache_dir/<digest>, replacing the entry atomically."""
+        if self.digest is None:
+            raise ValueError("A SequenceContext needs a content digest to be cached.")
+        os.makedirs(cache_dir, exist_ok=True)
+        target = os.path.join(cache_dir, f"{self.digest}.v{CACHE_VERSION}")
+        if os.path.isdir(target):
+            return target
+        staging = tempfile.mkdtemp(dir=cache_dir)
+        for name in self._arrays:
+            np.save(os.path.join(staging, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(staging, "headers.json"), "w") as file:
+            json.dump(self.headers, file)
+        try:
+            os.replace(staging, target)
+        except OSError:
+            #Another process cached the same file first
+            for name in os.listdir(staging):
+                os.remove(os.path.join(staging, name))
+            os.rmdir(staging)
+        return target
+
+    @classmethod
+    def load(cls, cache_dir, digest):
+        """Loads a cached SequenceContext memory-mapped, or returns None when it is not cached."""
+        target = os.path.join(cache_dir, f"{digest}.v{CACHE_VERSION}")
+        if not os.path.isdir(target):
+            return None
+        with open(os.path.join(target, "headers.json")) as file:
+            headers = json.load(file)
+        arrays = [np.load(os.path.join(target, f"{name}.npy"), mmap_mode="r") for name in cls._arrays]
+        return cls(headers, *arrays, digest=digest)
+
+    def codes(self, start, stop):
+        """Returns the 2-bit codes of bases start:stop of the concatenated sequence (ambiguous bases read as A)."""
+        first, last = start // 4, -(-stop // 4)
+        codes = (np.asarray(self.packed[first:last])[:, None] >> _SHIFTS) & 3
+        return codes.reshape(-1)[start - first * 4:stop - first * 4]
+
+    def ambiguous_mask(self, start, stop):
+        """Returns a boolean array marking the ambiguous bases in start:stop."""
+        first, last = start // 8, -(-stop // 8)
+        mask = np.unpackbits(np.asarray(self.ambiguous[first:last]))
+        return mask[start - first * 8:stop - first * 8].astype(bool)
+
+    def bases(self, start, stop):
+        """Decodes bases start:stop of the concatenated sequence to upper-case bytes."""
+        letters = _BASES[self.codes(start, stop)]
+        low, high = np.searchsorted(self.exception_positions, [start, stop])
+        letters[np.asarray(self.exception_positions[low:high]) - start] = self.exception_bases[low:high]
+        return letters.tobytes()
+
+    def record(self, index):
+        """Returns the sequence of one record as upper-case bytes."""
+        return self.bases(int(self.record_offsets[index]), int(self.record_offsets[index + 1]))
+
+    def records(self):
+        """Yields the sequence of every record as upper-case bytes."""
+        for index in range(len(self)):
+            yield self.record(index)
+
+    def frame(self, frame):
+        """
+        Returns a SequenceContext of every record read in a reading frame (see translate_file.FRAMES):
+        frame +2 starts at the second base, frames -1/-2/-3 read the reverse complement.
+        Everything computed on it (translation, GC windows, motif positions, ORFs) then follows that frame.
+        """
+        if frame == "+1":
+            return self
+        return SequenceContext.from_chunks((header, frame_bases(self.record(index), frame), True)
+                                           for index, header in enumerate(self.headers))
+
+    def stream(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Yields (header, chunk, end_of_record) tuples like stream_fasta, decoded from the packed arrays."""
+        for index, header in enumerate(self.headers):
+            start, stop = int(self.record_offsets[index]), int(self.record_offsets[index + 1])
+            while True:
+                end = min(start + chunk_size, stop)
+                yield header, self.bases(start, end), end >= stop
+                if end >= stop:
+                    break
+                start = end
+
+
+def _pack(codes):
+    """Packs 2-bit codes (a multiple of 4 long, ambiguous bases are stored as A) four to a byte."""
+    codes = (codes & 3).reshape(-1, 4)
+    return (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
@@ -0,0 +1,256 @@
+import asyncio
+import json
+import os
+import signal
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+'''
+A long-running render server, so a web front-end does not pay for the Python start-up, the imports
+and the lookup tables (codon table, motif scanner, wavetables) on every conversion.
+It speaks plain HTTP/1.1 with keep-alive, on localhost or on a Unix socket:
+POST /render with the FASTA text as the body returns the MIDI file (or the note table or WAV),
+the options go in the query string. GET /health returns the pool and queue state as JSON.
+The workers leave their output in a temporary file that the server streams to the client and removes,
+so a large output (a long WAV) is not copied through the pool's pipe.
+Requests wait in a bounded queue and 'workers' of them run at a time on a pool of processes that
+were warmed up when the server started. When the queue is full the server answers
+503 with Retry-After instead of letting the requests pile up.
+'''
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE_SIZE = 64
+#Largest request body accepted, FASTA text of a few genes is only kilobytes
+DEFAULT_MAX_BODY = 16 << 20
+#Bytes of an output file sent at a time
+SEND_BLOCK = 1 << 20
+
+#What a render handler returns: the Content-Type and the path of the temporary output file (the server removes it)
+Rendered = namedtuple("Rendered", ["content_type", "path"])
+
+
+class RenderServer:
+    """
+    Runs handler(body, query) -> Rendered on a pool of 'workers' processes for every POST /render.
+    handler must be picklable (a module-level function), it raises ValueError for a bad request.
+    warm() is run once in every worker when it starts, to fill the caches before the first request.
+    At most queue_size requests wait for a free worker, more are turned away with 503.
+    """
+    def __init__(self, handler, workers=None, queue_size=DEFAULT_QUEUE_SIZE, max_body=DEFAULT_MAX_BODY, warm=None):
+        self.handler = handler
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.max_body = max_body
+        self.warm = warm
+        self.pool = None
+        self.queue = None
+        self.busy = 0
+        self.served = 0
+
+    def _start_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=self.warm)
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None):
+        """Starts the pool (waiting until every worker is warm), the queue consumers and the listening socket."""
+        loop = asyncio.get_running_loop()
+        self.pool = self._start_pool()
+        #The pool starts a process for every job that finds no idle worker, so this starts and warms them all
+        await asyncio.gather(*(loop.run_in_executor(self.pool, os.getpid) for _ in range(self.workers)))
+        self.queue = asyncio.Queue(self.queue_size)
+        self.consumers = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)
+            self.server = await asyncio.start_unix_server(self._connection, path=unix_path)
+        else:
+            self.server = await asyncio.start_server(self._connection, host, port)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for consumer in self.consumers:
+            consumer.cancel()
+        await asyncio.gather(*self.consumers, return_exceptions=True)
+        self.pool.shutdown(cancel_futures=True)
+
+    async def _consume(self):
+        #One consumer per worker takes the next request from the queue and runs it on the pool
+        loop = asyncio.get_running_loop()
+        while True:
+            body, query, future = await self.queue.get()
+            if future.cancelled():
+                continue
+            self.busy += 1
+            pool = self.pool
+            try:
+                result = await loop.run_in_executor(pool, self.handler, body, query)
+            except BrokenProcessPool as error:
+                #A worker died (e.g. killed for memory), the next requests get a fresh pool.
+                #Every job of the broken pool fails, only the first of them replaces it
+                if self.pool is pool:
+                    pool.shutdown(wait=False)
+                    self.pool = self._start_pool()
+                result = error
+            except Exception as error:
+                result = error
+            finally:
+                self.busy -= 1
+            if future.done():
+                #The client is gone, its output is not needed
+                if isinstance(result, Rendered):
+                    _remove(result.path)
+            elif isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def render(self, body, query):
+        """Queues one render and waits for it. Raises asyncio.QueueFull when the queue is full."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((body, query, future))
+        return await future
+
+    def health(self):
+        return {"workers": self.workers, "busy": self.busy, "queued": self.queue.qsize(),
+                "queue_size": self.queue_size, "served": self.served}
+
+    async def _dispatch(self, method, target, body):
+        #Returns (status, content type, body, extra headers) for one request, the body is bytes or a Rendered output
+        url = urlsplit(target)
+        if url.path == "/health":
+            if method != "GET":
+                return _error(HTTPStatus.METHOD_NOT_ALLOWED, "use GET", {"Allow": "GET"})
+            return HTTPStatus.OK, "application/json", json.dumps(self.health()).encode("utf-8"), {}
+        if url.path != "/render":
+            return _error(HTTPStatus.NOT_FOUND, f"unknown path {url.path}, use POST /render or GET /health")
+        if method != "POST":
+            return _error(HTTPStatus.METHOD_NOT_ALLOWED, "use POST with the FASTA text as the body", {"Allow": "POST"})
+        started = time.perf_counter()
+        try:
+            result = await self.render(body, url.query)
+        except asyncio.QueueFull:
+            return _error(HTTPStatus.SERVICE_UNAVAILABLE, "render queue is full, try again", {"Retry-After": "1"})
+        except ValueError as error:
+            return _error(HTTPStatus.BAD_REQUEST, str(error))
+        except Exception as error:
+            return _error(HTTPStatus.INTERNAL_SERVER_ERROR, f"{type(error).__name__}: {error}")
+        self.served += 1
+        milliseconds = (time.perf_counter() - started) * 1000
+        return HTTPStatus.OK, result.content_type, result, {"X-Render-Time": f"{milliseconds:.1f}ms"}
+
+    async def _connection(self, reader, writer):
+        #Serves the requests of one connection until the client closes it or asks to
+        try:
+            while True:
+                request = await _read_request(reader, self.max_body)
+                if request is None:
+                    break
+                method, target, headers, body, keep_alive = request
+                if isinstance(body, tuple):
+                    status, content_type, payload, extra = body
+                    keep_alive = False
+                else:
+                    status, content_type, payload, extra = await self._dispatch(method, target, body)
+                await _send_response(writer, status, content_type, payload, extra, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def _error(status, message, headers=None):
+    return status, "text/plain; charset=utf-8", f"{message}\n".encode("utf-8"), headers or {}
+
+
+async def _read_request(reader, max_body):
+    #Reads one request. Returns None at the end of the connection, and an error response as the body of
+    #a request that can not be served (the connection is closed after it, the rest of it is not read)
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    parts = line.decode("latin-1").split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+        return None, None, {}, _error(HTTPStatus.BAD_REQUEST, "malformed request line"), False
+    method, target, version = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    connection = headers.get("connection", "").lower()
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    if "transfer-encoding" in headers:
+        return method, target, headers, _error(HTTPStatus.LENGTH_REQUIRED, "send the body with a Content-Length"), False
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        return method, target, headers, _error(HTTPStatus.BAD_REQUEST, "bad Content-Length"), False
+    if length > max_body:
+        return method, target, headers, _error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                               f"body is larger than {max_body} bytes"), False
+    body = await reader.readexactly(length) if length > 0 else b""
+    return method, target, headers, body, keep_alive
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _send_response(writer, status, content_type, body, headers, keep_alive):
+    #Sends the head and the body, an output file is sent block by block and removed afterwards
+    try:
+        length = os.path.getsize(body.path) if isinstance(body, Rendered) else len(body)
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Type: {content_type}",
+                 f"Content-Length: {length}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if not isinstance(body, Rendered):
+            writer.write(body)
+        else:
+            with open(body.path, "rb") as file:
+                while block := file.read(SEND_BLOCK):
+                    writer.write(block)
+                    await writer.drain()
+        await writer.drain()
+    finally:
+        if isinstance(body, Rendered):
+            _remove(body.path)
+
+
+async def _serve(server, host, port, unix_path, ready):
+    listening = await server.start(host, port, unix_path)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    if ready is not None:
+        ready(listening)
+    try:
+        await stop.wait()
+    finally:
+        await server.close()
+        if unix_path and os.path.exists(unix_path):
+            os.unlink(unix_path)
+
+
+def serve(handler, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None, workers=None,
+          queue_size=DEFAULT_QUEUE_SIZE, max_body=DEFAULT_MAX_BODY, warm=None, ready=None):
+    """
+    Runs a RenderServer until SIGINT or SIGTERM, on host:port or on the Unix socket unix_path.
+    ready(listening_server) is called once the workers are warm and the socket accepts connections.
+    """
+    server = RenderServer(handler, workers, queue_size, max_body, warm)
+    asyncio.run(_serve(server, host, port, unix_path, ready))
@@ -0,0 +1,177 @@
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+
+'''
+Content-addressed cache for the outputs of pipeline stages.
+An entry is a directory of .npy arrays named after the stage and a key. The key is a SHA-256 of the
+stage name, the content hash of the input, the parameters of the stage (and the keys of the stages
+it depends on) and the source code of the modules that compute it and of the packages modules they import,
+so changing one parameter or editing one package only recomputes the stages that are affected.
+The cache is bounded in size: after every write the least recently used entries are removed
+until the total size fits in max_bytes again.
+'''
+
+DEFAULT_MAX_BYTES = 2 << 30
+#The package whose modules count for the code version
+PACKAGE = __name__.rpartition(".")[0]
+
+
+@lru_cache(maxsize=None)
+def _source_hash(path):
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _package_imports(path):
+    #Returns the source files of the packages modules that the file at path imports (also inside functions)
+    with open(path, "rb") as file:
+        tree = ast.parse(file.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module == PACKAGE:
+            names.update(f"{PACKAGE}.{alias.name}" for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.module.startswith(PACKAGE + "."):
+            names.add(node.module)
+        elif isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names if alias.name.startswith(PACKAGE + "."))
+    paths = []
+    for name in sorted(names):
+        spec = importlib.util.find_spec(name)
+        if spec is not None and spec.origin and spec.origin.endswith(".py"):
+            paths.append(spec.origin)
+    return tuple(paths)
+
+
+def _dependencies(path):
+    #The file at path and every packages module it imports, directly or through other modules
+    seen = {path}
+    todo = [path]
+    while todo:
+        for dependency in _package_imports(todo.pop()):
+            if dependency not in seen:
+                seen.add(dependency)
+                todo.append(dependency)
+    return seen
+
+
+def code_version(*objects):
+    """
+    Returns a hash of the source files that define the given modules, classes or functions,
+    and of every packages module those files import, so editing a helper module changes the version too.
+    Pass the classes of the inputs that a stage only receives (like SequenceContext) as well.
+    """
+    paths = set()
+    for obj in objects:
+        paths |= _dependencies(inspect.getsourcefile(obj))
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(_source_hash(path).encode("ascii"))
+    return digest.hexdigest()[:16]
+
+
+def make_key(stage, **parts):
+    """Returns the cache key of a stage: a SHA-256 of its name and parts (digests, parameters, versions)."""
+    text = json.dumps({"stage": stage, **parts}, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class StageCache:
+    """
+    On-disk cache of stage outputs (dicts of NumPy arrays) in cache_dir, using at most max_bytes.
+    hits and misses list the stages that were loaded from the cache or computed by fetch().
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = []
+        self.misses = []
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry(self, stage, key):
+        return os.path.join(self.cache_dir, f"{stage}-{key}")
+
+    def get(self, stage, key, mmap=True):
+        """Returns the cached arrays of a stage (memory-mapped unless mmap is False), or None."""
+        entry = self._entry(stage, key)
+        try:
+            names = [name for name in os.listdir(entry) if name.endswith(".npy")]
+            arrays = {}
+            for name in names:
+                path = os.path.join(entry, name)
+                try:
+                    arrays[name[:-len(".npy")]] = np.load(path, mmap_mode="r" if mmap else None)
+                except ValueError:
+                    #Empty arrays can not be memory-mapped
+                    arrays[name[:-len(".npy")]] = np.load(path)
+            #Marks the entry as recently used for the eviction
+            os.utime(entry)
+        except FileNotFoundError:
+            #Not cached, or evicted by another process while reading
+            return None
+        return arrays
+
+    def put(self, stage, key, arrays):
+        """Stores the arrays of a stage, replacing the entry atomically, then evicts old entries."""
+        entry = self._entry(stage, key)
+        staging = tempfile.mkdtemp(dir=self.cache_dir, prefix=".staging-")
+        for name, values in arrays.items():
+            np.save(os.path.join(staging, f"{name}.npy"), np.asarray(values))
+        try:
+            os.replace(staging, entry)
+        except OSError:
+            #Another process stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+        return entry
+
+    def fetch(self, stage, key, compute, mmap=True):
+        """Returns the cached arrays of a stage, or computes them with compute() and stores them."""
+        arrays = self.get(stage, key, mmap)
+        if arrays is not None:
+            self.hits.append(stage)
+            return arrays
+        arrays = compute()
+        self.put(stage, key, arrays)
+        self.misses.append(stage)
+        return arrays
+
+    def entries(self):
+        """Returns (last used time, size in bytes, path) of every entry, oldest first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(".staging-") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except FileNotFoundError:
+                continue
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
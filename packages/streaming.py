@@ -0,0 +1,379 @@
+import sys
+import tempfile
+import time
+from abc import abstractmethod
+from types import SimpleNamespace
+
+import numpy as np
+
+from packages.calculate_gc import gc_to_velocity, gc_windows
+from packages.detect_motifs import assign_motif_hits, get_motif_scanner
+from packages.fasta_midi_converter import AAToMidiCSV, NoteTable
+from packages.get_tempo import TempoStream
+from packages.map_duration import map_notes_to_durations
+from packages.map_pitch import find_orfs, shift_orf_pitch
+from packages.midi_writer import MidiEventWriter, event_messages
+from packages.multiplier import multiply
+from packages.translate_file import stream_source, translate_bases
+
+'''
+Streaming version of the Musicinator pipeline.
+The sequence is read in chunks of residues and every step is a generator that passes the chunks on:
+bases -> translation -> GC velocity -> motif hits -> tempo -> durations -> ORF pitch -> sink.
+Each step keeps only the state it needs across a chunk boundary: the bases around the chunk for the
+GC windows and motifs that cross it, the repeat run and multiplier of the tempo, the running tick
+of the timeline, and the notes of an ORF that is still open.
+Notes reach the sink (a growing .mid file, stdout or a MIDI port) as soon as their chunk is done,
+so the first notes come out right away and memory does not grow with the genome.
+The notes are exactly those of the normal pipeline, a streamed .mid file is byte-identical to it.
+Notes after an 'M' can only be sent once the stop codon that closes their ORF is found (their pitch
+depends on it), so they are held until then, in a temporary file once there are too many for memory.
+'''
+
+#Residues handled per chunk
+DEFAULT_CHUNK_RESIDUES = 1 << 14
+#Notes of an open ORF kept in memory, more are moved to a temporary file until its stop codon is read
+MAX_HELD_NOTES = 1 << 20
+TICKS_PER_BEAT = 480
+
+
+def base_chunks(source, chunk_residues=DEFAULT_CHUNK_RESIDUES, margin=0):
+    """
+    Yields the bases of a FASTA file (or SequenceContext) in codon-aligned chunks that never cross a record.
+    Every chunk carries up to 'margin' bases of the same record before (left) and after (right) it,
+    and the length of the record once the end of the record is within reach of the chunk (None before).
+    """
+    chunk_bases = 3 * chunk_residues
+    record = -1
+    residue = 0
+    buffer = b""
+    new_record = True
+    for header, chunk, end_of_record in stream_source(source, max(chunk_bases, 1 << 16)):
+        if new_record:
+            record += 1
+            start, left = 0, b""
+        new_record = end_of_record
+        buffer += chunk
+        #A chunk is only sent once the bases after it are read, or the record ends
+        while len(buffer) >= chunk_bases + margin or (end_of_record and buffer):
+            size = min(chunk_bases, len(buffer))
+            bases = buffer[:size]
+            yield SimpleNamespace(record=record, start=start, residue=residue, bases=bases,
+                                  left=left, right=buffer[size:size + margin],
+                                  length=start + len(buffer) if end_of_record else None)
+            left = (left + bases)[-margin:] if margin else b""
+            buffer = buffer[size:]
+            start += size
+            residue += -(-size // 3)
+
+
+def translate_chunks(chunks):
+    """Adds the amino acids of every chunk, the last codon of a record is padded with 'N' like translate_file."""
+    for chunk in chunks:
+        bases = chunk.bases
+        if len(bases) % 3:
+            bases += b"N" * (3 - len(bases) % 3)
+        chunk.aa = translate_bases(bases)
+        yield chunk
+
+
+def note_chunks(chunks):
+    """Turns every chunk into a NoteTable with the default MIDI values, like AAToMidiCSV."""
+    for chunk in chunks:
+        chunk.table = AAToMidiCSV(chunk.aa).convert_to_note_table()
+        yield chunk
+
+
+def gc_chunks(chunks, window_size=12, sliding=False, scale=1.27):
+    """Sets the velocity from the GC content of the window around every codon, using the bases around the chunk."""
+    for chunk in chunks:
+        anchors = chunk.start + np.arange(0, len(chunk.bases), 3, dtype=np.int64)
+        if sliding:
+            anchors += 1
+        gc = gc_windows(chunk.left + chunk.bases + chunk.right, anchors, window_size, sliding,
+                        offset=chunk.start - len(chunk.left), length=chunk.length)
+        chunk.gc = gc.astype(np.float32)
+        chunk.table['Velocity'] = gc_to_velocity(chunk.gc, scale)
+        yield chunk
+
+
+def motif_chunks(chunks, motif_table=None, reverse_complement=False):
+    """
+    Sets the instrument and channel of motif hits. Like generate_motif_hits only the first record is scanned,
+    hits are found in the chunk plus the bases after it, so motifs that cross into the next chunk are found.
+    """
+    scanner = get_motif_scanner(motif_table, reverse_complement)
+    for chunk in chunks:
+        if chunk.record == 0:
+            dna = chunk.bases.upper()
+            positions, motif_ids = scanner.scan(dna + chunk.right[:scanner.longest - 1].upper())
+            keep = positions < len(dna)
+            positions, motif_ids = positions[keep] + chunk.start, motif_ids[keep]
+            instruments = np.ones(len(chunk.table), dtype=np.uint8)
+            channels = np.zeros(len(chunk.table), dtype=np.uint8)
+            assign_motif_hits(instruments, channels, positions // 3 - chunk.residue, positions, motif_ids,
+                              scanner.drum_notes)
+            chunk.table['Instrument'] = instruments
+            chunk.table['Channel'] = channels
+        yield chunk
+
+
+def tempo_chunks(chunks):
+    """Multiplies the tempo by the repeat multipliers of get_tempo, carried over from chunk to chunk."""
+    tempo = TempoStream()
+    for chunk in chunks:
+        chunk.table['Tempo'] = multiply(chunk.table['Tempo'], tempo.feed(chunk.aa))
+        yield chunk
+
+
+def duration_chunks(chunks, ticks_per_unit=TICKS_PER_BEAT / 4):
+    """Sets the durations and the time of every note, and their MIDI ticks, continuing the timeline of the chunk before."""
+    time_offset = 0.0
+    tick_offset = 0
+    for chunk in chunks:
+        durations = map_notes_to_durations(chunk.table['Note']).astype(np.float64)
+        ticks = (durations * ticks_per_unit).astype(np.int64)
+        chunk.table['Duration'] = durations
+        chunk.table['Time'] = time_offset + np.concatenate(([0.0], np.cumsum(durations[:-1])))
+        chunk.start_ticks = tick_offset + np.concatenate(([0], np.cumsum(ticks[:-1])))
+        chunk.duration_ticks = ticks
+        time_offset += float(durations.sum())
+        tick_offset += int(ticks.sum())
+        yield chunk
+
+
+def orf_chunks(chunks, min_length=0, policy="outermost", max_held=MAX_HELD_NOTES):
+    """
+    Lowers the pitch of notes inside ORFs, yielding (table, start_ticks, duration_ticks) blocks of finished notes.
+    Notes from the first 'M' after the last stop codon are held until the next stop codon decides their ORF,
+    beyond max_held notes they wait in a temporary file (see HeldNotes).
+    """
+    held = HeldNotes(max_held)
+    for chunk in chunks:
+        piece = (chunk.aa, chunk.table.to_arrays(), chunk.start_ticks, chunk.duration_ticks)
+        if len(held):
+            stop = chunk.aa.find("*")
+            if stop < 0:
+                #Still inside an open ORF
+                held.append(piece)
+                continue
+            #The first stop codon closes the ORFs of every held 'M'
+            held.append(_cut(piece, 0, stop + 1))
+            yield from held.release(min_length, policy)
+            piece = _cut(piece, stop + 1, None)
+        aa, columns, start_ticks, duration_ticks = piece
+        #Everything up to the last stop codon is decided
+        done = aa.rfind("*") + 1
+        if done:
+            starts, ends = find_orfs(aa[:done], min_length, policy)
+            table = NoteTable(_slice(columns, 0, done))
+            table['Note'] = shift_orf_pitch(table['Note'], starts, ends, stack=policy == "nested")
+            yield table, start_ticks[:done], duration_ticks[:done]
+            aa, columns, start_ticks, duration_ticks = _cut(piece, done, None)
+        #Notes before the next 'M' can not be in an ORF
+        free = aa.find("M")
+        free = len(aa) if free < 0 else free
+        if free:
+            yield NoteTable(_slice(columns, 0, free)), start_ticks[:free], duration_ticks[:free]
+        if free < len(aa):
+            held.append((aa[free:], _slice(columns, free, None), start_ticks[free:], duration_ticks[free:]))
+    #ORFs without a stop codon are not ORFs, the held notes keep their pitch
+    yield from held.release(None, policy)
+
+
+class HeldNotes:
+    '''
+    The notes of an ORF that is still open, as pieces of (aa, columns, start_ticks, duration_ticks) that start
+    with its first 'M'. At most max_held notes are kept in memory, the older pieces are moved to a temporary
+    file, so a long ORF (or the whole genome with the outermost policy) does not fill the memory.
+    '''
+    def __init__(self, max_held=MAX_HELD_NOTES):
+        self.max_held = max_held
+        self.file = None
+        self._clear()
+
+    def _clear(self):
+        if self.file is not None:
+            self.file.close()
+        self.pieces = []
+        self.in_memory = 0
+        self.file = None
+        self.spilled = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, piece):
+        self.pieces.append(piece)
+        self.in_memory += len(piece[0])
+        self.length += len(piece[0])
+        if self.in_memory > self.max_held:
+            self._spill()
+
+    def _spill(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix="musicinator-orf-")
+        for aa, columns, start_ticks, duration_ticks in self.pieces:
+            names = list(columns)
+            for values in [np.frombuffer(aa.encode("ascii"), dtype=np.uint8), start_ticks, duration_ticks] + \
+                          [columns[name] for name in names]:
+                np.save(self.file, np.ascontiguousarray(values), allow_pickle=False)
+            self.spilled.append(names)
+        self.pieces = []
+        self.in_memory = 0
+
+    def _pieces(self):
+        #The held pieces in order, the ones in the file first
+        if self.file is not None:
+            self.file.seek(0)
+            for names in self.spilled:
+                aa = np.load(self.file).tobytes().decode("ascii")
+                start_ticks, duration_ticks = np.load(self.file), np.load(self.file)
+                columns = {name: np.load(self.file) for name in names}
+                yield aa, columns, start_ticks, duration_ticks
+        yield from self.pieces
+
+    def release(self, min_length, policy):
+        """
+        Yields the held notes as (table, start_ticks, duration_ticks) blocks and empties the buffer.
+        The last held note is the stop codon that closes the ORFs, or min_length is None when the sequence
+        ended without one (the notes then keep their pitch).
+        Every 'M' starts an ORF that ends at that stop, so a note is lowered once for every 'M' before it
+        (only for the first one with the outermost policy) whose ORF is at least min_length long.
+        """
+        #Starts of ORFs that are long enough lie at or before this position of the held notes
+        last_start = -1 if min_length is None else self.length - max(min_length, 1)
+        offset = 0
+        depth = 0
+        for aa, columns, start_ticks, duration_ticks in self._pieces():
+            table = NoteTable(columns)
+            if policy == "nested":
+                codes = np.frombuffer(aa.encode("ascii"), dtype=np.uint8)
+                local = np.flatnonzero(codes == ord("M"))
+                local = local[local + offset <= last_start]
+            else:
+                local = np.array([0] if offset == 0 and last_start >= 0 else [], dtype=np.int64)
+            #The ORFs of the 'M's in earlier pieces cover the whole piece
+            starts = np.concatenate((np.zeros(depth, dtype=np.int64), local))
+            table['Note'] = shift_orf_pitch(table['Note'], starts, np.full(len(starts), len(aa) - 1),
+                                            stack=policy == "nested")
+            depth += len(local)
+            offset += len(aa)
+            yield table, start_ticks, duration_ticks
+        self._clear()
+
+
+def _cut(piece, start, stop):
+    aa, columns, start_ticks, duration_ticks = piece
+    return aa[start:stop], _slice(columns, start, stop), start_ticks[start:stop], duration_ticks[start:stop]
+
+
+def _slice(columns, start, stop):
+    return {name: values[start:stop] for name, values in columns.items()}
+
+
+def stream_notes(source, chunk_residues=DEFAULT_CHUNK_RESIDUES, motif_table=None, reverse_complement=False,
+                 window_size=12, sliding=False, min_orf_length=0, orf_policy="outermost"):
+    """
+    Chains the streaming steps and yields (table, start_ticks, duration_ticks) blocks of finished notes,
+    in order. The start ticks are the positions on the timeline, without the rests the MIDI export adds.
+    """
+    scanner = get_motif_scanner(motif_table, reverse_complement)
+    chunks = base_chunks(source, chunk_residues, margin=max(window_size, scanner.longest))
+    chunks = translate_chunks(chunks)
+    chunks = note_chunks(chunks)
+    chunks = gc_chunks(chunks, window_size, sliding)
+    chunks = motif_chunks(chunks, motif_table, reverse_complement)
+    chunks = tempo_chunks(chunks)
+    chunks = duration_chunks(chunks)
+    return orf_chunks(chunks, min_orf_length, orf_policy)
+
+
+def stream_render(source, sink, **options):
+    """
+    Streams the notes of a FASTA file (or SequenceContext) into a sink, a MidiEventWriter such as
+    MidiTrackWriter (a .mid file that grows block by block), MidiTextSink or MidiPortSink. Returns the number of notes.
+    """
+    count = 0
+    with sink:
+        for table, start_ticks, duration_ticks in stream_notes(source, **options):
+            #Each note is followed by a rest as long as the note itself, like the normal MIDI export
+            sink.add_notes(table['Note'], table['Velocity'], 2 * start_ticks, duration_ticks,
+                           table['Channel'], table['Instrument'], table['Tempo'])
+            sink.flush()
+            count += len(table)
+    return count
+
+
+class MidiMessageSink(MidiEventWriter):
+    '''
+    Base class of the sinks that handle one MIDI message at a time.
+    send(tick, seconds, message) gets every message with its tick and its time in seconds,
+    which follows the set_tempo events of the stream.
+    '''
+    def __init__(self, ticks_per_beat=TICKS_PER_BEAT):
+        super().__init__(ticks_per_beat)
+        self._tick = 0
+        self._seconds = 0.0
+        self._micros_per_beat = 500_000
+
+    def _write(self, events):
+        for tick, message in event_messages(events):
+            self._seconds += (tick - self._tick) * self._micros_per_beat / 1e6 / self.ticks_per_beat
+            self._tick = tick
+            if message[:2] == b"\xff\x51":
+                self._micros_per_beat = int.from_bytes(message[3:6], "big")
+            self.send(tick, self._seconds, message)
+
+    @abstractmethod
+    def send(self, tick, seconds, message):
+        '''Handles one MIDI message, every sink writes or plays it.'''
+
+    def flush(self):
+        pass
+
+
+class MidiTextSink(MidiMessageSink):
+    '''Writes every message as a line of text: tick, time in seconds and the message bytes in hex.'''
+    def __init__(self, stream=None, ticks_per_beat=TICKS_PER_BEAT):
+        super().__init__(ticks_per_beat)
+        self.stream = stream or sys.stdout
+
+    def send(self, tick, seconds, message):
+        self.stream.write(f"{tick}\t{seconds:.4f}\t{message.hex(' ')}\n")
+
+    def flush(self):
+        self.stream.flush()
+
+
+class MidiPortSink(MidiMessageSink):
+    '''
+    Plays the stream in real time on a MIDI output port (needs the mido package and a MIDI backend such as python-rtmidi).
+    Sending waits for the time of each message, so the pipeline never runs far ahead of the music.
+    '''
+    def __init__(self, port_name=None, ticks_per_beat=TICKS_PER_BEAT):
+        super().__init__(ticks_per_beat)
+        try:
+            import mido
+            self.port = mido.open_output(port_name)
+        except ImportError as err:
+            raise ImportError("Playing on a MIDI port needs the mido and python-rtmidi packages "
+                              "(pip install mido python-rtmidi).") from err
+        self._mido = mido
+        self._started = None
+
+    def send(self, tick, seconds, message):
+        if message[0] == 0xFF:
+            #Meta events only change the tempo, they are not sent to the port
+            return
+        if self._started is None:
+            self._started = time.monotonic() - seconds
+        delay = self._started + seconds - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.port.send(self._mido.Message.from_bytes(message))
+
+    def close(self):
+        super().close()
+        self.port.close()
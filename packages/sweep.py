@@ -0,0 +1,150 @@
+import csv
+import itertools
+import os
+from collections import namedtuple
+from types import SimpleNamespace
+
+from packages.batch import safe_name, unique_names
+from packages.calculate_gc import calculate_gc_sweep, gc_to_velocity
+from packages.detect_motifs import generate_motif_hits, read_motif_table
+from packages.farruhs_packages import farruhs_packages, repeat_instruments
+from packages.fasta_midi_converter import AAToMidiCSV, NoteTable
+from packages.get_tempo import tempo_maps_inator
+from packages.map_duration import compute_timeline, map_notes_to_durations
+from packages.map_pitch import find_orfs, shift_orf_pitch
+from packages.midi_writer import write_note_table
+from packages.translate_file import translate_file
+
+'''
+Parameter sweeps: many variants of one sequence, rendered from shared intermediates.
+Translation, the note table, the durations, the timeline and the ORFs do not depend on the swept
+parameters, so they are computed once. The varying stages are computed once per distinct value
+and in batches: the GC content of all window sizes from one prefix sum (calculate_gc_sweep),
+the velocities of all window sizes for one scale in one array operation, the tempo maps of all
+multiplier pairs from one pass over the repeat runs (tempo_maps_inator), and the motif hits once per table.
+Every variant then only puts its columns together and writes its MIDI file, on a pool of processes.
+'''
+
+#One point of the grid, motif_table is the path of a motif table or None for the built-in motifs
+SweepVariant = namedtuple("SweepVariant", ["name", "gc_window", "velocity_scale", "multiplier", "global_multiplier",
+                                           "motif_table"])
+
+_worker = None
+
+
+def sweep_grid(gc_windows, velocity_scales, tempos, motif_tables):
+    """
+    Returns a SweepVariant for every combination of the GC window sizes, velocity scales,
+    (multiplier, global multiplier) tempo pairs and motif tables (paths, None for the built-in motifs).
+    Repeated values are only used once, and variants whose values print the same (1.0 and 1.0000001)
+    get numbered names, so every variant writes its own files.
+    """
+    gc_windows, velocity_scales, tempos, motif_tables = (list(dict.fromkeys(values)) for values in
+                                                         (gc_windows, velocity_scales, tempos, motif_tables))
+    stems = [safe_name(os.path.splitext(os.path.basename(path))[0]) if path else "builtin" for path in motif_tables]
+    #Two tables with the same file name in different directories get numbered names
+    labels = stems if len(set(stems)) == len(stems) else [f"{stem}{index + 1}" for index, stem in enumerate(stems)]
+    variants = []
+    for gc_window, scale, (multiplier, global_multiplier), (label, motif_table) in itertools.product(
+            gc_windows, velocity_scales, tempos, zip(labels, motif_tables)):
+        name = f"gc{gc_window}_vel{scale:g}_tempo{multiplier:g}x{global_multiplier:g}_{label}"
+        variants.append(SweepVariant(name, gc_window, scale, multiplier, global_multiplier, motif_table))
+    names = unique_names(variant.name for variant in variants)
+    return [variant._replace(name=name) for variant, name in zip(variants, names)]
+
+
+def prepare_sweep(context, variants, sliding=False, reverse_complement=False, min_orf_length=0, orf_policy="outermost",
+                  repeats=None, tempo_column=True, ticks_per_unit=120, aa=None):
+    """
+    Computes everything the variants need from a SequenceContext: the shared columns and timeline once,
+    and the velocities, tempo maps and motif columns once per distinct parameter value.
+    repeats are the TandemRepeats of the sequence (see detect_repeats) or None.
+    aa is the translation of the context when the caller already has it (e.g. to find the repeats).
+    """
+    aa = translate_file(context) if aa is None else aa
+    table = AAToMidiCSV(aa).process(save=False)
+    #Durations come from the notes before the ORF shift, like in the render pipeline
+    table['Duration'] = map_notes_to_durations(table['Note'])
+    time, start_ticks, duration_ticks = compute_timeline(table['Duration'], ticks_per_unit)
+    table['Time'] = time
+    orf_starts, orf_ends = find_orfs(aa, min_orf_length, orf_policy)
+    table['Note'] = shift_orf_pitch(table['Note'], orf_starts, orf_ends, stack=orf_policy == "nested")
+
+    windows = sorted({variant.gc_window for variant in variants})
+    profiles = calculate_gc_sweep(context, windows, sliding)
+    velocities = {}
+    for scale in sorted({variant.velocity_scale for variant in variants}):
+        for window, row in zip(windows, gc_to_velocity(profiles, scale)):
+            velocities[window, scale] = row
+
+    pairs = sorted({(variant.multiplier, variant.global_multiplier) for variant in variants})
+    tempos = dict(zip(pairs, tempo_maps_inator(aa, pairs)))
+    if repeats is not None:
+        repeat_map = repeats.tempo_map(len(aa))
+        tempos = {pair: tempomap.multiplied(repeat_map) for pair, tempomap in tempos.items()}
+
+    motifs = {}
+    for motif_table in {variant.motif_table for variant in variants}:
+        instrument, channel = generate_motif_hits(context, len(aa), read_motif_table(motif_table) if motif_table else None,
+                                                  reverse_complement)
+        columns = {"Instrument": instrument, "Channel": channel}
+        if repeats is not None:
+            repeat_instruments(columns, repeats)
+        motifs[motif_table] = (columns['Instrument'], columns['Channel'])
+
+    return SimpleNamespace(aa=aa, columns=table.to_arrays(), start_ticks=start_ticks, duration_ticks=duration_ticks,
+                           velocities=velocities, tempos=tempos, motifs=motifs, tempo_column=tempo_column)
+
+
+def variant_table(data, variant):
+    """Puts the NoteTable of one variant together from the prepared data of prepare_sweep."""
+    table = NoteTable(data.columns)
+    table['Velocity'] = data.velocities[variant.gc_window, variant.velocity_scale]
+    table = farruhs_packages(data.aa, table, tempo_column=data.tempo_column,
+                             tempomap=data.tempos[variant.multiplier, variant.global_multiplier])
+    table['Instrument'], table['Channel'] = data.motifs[variant.motif_table]
+    return table
+
+
+def _init_worker(data):
+    global _worker
+    _worker = data
+
+
+def _write_variant(task):
+    #Runs in a worker: writes the MIDI file (and the table) of one variant
+    variant, midi_out, table_out, table_format, ticks_per_beat = task
+    table = variant_table(_worker, variant)
+    write_note_table(midi_out, table, 2 * _worker.start_ticks, _worker.duration_ticks, ticks_per_beat)
+    if table_out:
+        table.save(table_out, table_format)
+    return midi_out
+
+
+def run_sweep(context, variants, output_dir, jobs=None, table_format=None, ticks_per_beat=480, **options):
+    """
+    Renders every variant of a SequenceContext to <output_dir>/<name>.mid, and with table_format also its table
+    (<name>.csv, .npz or .parquet). The MIDI files are written on 'jobs' processes (all CPUs by default).
+    options are passed on to prepare_sweep. Writes sweep.csv, the parameters of every variant,
+    and returns the paths of the MIDI files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    data = prepare_sweep(context, variants, ticks_per_unit=ticks_per_beat / 4, **options)
+    tasks = [(variant, os.path.join(output_dir, f"{variant.name}.mid"),
+              os.path.join(output_dir, f"{variant.name}.{table_format}") if table_format else None,
+              table_format, ticks_per_beat) for variant in variants]
+    if jobs == 1:
+        _init_worker(data)
+        paths = [_write_variant(task) for task in tasks]
+    else:
+        #The prepared data is sent once to every worker, the tasks only carry the parameters
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(data,)) as pool:
+            paths = list(pool.map(_write_variant, tasks, chunksize=max(1, len(tasks) // (4 * (jobs or os.cpu_count() or 1)))))
+
+    with open(os.path.join(output_dir, "sweep.csv"), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(SweepVariant._fields + ("midi",))
+        for variant, path in zip(variants, paths):
+            writer.writerow(variant[:-1] + (variant.motif_table or "builtin", os.path.basename(path)))
+    return paths
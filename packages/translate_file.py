@@ -1,37 +1,217 @@
-from Bio import SeqIO
-from Bio.Seq import Seq
+import mmap
+import os
+from functools import lru_cache
+
+import numpy as np
+
+#Number of FASTA bytes read at a time by the streaming functions
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+#Reading frames: +1, +2, +3 start at the first, second and third base, -1, -2, -3 do the same on the reverse complement
+FRAMES = ("+1", "+2", "+3", "-1", "-2", "-3")
+
+#Every base letter (lower case and U included) as an index into the IUPAC alphabet, _INVALID for anything else.
+#A codon of three indices is looked up in a table of 16 * 16 * 16 entries.
+_IUPAC = b"ACGTRYSWKMBDHVN"
+_INVALID = 15
+_BASE_INDEX = np.full(256, _INVALID, dtype=np.uint16)
+for _index, _letter in enumerate(_IUPAC):
+    _BASE_INDEX[_letter] = _index
+    _BASE_INDEX[ord(chr(_letter).lower())] = _index
+_BASE_INDEX[ord("U")] = _BASE_INDEX[ord("u")] = _IUPAC.index(b"T")
+_N = _IUPAC.index(b"N")
+#Index of the complement of every index, for the reverse strand
+_COMPLEMENT_INDEX = np.array([_IUPAC.index(letter) for letter in b"TGCAYRSWMKVHDBN"] + [_INVALID], dtype=np.uint16)
+_COMPLEMENT = bytes.maketrans(b"ACGTURYSWKMBDHVNacgturyswkmbdhvn", b"TGCAAYRSWMKVHDBNtgcaayrswmkvhdbn")
+
+#The standard genetic code (NCBI table 1) for the codons in TCAG order, TTT TTC TTA TTG TCT ... GGG
+_STANDARD_CODE = b"FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+#The bases every IUPAC letter stands for
+_IUPAC_BASES = {"A": "A", "C": "C", "G": "G", "T": "T", "R": "AG", "Y": "CT", "S": "CG", "W": "AT", "K": "GT",
+                "M": "AC", "B": "CGT", "D": "AGT", "H": "ACT", "V": "ACG", "N": "ACGT"}
+#Ambiguous amino acids: Asx, Glx and Xle
+_AMBIGUOUS_RESIDUES = {b"DN": "B", b"EQ": "Z", b"IL": "J"}
 
 def read_fasta(filename):
     """Reads a FASTA file and returns a list of SeqRecord objects."""
+    from Bio import SeqIO
     records = []
     with open(filename, "r") as file:
         for sequence in SeqIO.parse(file, "fasta"):
             records.append(sequence)
     return records
 
-def translate_file(file):
+def stream_fasta(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+
+    """Memory-maps a FASTA file and yields (header, chunk, end_of_record) tuples.
+       Each chunk holds the sequence bytes of at most chunk_size bytes of the file, with line breaks and spaces removed,
+       so memory use does not depend on the size of the records."""
+
+    with open(filename, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from fasta_chunks(data, chunk_size)
+
+def fasta_chunks(data, chunk_size=DEFAULT_CHUNK_SIZE):
+
+    """Yields the (header, chunk, end_of_record) tuples of FASTA text that is already in memory (bytes or an mmap),
+       like stream_fasta does for a file."""
+
+    position = data.find(b">")
+    while position != -1:
+        #The header runs to the end of its line
+        header_end = data.find(b"\n", position)
+        if header_end == -1:
+            header_end = len(data)
+        header = data[position + 1:header_end].decode("ascii", "replace").strip()
+
+        #The sequence runs to the next line that starts a record
+        next_record = data.find(b"\n>", header_end)
+        sequence_end = len(data) if next_record == -1 else next_record
+
+        start = header_end + 1
+        while True:
+            stop = min(start + chunk_size, sequence_end)
+            end_of_record = stop >= sequence_end
+            yield header, data[start:stop].translate(None, b" \t\r\n"), end_of_record
+            if end_of_record:
+                break
+            start = stop
+
+        position = -1 if next_record == -1 else next_record + 1
+
+def stream_source(source, chunk_size=DEFAULT_CHUNK_SIZE):
+
+    """Streams a FASTA path, or a parsed SequenceContext, as (header, chunk, end_of_record) tuples."""
+
+    if hasattr(source, "stream"):
+        return source.stream(chunk_size)
+    return stream_fasta(source, chunk_size)
+
+def read_records(source):
+
+    """Yields the sequence of every record in a FASTA file (or SequenceContext) as bytes, one record in memory at a time."""
+
+    chunks = []
+    for header, chunk, end_of_record in stream_source(source):
+        chunks.append(chunk)
+        if end_of_record:
+            yield b"".join(chunks)
+            chunks = []
+
+def translate_stream(file, chunk_size=DEFAULT_CHUNK_SIZE):
+
+    """Streams a FASTA file (or SequenceContext) and yields the translated amino acids one chunk at a time.
+       Bases left over at the end of a chunk are carried into the next one, so codons split across chunks or lines are translated whole.
+       Every record is padded with 'N' to a full codon, the same as translate_file."""
+
+    carry = b""
+    for header, chunk, end_of_record in stream_source(file, chunk_size):
+        bases = carry + chunk
+        if end_of_record:
+            #Pads the last codon of the record
+            bases = _pad_codon(bases)
+            carry = b""
+        else:
+            #Keeps the incomplete codon for the next chunk
+            cut = len(bases) - len(bases) % 3
+            bases, carry = bases[:cut], bases[cut:]
+        if bases:
+            yield translate_bases(bases)
+
+@lru_cache(maxsize=None)
+def codon_table():
+
+    """Returns the amino acid (as an ASCII code) of every codon index, built once from the standard genetic code.
+       Ambiguous codons give the same letters as Biopython's Seq.translate: the amino acid all their codons share,
+       B, Z or J for the ambiguous amino acids, '*' when all are stops and X otherwise."""
+
+    #Which of the bases T, C, A, G every IUPAC letter stands for
+    stands_for = np.array([[base in _IUPAC_BASES[chr(letter)] for base in "TCAG"] for letter in _IUPAC])
+    letters = np.arange(len(_IUPAC))
+    first, second, third = (index.ravel() for index in np.meshgrid(letters, letters, letters, indexing="ij"))
+    #covers[k, c] is True when codon k can be the concrete codon c (0-63 in TCAG order)
+    covers = (stands_for[first][:, :, None, None] & stands_for[second][:, None, :, None]
+              & stands_for[third][:, None, None, :]).reshape(len(first), 64)
+
+    #The set of amino acids of every codon as a row of flags, one column per amino acid letter
+    residues = np.array(sorted(set(_STANDARD_CODE)), dtype=np.uint8)
+    code = np.searchsorted(residues, np.frombuffer(_STANDARD_CODE, dtype=np.uint8))
+    present = np.stack([covers[:, code == residue].any(axis=1) for residue in range(len(residues))], axis=1)
+
+    values = np.full(len(first), ord("X"), dtype=np.uint8)
+    single = present.sum(axis=1) == 1
+    values[single] = residues[present[single].argmax(axis=1)]
+    for pair, letter in _AMBIGUOUS_RESIDUES.items():
+        flags = np.array([residue in pair for residue in residues.tolist()])
+        values[(present == flags).all(axis=1)] = ord(letter)
+
+    table = np.full(1 << 12, ord("X"), dtype=np.uint8)
+    table[(first << 8) | (second << 4) | third] = values
+    return table
+
+def _codon_indices(indices):
+
+    """Returns the codon index starting at every position of an array of base indices, padded with N at the end."""
+
+    padded = np.concatenate((indices, [_N, _N])).astype(np.uint16)
+    return (padded[:-2] << 8) | (padded[1:-1] << 4) | padded[2:]
+
+def translate_bases(bases):
+
+    """Translates whole codons of bases (bytes) into an amino acid string.
+       The bases are turned into codon indices and looked up in codon_table() in one vectorized step,
+       only letters that are not nucleotide codes go through Biopython (which raises on them like before)."""
+
+    indices = _BASE_INDEX[np.frombuffer(bases, dtype=np.uint8)]
+    if (indices == _INVALID).any():
+        from Bio.Seq import Seq
+        return str(Seq(bases.decode("ascii")).translate(to_stop=False))
+    return codon_table()[_codon_indices(indices)[::3]].tobytes().decode("ascii")
+
+def frame_bases(bases, frame):
+
+    """Returns the bases of one record (bytes) read in a frame: shifted for +2/+3, reverse complemented for -1/-2/-3."""
+
+    if frame not in FRAMES:
+        raise ValueError(f"Unknown reading frame {frame}, use one of {', '.join(FRAMES)}.")
+    if frame[0] == "-":
+        bases = bases.translate(_COMPLEMENT)[::-1]
+    return bases[int(frame[1]) - 1:]
+
+def translate_frames(bases, frames=FRAMES):
 
-    """Takes in a FASTA file and returns a single string with all the translated records."""
-    
-    #FastA File read call
-    sequences = read_fasta(file)
+    """Translates one record (bytes) in several reading frames, by default all six, and returns {frame: amino acids}.
+       The codon index of every position of a strand is computed once and each frame takes every third one,
+       so six frames cost about two translations. Every frame is padded with 'N' to a full codon, like translate_file."""
 
-    #Empty string setup
-    translatedsequences = ''
+    indices = _BASE_INDEX[np.frombuffer(bases, dtype=np.uint8)]
+    if (indices == _INVALID).any():
+        return {frame: translate_bases(_pad_codon(frame_bases(bases, frame))) for frame in frames}
+    strands = {}
+    table = codon_table()
+    proteins = {}
+    for frame in frames:
+        if frame not in FRAMES:
+            raise ValueError(f"Unknown reading frame {frame}, use one of {', '.join(FRAMES)}.")
+        strand = frame[0]
+        if strand not in strands:
+            strands[strand] = _codon_indices(indices if strand == "+" else _COMPLEMENT_INDEX[indices[::-1]])
+        proteins[frame] = table[strands[strand][int(frame[1]) - 1::3]].tobytes().decode("ascii")
+    return proteins
 
-    #Interates through all the seqrecords, translates the sequences, and makes a cumulated string of all the amino acids
-    for seq in sequences:
-        seq =str(seq.seq)
-        if len(seq)%3==1:
-            seq+="NN"
-        elif len(seq)%3==2:
-            seq+="N"
+def _pad_codon(bases):
+    if len(bases) % 3:
+        bases += b"N" * (3 - len(bases) % 3)
+    return bases
 
-        translation = str((Seq(seq)).translate(to_stop=False))
+def translate_file(file, frame="+1"):
 
-        #Cumulated string of all the sequences
-        translatedsequences += translation
-        
-        #Returns the string
-    return translatedsequences
+    """Takes in a FASTA file (or SequenceContext) and returns a single string with all the translated records.
+       frame selects another reading frame (see FRAMES), frame +1 is streamed chunk by chunk."""
 
+    #Joins the streamed chunks once instead of growing a string, which keeps the translation linear in the file size
+    if frame == "+1":
+        return "".join(translate_stream(file))
+    return "".join(translate_frames(record, (frame,))[frame] for record in read_records(file))
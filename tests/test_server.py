@@ -0,0 +1,59 @@
+import asyncio
+import importlib.util
+import os
+import sys
+from functools import partial
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import musicinator
+from packages.server import RenderServer
+
+'''
+Checks that a serve request with a FASTA body that can not be translated, or an output format that can not
+be written here, is a bad request (400), not a server error. Run from the repository root with: python -m pytest tests
+'''
+
+SETTINGS = {"motif_table": None, "stage_cache": None, "stage_cache_size": 0}
+BAD_LETTERS = b">x\nJJJJJJ\n"
+GOOD_FASTA = b">x\nATGGCCATTGTAATGGGCCGCTGA\n"
+
+
+def test_render_request_rejects_bad_letters():
+    with pytest.raises(ValueError, match="can not be translated"):
+        musicinator.render_request(SETTINGS, BAD_LETTERS, "")
+
+
+def test_render_request_rejects_parquet_without_pyarrow():
+    if importlib.util.find_spec("pyarrow") is not None:
+        pytest.skip("pyarrow is installed")
+    with pytest.raises(ValueError, match="pyarrow"):
+        musicinator.render_request(SETTINGS, GOOD_FASTA, "output=parquet")
+
+
+async def _post(body):
+    #Starts a server with one worker, POSTs body to /render and returns the status code of the answer
+    server = RenderServer(partial(musicinator.render_request, SETTINGS), workers=1)
+    listening = await server.start(port=0)
+    try:
+        port = listening.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"POST /render HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+                     b"Content-Length: %d\r\n\r\n" % len(body) + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        await reader.read()
+        writer.close()
+        return status
+    finally:
+        await server.close()
+
+
+def test_bad_letters_get_400():
+    assert asyncio.run(_post(BAD_LETTERS)) == 400
+
+
+def test_good_fasta_gets_200():
+    assert asyncio.run(_post(GOOD_FASTA)) == 200